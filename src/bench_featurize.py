@@ -0,0 +1,83 @@
+from functools import partial
+import time
+import numpy as np
+import pandas as pd
+import dataset
+import featurize
+from bench_speed_distance import compute_speed_distance_apply
+from predict import resample_activity, window_features
+
+def featurize_groupby(sample_df, speed_thres=0, window=2*5, interval="30s"):
+    """[Featurization as predict.featurize_records did it before the array
+        engine, with the row-wise geopy distances the mode model was trained
+        on, kept as the reference for the benchmark]
+    Args:
+        sample_df ([pandas df]): [records with time, position_lat, position_long,
+                                  altitude and activity_id columns]
+        speed_thres (int, optional): [see featurize.featurize]. Defaults to 0.
+        window (int, optional): [see featurize.featurize]. Defaults to 2*5.
+        interval ([string]): [see featurize.featurize] Defaults to 30s
+    Returns:
+        [tuple of pandas df]: [resampled records and window features]
+    """
+    sample_df['time'] = pd.to_datetime(sample_df['time'], utc=True)
+    sample_df['time'] = sample_df['time'].dt.tz_localize(tz=None)
+    sample_df.set_index('time', inplace=True)
+    resample_activity_instance = partial(resample_activity, interval=interval)
+    sample_df = sample_df.groupby(['activity_id']).apply(resample_activity_instance).reset_index().set_index('time')
+    sample_df = sample_df.fillna(method='ffill')
+    sample_df = sample_df.fillna(method='bfill')
+    sample_df = compute_speed_distance_apply(sample_df)
+    sample_data = window_features(sample_df, speed_thres, window)
+    return sample_df, sample_data.dropna()
+
+def load_records(person):
+    """[Reads the records of a person in the shape featurize expects]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where activity files are.]
+    Returns:
+        [pandas dataframe]: [records with time, position_lat, position_long,
+                             altitude and activity_id columns]
+    """
+    df = dataset.read_records(person, columns=['timestamp', 'position_lat', 'position_long',
+                                               'altitude', 'activity_id'])
+    return df.rename(columns={'timestamp': 'time'})
+
+def check_same(records):
+    """[Checks the array engine gives the groupby features for every single
+        activity, to within the micrometres Vincenty's formula and geopy's
+        geodesic distance differ by]
+    Args:
+        records ([pandas dataframe]): [see output of load_records]
+    """
+    for activity_id, activity in records.groupby('activity_id'):
+        _, expected = featurize_groupby(activity.copy())
+        _, result = featurize.featurize(activity.copy())
+        np.testing.assert_array_equal(expected.index, result.index, err_msg=str(activity_id))
+        np.testing.assert_allclose(expected.values, result.values, rtol=1e-7, atol=1e-5,
+                                   err_msg=str(activity_id))
+
+def time_function(function, records, repeats=3):
+    """[Times featurizing all activities together]
+    Args:
+        function ([function]): [featurize_groupby or featurize.featurize]
+        records ([pandas dataframe]): [see output of load_records]
+        repeats (int, optional): [number of runs]. Defaults to 3.
+    Returns:
+        [float]: [best rows/sec]
+    """
+    best = float('inf')
+    for _ in range(repeats):
+        df = records.copy()
+        start = time.perf_counter()
+        function(df)
+        best = min(best, time.perf_counter() - start)
+    return len(records) / best
+
+if __name__ == '__main__':
+    records = load_records('Example_Strava')
+    check_same(records)
+    print(f'{records.activity_id.nunique()} activities, features match per activity')
+    for function in [featurize_groupby, featurize.featurize]:
+        print(f'{function.__name__:>20}: {time_function(function, records):,.0f} rows/sec')
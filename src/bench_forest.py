@@ -0,0 +1,103 @@
+import os
+import pickle
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestClassifier
+import forest
+from featurize import FEATURE_COLUMNS
+
+def training_data(n_rows=50000, seed=0):
+    """[Features to train the benchmark forest on: ../data/featurized.parquet
+        if it exists, otherwise random features with a learnable mode]
+    Args:
+        n_rows (int, optional): [rows of random features]. Defaults to 50000.
+        seed (int, optional): [random seed]. Defaults to 0.
+    Returns:
+        [tuple of numpy arrays]: [X, y]
+    """
+    if os.path.exists('../data/featurized.parquet'):
+        df = pd.read_parquet('../data/featurized.parquet')
+        return df.drop('mode', axis=1).values, df['mode'].values
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(n_rows, len(FEATURE_COLUMNS)))
+    modes = np.array(['fly_down', 'run_down', 'run_up', 'ski_down', 'ski_up'])
+    y = modes[(2 * X[:, 0] + X[:, 3] - X[:, 6] + rng.normal(size=n_rows)).astype(int) % len(modes)]
+    return X, y
+
+def time_load(clf, directory):
+    """[Times loading the pickled classifier and the memory mapped forest]
+    Args:
+        clf ([RandomForestClassifier]): [fit classifier]
+        directory ([string]): [scratch directory]
+    Returns:
+        [dictionary]: [load seconds and file size in MB of each]
+    """
+    filename = os.path.join(directory, 'model.pkl')
+    with open(filename, 'wb') as f:
+        pickle.dump(clf, f)
+    forest.export_forest(clf, os.path.join(directory, 'forest'))
+    start = time.perf_counter()
+    with open(filename, 'rb') as f:
+        pickle.load(f)
+    pickle_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    forest.load_forest(os.path.join(directory, 'forest'))
+    forest_seconds = time.perf_counter() - start
+    forest_size = sum(os.path.getsize(os.path.join(directory, 'forest', name))
+                      for name in os.listdir(os.path.join(directory, 'forest')))
+    return {'pickle': (pickle_seconds, os.path.getsize(filename) / 1e6),
+            'forest': (forest_seconds, forest_size / 1e6)}
+
+def time_latency(predict, X, repeats=200):
+    """[Median time to predict a single window]
+    Args:
+        predict ([function]): [predict function]
+        X ([numpy array]): [rows to predict one at a time]
+        repeats (int, optional): [number of single row predictions]. Defaults to 200.
+    Returns:
+        [float]: [median milliseconds per call]
+    """
+    times = []
+    for i in range(repeats):
+        row = X[i % len(X)][None, :]
+        start = time.perf_counter()
+        predict(row)
+        times.append(time.perf_counter() - start)
+    return np.median(times) * 1e3
+
+def time_throughput(predict, X, repeats=3):
+    """[Best rows per second predicting a whole batch]
+    Args:
+        predict ([function]): [predict function]
+        X ([numpy array]): [rows to predict]
+        repeats (int, optional): [number of runs]. Defaults to 3.
+    Returns:
+        [float]: [rows/sec]
+    """
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        predict(X)
+        best = min(best, time.perf_counter() - start)
+    return len(X) / best
+
+if __name__ == '__main__':
+    X, y = training_data()
+    clf = RandomForestClassifier(bootstrap=False, max_depth=15, max_features='sqrt',
+                                 min_samples_split=5, n_estimators=600, random_state=0)
+    clf.fit(X, y)
+    X_test = np.random.default_rng(1).permutation(X)[:20000]
+    with tempfile.TemporaryDirectory() as directory:
+        loads = time_load(clf, directory)
+        compiled = forest.CompiledForest(forest.load_forest(os.path.join(directory, 'forest')))
+        expected = clf.predict(X_test)
+        result = compiled.predict(X_test)
+        print(f'{(expected == result).mean():.2%} of {len(X_test)} predictions match, '
+              f'max probability difference {np.abs(clf.predict_proba(X_test) - compiled.predict_proba(X_test)).max():.1e}')
+        for name, model in [('pickle', clf), ('forest', compiled)]:
+            seconds, size = loads[name]
+            print(f'{name:>7}: {size:7.1f} MB, load {seconds*1e3:8.1f} ms, '
+                  f'latency {time_latency(model.predict, X_test):6.2f} ms/window, '
+                  f'{time_throughput(model.predict, X_test):,.0f} rows/sec')
@@ -0,0 +1,74 @@
+import glob
+import gzip
+import io
+import time
+from unittest import mock
+import pandas as pd
+import fit_columnar
+from pipeline_to_parquet import parse_fit, parse_fit_columnar
+
+def load_files(directory):
+    """[Reads and decompresses the sample fit files into memory so the
+        benchmark only times decoding]
+    Args:
+        directory ([string]): [directory containing .fit.gz files]
+    Returns:
+        [dictionary]: [keys are filenames, values are decompressed bytes]
+    """
+    files = {}
+    for filename in sorted(glob.glob(f'{directory}/*.fit.gz')):
+        with gzip.open(filename) as f:
+            files[filename] = f.read()
+    return files
+
+def time_parser(parser, files, repeats):
+    """[Times a parser over every file]
+    Args:
+        parser ([function]): [parse_fit or parse_fit_columnar]
+        files ([dictionary]): [see output of load_files]
+        repeats ([int]): [number of passes over the files]
+    Returns:
+        [tuple]: [best seconds for one pass, rows parsed in one pass]
+    """
+    best = float('inf')
+    for _ in range(repeats):
+        rows = 0
+        start = time.perf_counter()
+        for data in files.values():
+            df = parser(io.BytesIO(data))
+            rows += 0 if df is None else len(df)
+        best = min(best, time.perf_counter() - start)
+    return best, rows
+
+def check_same(files):
+    """[Checks both parsers return the same dataframe for every file]
+    Args:
+        files ([dictionary]): [see output of load_files]
+    """
+    for filename, data in files.items():
+        expected = parse_fit(io.BytesIO(data))
+        result = parse_fit_columnar(io.BytesIO(data))
+        pd.testing.assert_frame_equal(expected, result, obj=filename)
+
+def check_fallback(files):
+    """[Checks files the columnar decoder does not cover still parse, by
+        making it refuse every file so parse_fit_columnar falls back to parse_fit]
+    Args:
+        files ([dictionary]): [see output of load_files]
+    """
+    unsupported = NotImplementedError('forced fallback')
+    with mock.patch.object(fit_columnar, 'record_columns', side_effect=unsupported):
+        for filename, data in files.items():
+            expected = parse_fit(io.BytesIO(data))
+            result = parse_fit_columnar(io.BytesIO(data))
+            assert result is not None, f'{filename}: fallback returned nothing'
+            pd.testing.assert_frame_equal(expected, result, obj=filename)
+
+if __name__ == '__main__':
+    files = load_files('../data/Example_Strava/activities')
+    check_same(files)
+    check_fallback(files)
+    print(f'{len(files)} files, outputs identical, fallback to parse_fit identical')
+    for parser in [parse_fit, parse_fit_columnar]:
+        seconds, rows = time_parser(parser, files, repeats=3)
+        print(f'{parser.__name__:>20}: {seconds:.2f} s, {rows/seconds:,.0f} rows/sec')
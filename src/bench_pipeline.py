@@ -0,0 +1,205 @@
+import itertools
+import json
+import numpy as np
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import dataset
+import peak
+import simplify
+import synthetic_data
+import track_store
+from bench_forest import training_data
+from pipeline_to_parquet import parquet_activities
+from predict import evaluate_activity
+from sklearn.ensemble import RandomForestClassifier
+
+BASELINE_FILE = '../data/bench_baseline.json'
+PARTIAL_FILE = '../data/bench_partial.json'
+COLORS = ['#a6cee3', '#1f78b4', '#b2df8a', '#33a02c', '#fb9a99', '#e31a1c',
+          '#fdbf6f', '#ff7f00', '#cab2d6', '#6a3d9a', '#ffff99', '#b15928']
+
+def rss_mb():
+    """[Resident memory of this process]
+    Returns:
+        [float]: [MB, the peak so far where /proc is not available]
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1e6
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+def measure(function, *args, interval=0.01):
+    """[Runs a function while a thread samples resident memory]
+    Args:
+        function ([function]): [stage to run]
+        args: [passed to function]
+        interval (float, optional): [seconds between memory samples]. Defaults to 0.01.
+    Returns:
+        [tuple]: [result of function, wall seconds, peak RSS in MB]
+    """
+    peak_rss = [rss_mb()]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            peak_rss[0] = max(peak_rss[0], rss_mb())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        result = function(*args)
+    finally:
+        seconds = time.perf_counter() - start
+        done.set()
+        sampler.join()
+    return result, seconds, max(peak_rss[0], rss_mb())
+
+def benchmark_model(seed=0):
+    """[Fixed classifier so evaluate_mode timings are comparable between runs]
+    Args:
+        seed (int, optional): [random seed]. Defaults to 0.
+    Returns:
+        [RandomForestClassifier]: [fit classifier]
+    """
+    X, y = training_data(seed=seed)
+    return RandomForestClassifier(n_estimators=100, max_depth=15, random_state=seed, n_jobs=-1).fit(X, y)
+
+def run_stages(person, clf, epsilon=110, gain_threshold=400, n_evaluate=20):
+    """[Times each stage of the pipeline on a person's archive, cold: the
+        dataset, track store and track caches of the person are removed first.
+        If a stage fails the timings of the stages before it are written to
+        PARTIAL_FILE before the error is raised again. The map is rendered
+        without a tile layer, which is fetched by the browser and not timed.]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where the activity overview file is.]
+        clf ([model]): [fit classification model]
+        epsilon (int, optional): [see peak.peak_clustering]. Defaults to 110.
+        gain_threshold (int, optional): [see peak.peak_detector]. Defaults to 400.
+        n_evaluate (int, optional): [activities evaluate_mode is timed on]. Defaults to 20.
+    Returns:
+        [dictionary]: [stage to seconds, peak_rss_mb, rows and rows_per_sec]
+    """
+    shutil.rmtree(os.path.join(dataset.DATASET_DIR, f'person={person}'), ignore_errors=True)
+    shutil.rmtree(f'../data/{person}/track_cache', ignore_errors=True)
+    shutil.rmtree(track_store.store_dir(person), ignore_errors=True)
+    results = {}
+
+    def record(stage, rows, seconds, peak_rss):
+        results[stage] = {'seconds': seconds, 'peak_rss_mb': peak_rss, 'rows': int(rows),
+                          'rows_per_sec': rows / seconds if seconds else None}
+        print(f'{stage:>18}: {seconds:8.2f} s, {peak_rss:8.0f} MB peak RSS, {rows:>11,} rows, '
+              f'{rows / seconds if seconds else 0:>12,.0f} rows/sec')
+
+    try:
+        _, seconds, peak_rss = measure(parquet_activities, person)
+        record_ids = dataset.read_records(person, columns=['activity_id'])['activity_id'].values
+        record('parquet_activities', len(record_ids), seconds, peak_rss)
+
+        store, seconds, peak_rss = measure(track_store.update_track_store, person)
+        record('track_store', len(record_ids), seconds, peak_rss)
+
+        peaks, seconds, peak_rss = measure(peak.detect_peaks, store, gain_threshold)
+        record('peak_detector', len(record_ids), seconds, peak_rss)
+
+        peaks = peaks.dropna(subset=['position_lat', 'position_long'])
+        cluster_series, seconds, peak_rss = measure(peak.peak_clustering, peaks, epsilon)
+        record('peak_clustering', len(peaks), seconds, peak_rss)
+
+        ids, counts = np.unique(record_ids, return_counts=True)
+        sample = ids[:n_evaluate]
+        _, seconds, peak_rss = measure(lambda: [evaluate_activity(person, i, clf) for i in sample])
+        record('evaluate_mode', counts[:n_evaluate].sum(), seconds, peak_rss)
+
+        def render():
+            clustered = peaks.index[peaks['cluster'] != -1]
+            tracks = simplify.simplified_tracks(person, clustered, zoom=14)
+            m = peak.plot_multiple_clusters(tracks, peaks, itertools.cycle(COLORS), cluster_series,
+                                            tiles=None)
+            with tempfile.TemporaryDirectory() as directory:
+                m.save(os.path.join(directory, 'map.html'))
+            return sum(len(track) for track in tracks.values())
+
+        points, seconds, peak_rss = measure(render)
+        record('map_rendering', points, seconds, peak_rss)
+    except Exception as error:
+        # keep the timings of the stages that finished, to see how far it got
+        os.makedirs(os.path.dirname(PARTIAL_FILE) or '.', exist_ok=True)
+        with open(PARTIAL_FILE, 'w') as f:
+            json.dump({'person': person, 'error': repr(error), 'results': results}, f, indent=2)
+        print(f'Failed after {len(results)} stages, timings so far written to {PARTIAL_FILE}')
+        raise
+    return results
+
+def load_baseline(filename=BASELINE_FILE):
+    """[Reads the stored baseline results]
+    Args:
+        filename (str, optional): [baseline file]. Defaults to BASELINE_FILE.
+    Returns:
+        [dictionary]: [number of activities to stage results, empty if there is none]
+    """
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
+
+def save_baseline(baseline, filename=BASELINE_FILE):
+    """[Writes the baseline results]
+    Args:
+        baseline ([dictionary]): [see load_baseline]
+        filename (str, optional): [baseline file]. Defaults to BASELINE_FILE.
+    """
+    with open(f'{filename}.tmp', 'w') as f:
+        json.dump(baseline, f, indent=1)
+    os.replace(f'{filename}.tmp', filename)
+
+def find_regressions(results, baseline, tolerance=0.25, min_change={'seconds': 0.1, 'peak_rss_mb': 20}):
+    """[Stages that got slower or use more memory than the baseline]
+    Args:
+        results ([dictionary]): [see output of run_stages]
+        baseline ([dictionary]): [stage results of the same archive size]
+        tolerance (float, optional): [allowed relative increase]. Defaults to 0.25.
+        min_change (dict, optional): [smallest increase of each metric that
+                                      counts, so timer noise in short stages
+                                      is not flagged]. Defaults to 0.1 s and 20 MB.
+    Returns:
+        [list]: [description of each regression]
+    """
+    regressions = []
+    for stage, result in results.items():
+        if stage not in baseline:
+            continue
+        for metric in ['seconds', 'peak_rss_mb']:
+            before, after = baseline[stage][metric], result[metric]
+            if after > before * (1 + tolerance) and after - before > min_change[metric]:
+                regressions.append(f'{stage} {metric}: {before:.2f} -> {after:.2f} (+{after / before - 1:.0%})')
+    return regressions
+
+if __name__ == '__main__':
+    sizes = [int(n) for n in sys.argv[1:]] or [100, 5000, 50000]
+    clf = benchmark_model()
+    baseline = load_baseline()
+    for n in sizes:
+        person = f'Synthetic_{n}'
+        if not os.path.exists(f'../data/{person}/activities.csv'):
+            print(f'Generating {n} synthetic activities')
+            synthetic_data.generate_archive(person, n)
+        print(f'{person}:')
+        results = run_stages(person, clf)
+        if str(n) in baseline:
+            regressions = find_regressions(results, baseline[str(n)])
+            for regression in regressions:
+                print(f'REGRESSION {person} {regression}')
+            if not regressions:
+                print(f'No regressions against the baseline for {person}')
+        else:
+            baseline[str(n)] = results
+            save_baseline(baseline)
+            print(f'Stored baseline for {person}')
@@ -0,0 +1,72 @@
+import time
+from geopy import distance
+import numpy as np
+import pandas as pd
+import dataset
+from predict import compute_speed_distance
+
+def compute_speed_distance_apply(df):
+    """[Row-wise compute_speed_distance as it was before the vectorized kernel,
+        kept as the reference for the benchmark]
+    Args:
+        df ([pandas dataframe]): [df with position_lat, position_long, altitude, and time]
+    Returns:
+        [pandas dataframe]: [df with distance, change in time, change in altitude, speed]
+    """
+    df = df.reset_index()
+    df['lon_previous'] = df['position_long'].shift(1)
+    df['lat_previous'] = df['position_lat'].shift(1)
+    df['alt_previous'] = df['altitude'].shift(1)
+    df['time_previous'] = df['time'].shift(1)
+    df = df.fillna(method='bfill')
+    df['distance_dis_2d'] = df.apply(lambda x: distance.distance((x['lat_previous'], x['lon_previous']), (x['position_lat'], x['position_long'])).m, axis = 1)
+    df['delta_alt'] = df.apply(lambda x: x['altitude']- x['alt_previous'], axis=1)
+    df['distance'] = df.apply(lambda x: np.sqrt(x['distance_dis_2d']**2 + (x['delta_alt'])**2), axis=1)
+    df['time_delta'] = df.apply(lambda x: (x['time'] - x['time_previous']).total_seconds(), axis=1)
+    df['speed'] = df['distance'].divide(df['time_delta'])
+    return df
+
+def load_records(person):
+    """[Reads the records of a person in the shape compute_speed_distance expects]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where activity files are.]
+    Returns:
+        [pandas dataframe]: [records indexed by time with no missing positions]
+    """
+    df = dataset.read_records(person, columns=['timestamp', 'position_lat', 'position_long', 'altitude'])
+    df = df.rename(columns={'timestamp': 'time'}).astype({'position_lat': float, 'position_long': float,
+                                                          'altitude': float})
+    return df.dropna().set_index('time')
+
+def time_function(function, df, repeats=3):
+    """[Times a function over a dataframe]
+    Args:
+        function ([function]): [function taking the dataframe]
+        df ([pandas dataframe]): [input]
+        repeats (int, optional): [number of runs]. Defaults to 3.
+    Returns:
+        [tuple]: [best rows/sec and the output of the last run]
+    """
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        out = function(df)
+        best = min(best, time.perf_counter() - start)
+    return len(df) / best, out
+
+if __name__ == '__main__':
+    df = load_records('Example_Strava')
+    before, expected = time_function(compute_speed_distance_apply, df, repeats=1)
+    print(f'{len(df)} rows')
+    print(f'{"row-wise geopy":>20}: {before:,.0f} rows/sec')
+    for method in ['haversine', 'ellipsoid']:
+        after, out = time_function(lambda d: compute_speed_distance(d, method), df)
+        error = np.abs(out['distance_dis_2d'] - expected['distance_dis_2d'])
+        relative = (error / expected['distance_dis_2d'])[expected['distance_dis_2d'] > 1]
+        print(f'{method:>20}: {after:,.0f} rows/sec ({after/before:,.0f}x), difference from geopy '
+              f'max {error.max():.2e} m, max relative {relative.max():.2e}')
+    out = compute_speed_distance(df)
+    np.testing.assert_allclose(out['distance_dis_2d'], expected['distance_dis_2d'], rtol=0, atol=1e-3)
+    for column in ['delta_alt', 'time_delta']:
+        pd.testing.assert_series_equal(out[column], expected[column])
@@ -0,0 +1,192 @@
+import numpy as np
+import pandas as pd
+import geo
+import instrument
+
+POSITION_FILLED = 1
+ALTITUDE_FILLED = 2
+POSITION_OUTLIER = 4
+ALTITUDE_OUTLIER = 8
+GAP = 16
+SEGMENT_START = 32
+
+def to_seconds(times):
+    """[Timestamps as float seconds, NaN where missing]
+    Args:
+        times ([numpy array]): [datetime64 timestamps]
+    Returns:
+        [numpy array]: [seconds since the epoch]
+    """
+    times = np.asarray(times, dtype='datetime64[ns]')
+    return np.where(np.isnat(times), np.nan, times.astype(np.int64) / 1e9)
+
+def fill_short_gaps(seconds, values, segment, short_gap):
+    """[Interpolates runs of missing values linearly in time, where the values
+        either side are in the same segment and at most short_gap apart]
+    Args:
+        seconds ([numpy array]): [time of each record, see to_seconds]
+        values ([numpy array]): [float values with NaN where missing, filled in place]
+        segment ([numpy array]): [segment of each record]
+        short_gap ([float]): [longest gap filled, in seconds]
+    Returns:
+        [numpy array]: [True for the values that were filled]
+    """
+    n = len(values)
+    valid = ~np.isnan(values)
+    index = np.arange(n)
+    before = np.maximum.accumulate(np.where(valid, index, -1)) if n else index
+    after = np.minimum.accumulate(np.where(valid, index, n)[::-1])[::-1] if n else index
+    rows = np.flatnonzero(~valid & (before >= 0) & (after < n))
+    p, q = before[rows], after[rows]
+    span = seconds[q] - seconds[p]
+    ok = (segment[p] == segment[q]) & (span <= short_gap)
+    rows, p, q, span = rows[ok], p[ok], q[ok], span[ok]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weight = np.where(span > 0, (seconds[rows] - seconds[p]) / span, 0.5)
+    values[rows] = values[p] + weight * (values[q] - values[p])
+    filled = np.zeros(n, dtype=bool)
+    filled[rows] = True
+    return filled
+
+def position_spikes(seconds, lat, lon, segment, max_speed):
+    """[Fixes that jump away from and back to the track: reaching the fix
+        and leaving it both need more than max_speed, while going straight
+        from the fix before to the fix after does not]
+    Args:
+        seconds ([numpy array]): [time of each record, see to_seconds]
+        lat ([numpy array]): [latitudes in degrees, NaN where there is no fix]
+        lon ([numpy array]): [longitudes in degrees]
+        segment ([numpy array]): [segment of each record]
+        max_speed ([float]): [fastest believable speed in m/s]
+    Returns:
+        [numpy array]: [True for the spikes]
+    """
+    spikes = np.zeros(len(lat), dtype=bool)
+    rows = np.flatnonzero(~(np.isnan(lat) | np.isnan(lon)))
+    if len(rows) < 3:
+        return spikes
+    t, la, lo, sg = seconds[rows], lat[rows], lon[rows], segment[rows]
+    speed = geo.distance(la[:-1], lo[:-1], la[1:], lo[1:]) / np.maximum(np.diff(t), 1)
+    fast = (speed > max_speed) & (sg[1:] == sg[:-1])
+    bridge = geo.distance(la[:-2], lo[:-2], la[2:], lo[2:]) / np.maximum(t[2:] - t[:-2], 1)
+    spikes[rows[1:-1][fast[:-1] & fast[1:] & (bridge <= max_speed)]] = True
+    return spikes
+
+def altitude_spikes(altitude, window, max_deviation):
+    """[Altitudes further than max_deviation from the rolling median of the
+        window records around them. A steady climb or descent is its own
+        median, so only spikes, e.g. from a barometer, are caught. A sharp
+        summit or dip is also far from the median, but unlike a spike it is
+        reached from and left to neighbours within max_deviation of it that
+        are not spikes themselves, so such local extremes are kept.]
+    Args:
+        altitude ([numpy array]): [altitudes in metres, NaN where missing]
+        window ([int]): [records in the centred rolling median]
+        max_deviation ([float]): [largest believable distance from the median in metres]
+    Returns:
+        [numpy array]: [True for the spikes]
+    """
+    median = pd.Series(altitude).rolling(window, center=True, min_periods=1).median().values
+    with np.errstate(invalid='ignore'):
+        spikes = np.abs(altitude - median) > max_deviation
+        before, after = np.r_[np.nan, altitude[:-1]], np.r_[altitude[1:], np.nan]
+        supported = (np.r_[False, ~spikes[:-1]] & np.r_[~spikes[1:], False] &
+                     (np.abs(altitude - before) <= max_deviation) & (np.abs(altitude - after) <= max_deviation))
+        extreme = ((altitude >= before) & (altitude >= after)) | ((altitude <= before) & (altitude <= after))
+    return spikes & ~(supported & extreme)
+
+def clean_activity(times, lat, lon, altitude, short_gap=30, long_gap=300, max_speed=50,
+                   max_altitude_deviation=50, window=9, passes=2):
+    """[Cleans the records of one activity, in time order. The track is split
+        into segments at gaps longer than long_gap, position and altitude
+        spikes are rejected and then missing values spanning at most
+        short_gap are interpolated. Longer dropouts are left missing.]
+    Args:
+        times ([numpy array]): [datetime64 timestamps, sorted]
+        lat ([numpy array]): [latitudes in degrees, None if the activity has none]
+        lon ([numpy array]): [longitudes in degrees, None if the activity has none]
+        altitude ([numpy array]): [altitudes in metres, None if the activity has none]
+        short_gap (int, optional): [longest dropout interpolated, in seconds,
+                                    above the 99th percentile of the time
+                                    between records of smart recording]. Defaults to 30.
+        long_gap (int, optional): [time without records that starts a new
+                                   segment, in seconds]. Defaults to 300.
+        max_speed (int, optional): [see position_spikes, in m/s]. Defaults to 50.
+        max_altitude_deviation (int, optional): [see altitude_spikes, in metres]. Defaults to 50.
+        window (int, optional): [see altitude_spikes]. Defaults to 9.
+        passes (int, optional): [times spikes are looked for, as removing one
+                                 can reveal the next]. Defaults to 2.
+    Returns:
+        [dictionary]: [cleaned position_lat, position_long and altitude as
+                       float64 (None where not given), quality, a uint8 of
+                       the flags set on each record, and segment, int16]
+    """
+    seconds = to_seconds(times)
+    quality = np.zeros(len(seconds), dtype=np.uint8)
+    with np.errstate(invalid='ignore'):
+        step = np.r_[0, np.diff(seconds)]
+    quality[step > short_gap] |= GAP
+    quality[step > long_gap] |= SEGMENT_START
+    segment = np.cumsum(step > long_gap).astype(np.int16)
+    cleaned = {'position_lat': None, 'position_long': None, 'altitude': None}
+    if lat is not None and lon is not None:
+        lat, lon = np.array(lat, dtype=np.float64), np.array(lon, dtype=np.float64)
+        for _ in range(passes):
+            spikes = position_spikes(seconds, lat, lon, segment, max_speed)
+            if not spikes.any():
+                break
+            lat[spikes], lon[spikes] = np.nan, np.nan
+            quality[spikes] |= POSITION_OUTLIER
+        filled = fill_short_gaps(seconds, lat, segment, short_gap)
+        fill_short_gaps(seconds, lon, segment, short_gap)
+        quality[filled] |= POSITION_FILLED
+        cleaned['position_lat'], cleaned['position_long'] = lat, lon
+    if altitude is not None:
+        altitude = np.array(altitude, dtype=np.float64)
+        for _ in range(passes):
+            spikes = altitude_spikes(altitude, window, max_altitude_deviation)
+            if not spikes.any():
+                break
+            altitude[spikes] = np.nan
+            quality[spikes] |= ALTITUDE_OUTLIER
+        quality[fill_short_gaps(seconds, altitude, segment, short_gap)] |= ALTITUDE_FILLED
+        cleaned['altitude'] = altitude
+    cleaned['quality'], cleaned['segment'] = quality, segment
+    return cleaned
+
+def clean_records(df, **params):
+    """[Runs clean_activity over each activity of parsed records, as a
+        clean stage, see instrument.stage]
+    Args:
+        df ([pandas dataframe]): [records with timestamp and any of
+                                  position_lat, position_long and altitude,
+                                  and activity_id if there is more than one activity]
+        params: [see clean_activity]
+    Returns:
+        [pandas dataframe]: [records sorted by activity_id and timestamp with
+                             the cleaned values and quality and segment columns]
+    """
+    with instrument.stage('clean') as info:
+        info['rows'] = len(df)
+        keys = ['activity_id', 'timestamp'] if 'activity_id' in df.columns else ['timestamp']
+        df = df.sort_values(keys, kind='stable').reset_index(drop=True)
+        ids = df['activity_id'].values if 'activity_id' in df.columns else np.zeros(len(df), dtype=np.int64)
+        starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]]) if len(ids) else np.empty(0, dtype=np.int64)
+        stops = np.r_[starts[1:], len(ids)]
+        columns = {column: df[column].values if column in df.columns else None
+                   for column in ['timestamp', 'position_lat', 'position_long', 'altitude']}
+        if columns['position_lat'] is None or columns['position_long'] is None:
+            columns['position_lat'] = columns['position_long'] = None
+        out = {column: np.full(len(df), np.nan) for column in ['position_lat', 'position_long', 'altitude']
+               if columns[column] is not None}
+        out['quality'] = np.zeros(len(df), dtype=np.uint8)
+        out['segment'] = np.zeros(len(df), dtype=np.int16)
+        for start, stop in zip(starts, stops):
+            cleaned = clean_activity(*[None if columns[c] is None else columns[c][start:stop]
+                                       for c in ['timestamp', 'position_lat', 'position_long', 'altitude']],
+                                     **params)
+            for column in out:
+                out[column][start:stop] = cleaned[column]
+        for column, values in out.items():
+            df[column] = values
+        return df
@@ -0,0 +1,437 @@
+import numpy as np
+import pandas as pd
+import pickle
+import os
+from sklearn.cluster import DBSCAN
+from sklearn.neighbors import BallTree
+import geo
+
+def to_radians(lat, lon):
+    """[Coordinates in radians, the layout BallTree's haversine metric expects]
+    Args:
+        lat ([numpy array]): [latitudes in degrees]
+        lon ([numpy array]): [longitudes in degrees]
+    Returns:
+        [numpy array]: [n x 2 array of latitude, longitude in radians]
+    """
+    return np.radians(np.column_stack([lat, lon]).astype(np.float64)).reshape(-1, 2)
+
+def fit_cluster_model(peaks, epsilon, min_samples=2, rebuild_every=1000):
+    """[Clusters peaks with DBSCAN and keeps what is needed to assign new
+        peaks later without refitting: the core peaks and their cluster, a
+        tree over every peak and the centroid of each cluster]
+    Args:
+        peaks ([pandas dataframe]): [df with peaks lat/long, indexed by activity_id]
+        epsilon ([float]): [DBSCAN local radius for expanding clusters, in metres]
+        min_samples (int, optional): [minimun number of samples for cluster]. Defaults to 2.
+        rebuild_every (int, optional): [number of peaks added, removed or
+                                        turned core after which the trees
+                                        are rebuilt]. Defaults to 1000.
+    Returns:
+        [dictionary]: [cluster model]
+    """
+    peaks = peaks.drop(columns=['cluster', 'core'], errors='ignore')
+    lat = peaks['position_lat'].values.astype(np.float64)
+    lon = peaks['position_long'].values.astype(np.float64)
+    labels = np.empty(0, dtype=np.int64)
+    core = np.zeros(len(peaks), dtype=bool)
+    if len(peaks):
+        clustering = DBSCAN(eps=epsilon / geo.EARTH_RADIUS, min_samples=min_samples,
+                            metric='haversine', algorithm='ball_tree').fit(to_radians(lat, lon))
+        labels = clustering.labels_.astype(np.int64)
+        core[clustering.core_sample_indices_] = True
+    clustered = labels != -1
+    centroids = pd.DataFrame({'position_lat': lat[clustered], 'position_long': lon[clustered],
+                              'cluster': labels[clustered]}).groupby('cluster').agg(
+        position_lat=('position_lat', 'mean'), position_long=('position_long', 'mean'),
+        count=('position_lat', 'size'))
+    centroids = {int(c): list(row) for c, row in zip(centroids.index, centroids.values.tolist())}
+    model = {'epsilon': epsilon, 'min_samples': min_samples, 'rebuild_every': rebuild_every,
+             'peaks': peaks, 'lat': lat, 'lon': lon, 'cluster': labels, 'core': core,
+             'pending': [], 'aliases': {}, 'centroids': centroids, 'dirty': False,
+             'next_cluster': int(labels.max()) + 1 if len(labels) else 0}
+    build_trees(model)
+    return model
+
+def refit_cluster_model(model):
+    """[Reclusters every peak of a model from scratch]
+    Args:
+        model ([dictionary]): [see output of fit_cluster_model]
+    Returns:
+        [dictionary]: [new cluster model with the same parameters]
+    """
+    refit = fit_cluster_model(cluster_peaks(model), model['epsilon'], model['min_samples'], model['rebuild_every'])
+    for key in model:
+        if key not in refit:
+            refit[key] = model[key]
+    return refit
+
+def build_trees(model):
+    """[Builds the trees over the indexed peaks and over the indexed core
+        peaks, None when there are none, and empties the buffers of changes
+        since the last rebuild: pending peaks, deleted rows and rows promoted
+        to core]
+    Args:
+        model ([dictionary]): [see output of fit_cluster_model]
+    """
+    coords = to_radians(model['lat'], model['lon'])
+    model['tree'] = BallTree(coords, metric='haversine') if len(coords) else None
+    model['core_rows'] = np.flatnonzero(model['core'])
+    model['core_tree'] = BallTree(coords[model['core_rows']], metric='haversine') if len(model['core_rows']) else None
+    model['deleted'] = np.zeros(len(coords), dtype=bool)
+    model['n_deleted'] = 0
+    model['promoted'] = []
+    model['pending_lat'] = np.empty(model['rebuild_every'])
+    model['pending_lon'] = np.empty(model['rebuild_every'])
+    model['pending_core'] = np.zeros(model['rebuild_every'], dtype=bool)
+
+def rebuild_due(model):
+    """[Whether enough has changed since the last rebuild that the trees
+        should be rebuilt rather than the buffers scanned]
+    Args:
+        model ([dictionary]): [see output of fit_cluster_model]
+    Returns:
+        [bool]: [True once the pending peaks, deleted rows and promoted rows
+                 reach rebuild_every]
+    """
+    return len(model['pending']) + model['n_deleted'] + len(model['promoted']) >= model['rebuild_every']
+
+def resolve(model, cluster):
+    """[Follows the merges a cluster number went through]
+    Args:
+        model ([dictionary]): [see output of fit_cluster_model]
+        cluster ([int]): [cluster number as stored]
+    Returns:
+        [int]: [current cluster number]
+    """
+    while cluster in model['aliases']:
+        cluster = model['aliases'][cluster]
+    return cluster
+
+def rebuild_trees(model):
+    """[Drops deleted peaks from the indexed arrays, moves the peaks assigned
+        since the last rebuild into them, applies cluster merges and
+        rebuilds the trees]
+    Args:
+        model ([dictionary]): [see output of fit_cluster_model]
+    """
+    keep = ~model['deleted']
+    model['peaks'] = model['peaks'][keep]
+    for key in ['lat', 'lon', 'cluster', 'core']:
+        model[key] = model[key][keep]
+    pending = model['pending']
+    if pending:
+        new_peaks = pd.DataFrame([p['peak'] for p in pending], index=[p['activity_id'] for p in pending])
+        new_peaks.index.name = model['peaks'].index.name
+        model['peaks'] = pd.concat([model['peaks'], new_peaks])
+        model['lat'] = np.r_[model['lat'], [p['lat'] for p in pending]]
+        model['lon'] = np.r_[model['lon'], [p['lon'] for p in pending]]
+        model['cluster'] = np.r_[model['cluster'], np.array([p['cluster'] for p in pending], dtype=np.int64)]
+        model['core'] = np.r_[model['core'], np.array([p['core'] for p in pending], dtype=bool)]
+    if model['aliases']:
+        clusters, inverse = np.unique(model['cluster'], return_inverse=True)
+        model['cluster'] = np.array([resolve(model, c) for c in clusters], dtype=np.int64)[inverse]
+    model['pending'] = []
+    model['aliases'] = {}
+    build_trees(model)
+
+def neighbours(model, lat, lon, core_only=False):
+    """[Finds the peaks of a model within epsilon of a point: a tree query
+        over the indexed peaks, skipping deleted ones, plus a scan of the
+        buffers of peaks assigned and rows promoted to core since the last
+        rebuild]
+    Args:
+        model ([dictionary]): [see output of fit_cluster_model]
+        lat ([float]): [latitude in degrees]
+        lon ([float]): [longitude in degrees]
+        core_only (bool, optional): [only return core peaks]. Defaults to False.
+    Returns:
+        [tuple of numpy arrays]: [peak numbers, below len(model['lat']) for
+                                  indexed peaks and above for pending ones, and
+                                  their distance in metres]
+    """
+    tree = model['core_tree'] if core_only else model['tree']
+    rows, distances = np.empty(0, dtype=np.int64), np.empty(0)
+    if tree is not None:
+        rows, distances = tree.query_radius(to_radians([lat], [lon]), r=model['epsilon'] / geo.EARTH_RADIUS,
+                                            return_distance=True)
+        rows, distances = rows[0], distances[0] * geo.EARTH_RADIUS
+        if core_only:
+            rows = model['core_rows'][rows]
+    if core_only and model['promoted']:
+        promoted = np.array(model['promoted'], dtype=np.int64)
+        promoted_distances = geo.haversine(lat, lon, model['lat'][promoted], model['lon'][promoted])
+        close = promoted_distances <= model['epsilon']
+        rows = np.r_[rows, promoted[close]]
+        distances = np.r_[distances, promoted_distances[close]]
+    live = ~model['deleted'][rows]
+    rows, distances = rows[live], distances[live]
+    n_pending = len(model['pending'])
+    if n_pending:
+        pending_distances = geo.haversine(lat, lon, model['pending_lat'][:n_pending], model['pending_lon'][:n_pending])
+        close = pending_distances <= model['epsilon']
+        if core_only:
+            close &= model['pending_core'][:n_pending]
+        rows = np.r_[rows, len(model['lat']) + np.flatnonzero(close)]
+        distances = np.r_[distances, pending_distances[close]]
+    return rows, distances
+
+def get_peak(model, row, key):
+    """[Reads the position, cluster or core flag of an indexed or pending peak]
+    Args:
+        model ([dictionary]): [see output of fit_cluster_model]
+        row ([int]): [peak number, see neighbours]
+        key ([string]): [lat, lon, cluster or core]
+    Returns:
+        [float, int or bool]: [value, clusters resolved through merges]
+    """
+    n = len(model['lat'])
+    value = model[key][row] if row < n else model['pending'][row - n][key]
+    return resolve(model, int(value)) if key == 'cluster' else value
+
+def set_peak(model, row, key, value):
+    """[Sets the cluster or core flag of an indexed or pending peak]
+    Args:
+        model ([dictionary]): [see output of fit_cluster_model]
+        row ([int]): [peak number, see neighbours]
+        key ([string]): [cluster or core]
+        value ([int or bool]): [new value]
+    """
+    n = len(model['lat'])
+    if row < n:
+        model[key][row] = value
+    else:
+        model['pending'][row - n][key] = value
+        if key == 'core':
+            model['pending_core'][row - n] = value
+
+def move_centroid(model, cluster, lat, lon, count=1):
+    """[Adds peaks to (or with a negative count removes them from) the running
+        mean position of a cluster]
+    Args:
+        model ([dictionary]): [see output of fit_cluster_model]
+        cluster ([int]): [cluster number]
+        lat ([float]): [mean latitude of the peaks]
+        lon ([float]): [mean longitude of the peaks]
+        count (int, optional): [number of peaks]. Defaults to 1.
+    """
+    centroids = model['centroids']
+    if cluster not in centroids:
+        centroids[cluster] = [lat, lon, count]
+        return
+    old_lat, old_lon, old = centroids[cluster]
+    total = old + count
+    if total <= 0:
+        del centroids[cluster]
+        return
+    centroids[cluster] = [(old_lat * old + lat * count) / total, (old_lon * old + lon * count) / total, total]
+
+def merge_clusters(model, clusters):
+    """[Merges clusters joined by a new core peak into the lowest numbered
+        one. Only the centroids are combined now, peaks are relabelled
+        through model['aliases'] at the next rebuild.]
+    Args:
+        model ([dictionary]): [see output of fit_cluster_model]
+        clusters ([list]): [current cluster numbers to merge]
+    Returns:
+        [int]: [cluster number of the merged cluster]
+    """
+    target = min(clusters)
+    for cluster in clusters:
+        if cluster == target:
+            continue
+        move_centroid(model, target, *model['centroids'].pop(cluster))
+        model['aliases'][cluster] = target
+    return target
+
+def new_cluster(model):
+    """[Takes the next unused cluster number]
+    Args:
+        model ([dictionary]): [see output of fit_cluster_model]
+    Returns:
+        [int]: [cluster number]
+    """
+    cluster = model['next_cluster']
+    model['next_cluster'] += 1
+    return cluster
+
+def assign_peak(model, activity_id, peak):
+    """[Assigns one new peak the way DBSCAN would have had it been in the
+        fit. With enough neighbours to be core it joins the clusters of the
+        core peaks within epsilon, merging them, or starts a new one;
+        otherwise it joins the nearest core peak's cluster as a border peak.
+        Noise neighbours within reach then join its cluster, as core peaks
+        if the new peak gives them enough neighbours. Noise is not expanded
+        any further, which is exact for min_samples=2 and otherwise is
+        corrected by a refit.]
+    Args:
+        model ([dictionary]): [see output of fit_cluster_model]
+        activity_id ([int]): [activity the peak belongs to]
+        peak ([dictionary]): [peak with position_lat and position_long]
+    Returns:
+        [int]: [cluster number, -1 for noise]
+    """
+    lat, lon = float(peak['position_lat']), float(peak['position_long'])
+    rows, _ = neighbours(model, lat, lon)
+    is_core = len(rows) + 1 >= model['min_samples']
+    core_rows, core_distances = neighbours(model, lat, lon, core_only=True)
+    core_clusters = sorted({get_peak(model, r, 'cluster') for r in core_rows})
+    if is_core and core_clusters:
+        cluster = merge_clusters(model, core_clusters)
+    elif is_core:
+        cluster = new_cluster(model)
+    elif len(core_rows):
+        cluster = get_peak(model, core_rows[np.argmin(core_distances)], 'cluster')
+    else:
+        cluster = -1
+    for r in rows:
+        if get_peak(model, r, 'cluster') != -1:
+            continue
+        noise_lat, noise_lon = get_peak(model, r, 'lat'), get_peak(model, r, 'lon')
+        noise_core = len(neighbours(model, noise_lat, noise_lon)[0]) + 1 >= model['min_samples']
+        if not (is_core or noise_core):
+            continue
+        if cluster == -1:
+            cluster = new_cluster(model)
+        set_peak(model, r, 'cluster', cluster)
+        move_centroid(model, cluster, noise_lat, noise_lon)
+        if noise_core:
+            set_peak(model, r, 'core', True)
+            if r < len(model['lat']):
+                model['promoted'].append(int(r))
+    n_pending = len(model['pending'])
+    model['pending_lat'][n_pending], model['pending_lon'][n_pending] = lat, lon
+    model['pending_core'][n_pending] = is_core
+    model['pending'].append({'activity_id': activity_id, 'peak': peak,
+                             'lat': lat, 'lon': lon, 'cluster': cluster, 'core': is_core})
+    if cluster != -1:
+        move_centroid(model, cluster, lat, lon)
+    return cluster
+
+def assign_peaks(model, peaks):
+    """[Assigns new peaks to the clusters of a model, each with a couple of
+        tree queries and a scan of the buffers, rebuilding the trees only
+        once rebuild_every changes have built up, see rebuild_due. Peaks of
+        activities the model already holds replace the old ones.]
+    Args:
+        model ([dictionary]): [see output of fit_cluster_model]
+        peaks ([pandas dataframe]): [df with peaks lat/long, indexed by activity_id]
+    Returns:
+        [pandas series]: [cluster of each new peak, indexed by activity_id]
+    """
+    if len(peaks):
+        remove_peaks(model, peaks.index)
+    clusters = {}
+    records = peaks.drop(columns=['cluster', 'core'], errors='ignore').to_dict(orient='index')
+    for activity_id, peak in records.items():
+        clusters[activity_id] = assign_peak(model, activity_id, peak)
+        if rebuild_due(model):
+            rebuild_trees(model)
+    return pd.Series([resolve(model, c) for c in clusters.values()], index=list(clusters.keys()),
+                     name='cluster', dtype=np.int64)
+
+def remove_peaks(model, activity_ids):
+    """[Removes the peaks of deleted or changed activities from their
+        clusters. Pending peaks are dropped from the buffer and indexed ones
+        only marked deleted, so the trees are not rebuilt until rebuild_due.
+        Clusters a removed core peak held together are not split here, so
+        removing one marks the model dirty for a refit, see
+        peak.update_cluster_model.]
+    Args:
+        model ([dictionary]): [see output of fit_cluster_model]
+        activity_ids ([list]): [activities to remove]
+    """
+    activity_ids = set(activity_ids)
+    kept = [p for p in model['pending'] if p['activity_id'] not in activity_ids]
+    if len(kept) < len(model['pending']):
+        for p in model['pending']:
+            if p['activity_id'] not in activity_ids:
+                continue
+            if resolve(model, p['cluster']) != -1:
+                move_centroid(model, resolve(model, p['cluster']), p['lat'], p['lon'], -1)
+            model['dirty'] = model.get('dirty', False) or bool(p['core'])
+        model['pending'] = kept
+        model['pending_lat'][:len(kept)] = [p['lat'] for p in kept]
+        model['pending_lon'][:len(kept)] = [p['lon'] for p in kept]
+        model['pending_core'][:len(kept)] = [p['core'] for p in kept]
+    removed = model['peaks'].index.isin(list(activity_ids)) & ~model['deleted']
+    if removed.any():
+        for lat, lon, cluster in zip(model['lat'][removed], model['lon'][removed], model['cluster'][removed]):
+            if resolve(model, int(cluster)) != -1:
+                move_centroid(model, resolve(model, int(cluster)), lat, lon, -1)
+        model['deleted'] |= removed
+        model['n_deleted'] += int(removed.sum())
+        model['dirty'] = model.get('dirty', False) or bool(model['core'][removed].any())
+    if rebuild_due(model):
+        rebuild_trees(model)
+
+def cluster_peaks(model):
+    """[Every peak of a model with its current cluster]
+    Args:
+        model ([dictionary]): [see output of fit_cluster_model]
+    Returns:
+        [pandas dataframe]: [peaks indexed by activity_id with cluster and core columns]
+    """
+    live = ~model['deleted']
+    peaks = model['peaks'][live].copy()
+    peaks['cluster'] = [resolve(model, int(c)) for c in model['cluster'][live]]
+    peaks['core'] = model['core'][live]
+    if model['pending']:
+        new_peaks = pd.DataFrame([p['peak'] for p in model['pending']],
+                                 index=[p['activity_id'] for p in model['pending']])
+        new_peaks['cluster'] = [resolve(model, p['cluster']) for p in model['pending']]
+        new_peaks['core'] = [p['core'] for p in model['pending']]
+        peaks = pd.concat([peaks, new_peaks])
+    return peaks
+
+def cluster_counts(model):
+    """[Number of peaks in each cluster of a model, read from the centroids]
+    Args:
+        model ([dictionary]): [see output of fit_cluster_model]
+    Returns:
+        [pandas series]: [index is cluster number, values are number of
+                          activities belonging to that cluster]
+    """
+    counts = cluster_centroids(model)['count']
+    return counts.sort_values(ascending=False, kind='stable')
+
+def cluster_centroids(model):
+    """[Mean position and number of peaks of each cluster of a model]
+    Args:
+        model ([dictionary]): [see output of fit_cluster_model]
+    Returns:
+        [pandas dataframe]: [position_lat, position_long and count, indexed by cluster]
+    """
+    centroids = pd.DataFrame.from_dict(model['centroids'], orient='index',
+                                       columns=['position_lat', 'position_long', 'count'])
+    centroids['count'] = centroids['count'].astype(np.int64)
+    centroids.index.name = 'cluster'
+    return centroids
+
+def save_cluster_model(model, filename):
+    """[Saves a cluster model, atomically replacing the previous one]
+    Args:
+        model ([dictionary]): [see output of fit_cluster_model]
+        filename ([string]): [output file]
+    """
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    with open(f'{filename}.tmp', 'wb') as f:
+        pickle.dump(model, f)
+    os.replace(f'{filename}.tmp', filename)
+
+def load_cluster_model(filename):
+    """[Loads a saved cluster model, rebuilding the trees of models saved
+        before they kept buffers of deleted and promoted peaks]
+    Args:
+        filename ([string]): [file written by save_cluster_model]
+    Returns:
+        [dictionary]: [see output of fit_cluster_model, None if there is no file]
+    """
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'rb') as f:
+        model = pickle.load(f)
+    if 'deleted' not in model:
+        model.pop('stale', None)
+        rebuild_trees(model)
+    return model
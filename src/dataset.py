@@ -0,0 +1,188 @@
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+DATASET_DIR = '../data/dataset'
+COMPACT_TYPES = {'position_lat': np.float32, 'position_long': np.float32,
+                 'altitude': np.float32, 'activity_id': np.int64,
+                 'quality': np.uint8, 'segment': np.int16}
+PARTITION_SCHEMA = pa.schema([('person', pa.dictionary(pa.int32(), pa.string())),
+                              ('year', pa.int16()), ('month', pa.int8())])
+
+def partition_dir(person, year, month, root=DATASET_DIR):
+    """[Directory of one partition of the dataset]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where the activity overview file is.]
+        year ([int]): [year of the activities in the partition]
+        month ([int]): [month of the activities in the partition]
+        root (str, optional): [root of the dataset]. Defaults to DATASET_DIR.
+    Returns:
+        [string]: [hive style partition directory]
+    """
+    return os.path.join(root, f'person={person}', f'year={year}', f'month={month}')
+
+def compact_records(df):
+    """[Converts records to the compact dtypes stored in the dataset]
+    Args:
+        df ([pandas dataframe]): [records from parse_file with activity_id]
+    Returns:
+        [pandas dataframe]: [float32 coordinates and altitude, int64 activity_id,
+                             uint8 quality and int16 segment (0 for records
+                             ingested before they were cleaned), other
+                             numeric sensor columns as float32, sorted by
+                             activity_id and timestamp. The partition columns
+                             person, year and month are dropped as they are
+                             stored in the directory names.]
+    """
+    df = df.drop(columns=['person', 'year', 'month'], errors='ignore')
+    for column in df.columns:
+        if column in COMPACT_TYPES:
+            if np.issubdtype(COMPACT_TYPES[column], np.integer):
+                df[column] = df[column].fillna(0)
+            df[column] = df[column].astype(COMPACT_TYPES[column])
+        elif column != 'timestamp' and pd.api.types.is_numeric_dtype(df[column]):
+            df[column] = df[column].astype(np.float32)
+    return df.sort_values(['activity_id', 'timestamp'], kind='stable').reset_index(drop=True)
+
+def to_timestamps(values):
+    """[Converts parsed timestamps, datetimes from fit files or ISO 8601
+        strings from gpx files, to the naive UTC seconds stored in the
+        dataset in one vectorized conversion]
+    Args:
+        values ([array like]): [timestamps, naive ones are taken as UTC]
+    Returns:
+        [pandas series]: [datetime64[ns] timestamps truncated to the second]
+    """
+    times = pd.to_datetime(pd.Series(values), utc=True, format='ISO8601')
+    return times.dt.tz_localize(None).dt.floor('s')
+
+def write_partition(df, person, year, month, root=DATASET_DIR, row_group_size=65536):
+    """[Replaces one partition of the dataset with the given records. Rows are
+        sorted by activity_id so the row group statistics let readers skip row
+        groups that do not contain the activities they filter on.]
+    Args:
+        df ([pandas dataframe]): [records for the partition, removes the
+                                  partition if empty]
+        person ([string]): [The name of the folder in ../data
+        where the activity overview file is.]
+        year ([int]): [year of the activities in the partition]
+        month ([int]): [month of the activities in the partition]
+        root (str, optional): [root of the dataset]. Defaults to DATASET_DIR.
+        row_group_size (int, optional): [rows per row group]. Defaults to 65536.
+    """
+    directory = partition_dir(person, year, month, root)
+    if df is None or len(df) == 0:
+        shutil.rmtree(directory, ignore_errors=True)
+        return
+    os.makedirs(directory, exist_ok=True)
+    table = pa.Table.from_pandas(compact_records(df), preserve_index=False)
+    path = os.path.join(directory, 'part-0.parquet')
+    pq.write_table(table, f'{path}.tmp', row_group_size=row_group_size,
+                   write_statistics=True, compression='zstd')
+    os.replace(f'{path}.tmp', path)
+
+def write_person(df, person, root=DATASET_DIR):
+    """[Replaces every partition of a person with the given records]
+    Args:
+        df ([pandas dataframe]): [records with year and month columns]
+        person ([string]): [The name of the folder in ../data
+        where the activity overview file is.]
+        root (str, optional): [root of the dataset]. Defaults to DATASET_DIR.
+    """
+    shutil.rmtree(os.path.join(root, f'person={person}'), ignore_errors=True)
+    for (year, month), partition in df.groupby(['year', 'month']):
+        write_partition(partition, person, year, month, root)
+
+def open_dataset(root=DATASET_DIR):
+    """[Opens the partitioned dataset]
+    Args:
+        root (str, optional): [root of the dataset]. Defaults to DATASET_DIR.
+    Returns:
+        [pyarrow dataset]: [dataset with person, year and month partition columns]
+    """
+    partitioning = ds.partitioning(PARTITION_SCHEMA, flavor='hive', dictionaries='infer')
+    return ds.dataset(root, format='parquet', partitioning=partitioning)
+
+def build_filter(person=None, activity_ids=None, start=None, end=None):
+    """[Builds the filter expression pushed down to the dataset]
+    Args:
+        person ([string], optional): [only read this person]. Defaults to None.
+        activity_ids ([list], optional): [only read these activities]. Defaults to None.
+        start ([timestamp], optional): [only read records at or after]. Defaults to None.
+        end ([timestamp], optional): [only read records before]. Defaults to None.
+    Returns:
+        [pyarrow expression]: [filter, None if nothing to filter on]
+    """
+    expressions = []
+    if person is not None:
+        expressions.append(ds.field('person') == person)
+    if activity_ids is not None:
+        expressions.append(ds.field('activity_id').isin([int(a) for a in activity_ids]))
+    if start is not None:
+        expressions.append(ds.field('timestamp') >= pd.Timestamp(start).to_datetime64())
+    if end is not None:
+        expressions.append(ds.field('timestamp') < pd.Timestamp(end).to_datetime64())
+    if not expressions:
+        return None
+    expression = expressions[0]
+    for e in expressions[1:]:
+        expression = expression & e
+    return expression
+
+def read_records(person=None, columns=None, activity_ids=None, start=None, end=None, root=DATASET_DIR):
+    """[Reads records from the dataset, pruning partitions by person and
+        row groups by activity_id/timestamp statistics before any data is read]
+    Args:
+        person ([string], optional): [only read this person]. Defaults to None.
+        columns ([list], optional): [only read these columns]. Defaults to None, all.
+        activity_ids ([list], optional): [only read these activities]. Defaults to None.
+        start ([timestamp], optional): [only read records at or after]. Defaults to None.
+        end ([timestamp], optional): [only read records before]. Defaults to None.
+        root (str, optional): [root of the dataset]. Defaults to DATASET_DIR.
+    Returns:
+        [pandas dataframe]: [records, sorted by activity_id and timestamp
+                             within each partition, person is categorical]
+    """
+    dataset = open_dataset(root)
+    expression = build_filter(person, activity_ids, start, end)
+    schemas = [f.physical_schema for f in dataset.get_fragments(filter=expression)]
+    if not schemas:
+        return pd.DataFrame(columns=columns)
+    schema = pa.unify_schemas(schemas + [PARTITION_SCHEMA], promote_options='permissive')
+    dataset = ds.dataset(root, format='parquet', partitioning=dataset.partitioning, schema=schema)
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+def activity_ids(person=None, root=DATASET_DIR):
+    """[Ids of the activities in the dataset, reading only the activity_id column]
+    Args:
+        person ([string], optional): [only read this person]. Defaults to None.
+        root (str, optional): [root of the dataset]. Defaults to DATASET_DIR.
+    Returns:
+        [numpy array]: [unique activity ids]
+    """
+    if not os.path.exists(root):
+        return np.empty(0, dtype=np.int64)
+    table = open_dataset(root).to_table(columns=['activity_id'], filter=build_filter(person))
+    return pc.unique(table['activity_id']).to_numpy()
+
+def activity_slices(df):
+    """[Sorts records by activity once and indexes where each activity's rows
+        are, so an activity is a slice rather than a scan of every row]
+    Args:
+        df ([pandas dataframe]): [records with an activity_id column]
+    Returns:
+        [tuple]: [records sorted by activity_id (stable, so each activity
+                  keeps its order) and a dictionary of activity_id to
+                  (start, stop) row positions]
+    """
+    df = df.sort_values('activity_id', kind='stable').reset_index(drop=True)
+    ids = df['activity_id'].values
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]]) if len(ids) else np.empty(0, dtype=np.int64)
+    stops = np.r_[starts[1:], len(ids)]
+    return df, {int(ids[start]): (int(start), int(stop)) for start, stop in zip(starts, stops)}
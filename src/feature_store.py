@@ -0,0 +1,180 @@
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import numpy as np
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from featurize import FEATURE_COLUMNS
+from predict import featurize_records
+
+LABELLED_DIR = '../data/labelled'
+STORE_DIR = '../data/feature_store'
+
+def labelled_files(source=LABELLED_DIR):
+    """[Hand labelled activities: one parquet file per activity named
+        {activity_id}.parquet, holding its records with timestamp,
+        position_lat, position_long, altitude and mode columns]
+    Args:
+        source (str, optional): [directory of labelled activities]. Defaults to LABELLED_DIR.
+    Returns:
+        [dictionary]: [activity_id to labelled file]
+    """
+    files = glob.glob(os.path.join(source, '*.parquet'))
+    return {int(os.path.basename(f)[:-len('.parquet')]): f for f in sorted(files)}
+
+def store_dir(speed_thres=0, window=2*5, interval="30s", root=STORE_DIR):
+    """[Directory of the features computed with one set of featurization
+        parameters, so features for other parameters are kept alongside]
+    Args:
+        speed_thres (int, optional): [see predict.featurize_records]. Defaults to 0.
+        window (int, optional): [see predict.featurize_records]. Defaults to 2*5.
+        interval ([string]): [see predict.featurize_records] Defaults to 30s
+        root (str, optional): [root of the feature store]. Defaults to STORE_DIR.
+    Returns:
+        [string]: [directory of {activity_id}.parquet feature files]
+    """
+    return os.path.join(root, f'speed_thres={speed_thres},window={window},interval={interval}')
+
+def label_rows(resampled, records, interval):
+    """[Mode of each resampled row: the mode of the last record in its bin,
+        or for an empty bin of the last record before it, as the bin's
+        position is filled forward]
+    Args:
+        resampled ([pandas df]): [resampled rows with activity_id and time, the bin start]
+        records ([pandas df]): [records with activity_id, time and mode]
+        interval ([string]): [interval the rows were resampled at]
+    Returns:
+        [numpy array]: [mode of each resampled row]
+    """
+    bins = pd.DataFrame({'activity_id': resampled['activity_id'].values,
+                         'end': resampled['time'].values + pd.Timedelta(interval) - pd.Timedelta(1, 'ns'),
+                         'row': np.arange(len(resampled))}).sort_values('end', kind='stable')
+    labels = records[['activity_id', 'time', 'mode']].sort_values('time', kind='stable')
+    labels['time'] = labels['time'].values.astype('datetime64[ns]')
+    merged = pd.merge_asof(bins, labels, left_on='end', right_on='time', by='activity_id')
+    return merged.sort_values('row')['mode'].values
+
+def featurize_labelled(files, speed_thres=0, window=2*5, interval="30s", root=STORE_DIR):
+    """[Featurizes a group of labelled activities together and writes each
+        activity's features and mode to its own file in the store. Runs
+        inside a worker process.]
+    Args:
+        files ([dictionary]): [activity_id to labelled file]
+        speed_thres (int, optional): [see predict.featurize_records]. Defaults to 0.
+        window (int, optional): [see predict.featurize_records]. Defaults to 2*5.
+        interval ([string]): [see predict.featurize_records] Defaults to 30s
+        root (str, optional): [root of the feature store]. Defaults to STORE_DIR.
+    Returns:
+        [list]: [feature files written]
+    """
+    columns = ['timestamp', 'position_lat', 'position_long', 'altitude', 'mode']
+    records = pd.concat([pd.read_parquet(f, columns=columns).assign(activity_id=activity_id)
+                         for activity_id, f in files.items()], ignore_index=True)
+    records = records.rename(columns={'timestamp': 'time'})
+    records['time'] = pd.to_datetime(records['time'], utc=True).dt.tz_localize(tz=None)
+    resampled, features = featurize_records(records, speed_thres, window, interval)
+    features['mode'] = label_rows(resampled, records, interval)[features.index]
+    features = features.dropna(subset=['mode'])
+    features['activity_id'] = resampled['activity_id'].values[features.index]
+    directory = store_dir(speed_thres, window, interval, root)
+    os.makedirs(directory, exist_ok=True)
+    written = []
+    by_activity = dict(tuple(features.groupby('activity_id')))
+    for activity_id in files:
+        group = by_activity.get(activity_id, features.iloc[:0])
+        path = os.path.join(directory, f'{activity_id}.parquet')
+        table = pa.Table.from_pandas(group[FEATURE_COLUMNS + ['mode']], preserve_index=False)
+        pq.write_table(table, f'{path}.tmp')
+        os.replace(f'{path}.tmp', path)
+        written.append(path)
+    return written
+
+def is_cached(path, source):
+    """[Whether a feature file exists and is newer than its labelled activity]
+    Args:
+        path ([string]): [feature file]
+        source ([string]): [labelled file]
+    Returns:
+        [bool]: [True if the cached features can be used]
+    """
+    return os.path.exists(path) and os.stat(path).st_mtime_ns >= os.stat(source).st_mtime_ns
+
+def build_feature_store(speed_thres=0, window=2*5, interval="30s", source=LABELLED_DIR, root=STORE_DIR,
+                        n_workers=None, activities_per_task=20):
+    """[Brings the feature store for one set of featurization parameters up to
+        date. Only activities without features, or labelled again since, are
+        featurized, across a process pool, so a sweep over window sizes
+        featurizes each activity once per window.]
+    Args:
+        speed_thres (int, optional): [see predict.featurize_records]. Defaults to 0.
+        window (int, optional): [see predict.featurize_records]. Defaults to 2*5.
+        interval ([string]): [see predict.featurize_records] Defaults to 30s
+        source (str, optional): [directory of labelled activities]. Defaults to LABELLED_DIR.
+        root (str, optional): [root of the feature store]. Defaults to STORE_DIR.
+        n_workers (int, optional): [number of worker processes]. Defaults to
+                                    None, one per core.
+        activities_per_task (int, optional): [activities featurized by a
+                                              worker at a time]. Defaults to 20.
+    Returns:
+        [list]: [feature files of every labelled activity]
+    """
+    files = labelled_files(source)
+    directory = store_dir(speed_thres, window, interval, root)
+    paths = {activity_id: os.path.join(directory, f'{activity_id}.parquet') for activity_id in files}
+    stale = [activity_id for activity_id in files if not is_cached(paths[activity_id], files[activity_id])]
+    tasks = [{activity_id: files[activity_id] for activity_id in stale[i:i + activities_per_task]}
+             for i in range(0, len(stale), activities_per_task)]
+    if tasks:
+        print(f'Featurizing {len(stale)} of {len(files)} labelled activities.')
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            list(executor.map(featurize_labelled, tasks, [speed_thres] * len(tasks), [window] * len(tasks),
+                              [interval] * len(tasks), [root] * len(tasks)))
+    return [paths[activity_id] for activity_id in files]
+
+def read_features(paths, dtype=np.float32):
+    """[Reads feature files into one preallocated feature array, a file at a
+        time, so only the arrays and not a concatenated table are in memory.
+        float32 loses nothing as the forest compares float32 features.]
+    Args:
+        paths ([list]): [feature files, see build_feature_store]
+        dtype ([numpy dtype], optional): [dtype of the features]. Defaults to np.float32.
+    Returns:
+        [tuple of numpy arrays]: [X, y]
+    """
+    sizes = [pq.ParquetFile(path).metadata.num_rows for path in paths]
+    X = np.empty((sum(sizes), len(FEATURE_COLUMNS)), dtype=dtype)
+    y = np.empty(sum(sizes), dtype=object)
+    start = 0
+    for path, size in zip(paths, sizes):
+        table = pq.ParquetFile(path).read()
+        for j, column in enumerate(FEATURE_COLUMNS):
+            X[start:start + size, j] = table.column(column).to_numpy()
+        y[start:start + size] = table.column('mode').to_numpy(zero_copy_only=False)
+        start += size
+    return X, y
+
+def export_features(paths, filename='../data/featurized.parquet'):
+    """[Writes the feature files as one table, the featurized.parquet that
+        sup_model and bench_forest read, a file at a time]
+    Args:
+        paths ([list]): [feature files, see build_feature_store]
+        filename (str, optional): [output file]. Defaults to '../data/featurized.parquet'.
+    """
+    writer = None
+    for path in paths:
+        table = pq.ParquetFile(path).read()
+        if table.num_rows == 0:
+            continue
+        if writer is None:
+            writer = pq.ParquetWriter(f'{filename}.tmp', table.schema)
+        writer.write_table(table.cast(writer.schema))
+    if writer is not None:
+        writer.close()
+        os.replace(f'{filename}.tmp', filename)
+
+if __name__ == '__main__':
+    for window in [6, 10, 20]:
+        paths = build_feature_store(window=window)
+        X, y = read_features(paths)
+        print(f'window={window}: {len(X)} rows from {len(paths)} activities')
@@ -0,0 +1,169 @@
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+import geo
+
+FEATURE_COLUMNS = ['dist', 'dist_max', 'dist_std',
+                   'speed', 'speed_max', 'speed_std',
+                   'delta_alt', 'delta_alt_max', 'delta_alt_std', 'month']
+VALUE_COLUMNS = ['position_lat', 'position_long', 'altitude']
+
+def group_starts(keys):
+    """[Finds where each run of equal keys starts]
+    Args:
+        keys ([numpy array]): [sorted group keys, e.g. activity ids]
+    Returns:
+        [tuple of numpy arrays]: [start position of each group, and for each
+                                  row the start and end position of its group]
+    """
+    if len(keys) == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    ends = np.r_[starts[1:], len(keys)]
+    sizes = ends - starts
+    return starts, np.repeat(starts, sizes), np.repeat(ends, sizes)
+
+def fill_within(column, row_starts, row_ends):
+    """[Forward fills then back fills a column without crossing groups]
+    Args:
+        column ([numpy array]): [values with NaN for missing]
+        row_starts ([numpy array]): [start position of each row's group]
+        row_ends ([numpy array]): [end position of each row's group]
+    Returns:
+        [numpy array]: [filled values, NaN only where a group has no values]
+    """
+    n = len(column)
+    position = np.arange(n)
+    last = np.maximum.accumulate(np.where(np.isnan(column), -1, position))
+    column = np.where(last >= row_starts, column[np.maximum(last, 0)], np.nan).astype(column.dtype)
+    following = np.minimum.accumulate(np.where(np.isnan(column), n, position)[::-1])[::-1]
+    return np.where(following < row_ends, column[np.minimum(following, n - 1)], np.nan).astype(column.dtype)
+
+def resample_arrays(activity_ids, times, columns, interval):
+    """[Averages each activity's records over fixed time bins, the same bins
+        DataFrame.resample(interval).mean() uses, then fills empty bins
+        forward and backward within the activity]
+    Args:
+        activity_ids ([numpy array]): [activity of each record, sorted]
+        times ([numpy array]): [datetime64[ns] of each record, sorted within activity]
+        columns ([list]): [float arrays of values to average. Means are
+                           rounded the way pandas does for the array's dtype.]
+        interval ([string]): [interval at which you want to resample]
+    Returns:
+        [tuple]: [activity id and bin time of each bin, list of averaged columns]
+    """
+    freq = pd.Timedelta(interval).value
+    t = times.astype(np.int64)
+    starts, _, _ = group_starts(activity_ids)
+    sizes = np.diff(np.r_[starts, len(t)])
+    day = 24 * 3600 * 10**9
+    origin = (t[starts] // day) * day
+    bins = (t - np.repeat(origin, sizes)) // freq
+    first_bin = bins[starts]
+    n_bins = bins[starts + sizes - 1] - first_bin + 1
+    offsets = np.cumsum(n_bins) - n_bins
+    out = bins - np.repeat(first_bin - offsets, sizes)
+    total = int(n_bins.sum())
+    out_ids = np.repeat(activity_ids[starts], n_bins)
+    bin_number = np.arange(total) - np.repeat(offsets, n_bins) + np.repeat(first_bin, n_bins)
+    out_times = (np.repeat(origin, n_bins) + bin_number * freq).astype('datetime64[ns]')
+    _, out_starts, out_ends = group_starts(out_ids)
+    means = []
+    for column in columns:
+        valid = ~np.isnan(column)
+        sums = np.bincount(out, np.where(valid, column, 0), total).astype(column.dtype)
+        counts = np.bincount(out, valid, total).astype(column.dtype)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(counts > 0, sums / counts, np.nan).astype(column.dtype)
+        means.append(fill_within(mean, out_starts, out_ends))
+    return out_ids, out_times, means
+
+def speed_distance_arrays(activity_ids, times, lat, lon, alt, method='ellipsoid'):
+    """[Distance, change in altitude, change in time and speed from each
+        resampled row to the previous row of the same activity. The first row
+        of an activity is compared with itself, as the back fill in
+        predict.compute_speed_distance does.]
+    Args:
+        activity_ids ([numpy array]): [activity of each row, sorted]
+        times ([numpy array]): [datetime64[ns] of each row]
+        lat ([numpy array]): [latitude of each row]
+        lon ([numpy array]): [longitude of each row]
+        alt ([numpy array]): [altitude of each row]
+        method (str, optional): [see predict.compute_speed_distance]. Defaults to 'ellipsoid'.
+    Returns:
+        [tuple of numpy arrays]: [distance, delta_alt, time_delta, speed]
+    """
+    previous = np.arange(len(lat)) - 1
+    starts, _, _ = group_starts(activity_ids)
+    previous[starts] = starts
+    distance_2d = geo.distance(lat[previous], lon[previous], lat, lon, method)
+    delta_alt = alt - alt[previous]
+    distance = np.sqrt(distance_2d**2 + delta_alt**2)
+    time_delta = (times - times[previous]).astype('timedelta64[ns]').astype(np.int64) / 1e9
+    with np.errstate(invalid='ignore', divide='ignore'):
+        speed = distance / time_delta
+    return distance, delta_alt, time_delta, speed
+
+def rolling_stats(x, activity_ids, window):
+    """[Rolling mean, max and sample std over the last window rows of the same activity]
+    Args:
+        x ([numpy array]): [values]
+        activity_ids ([numpy array]): [activity of each value, sorted]
+        window ([int]): [number of rows in the window]
+    Returns:
+        [tuple of numpy arrays]: [mean, max, std, NaN where the window is not
+                                  yet full within the activity]
+    """
+    x = np.asarray(x, dtype=np.float64)
+    stats = np.full((3, len(x)), np.nan)
+    if len(x) < window:
+        return stats
+    windows = sliding_window_view(x, window)
+    full = activity_ids[:len(x) - window + 1] == activity_ids[window - 1:]
+    stats[0, window - 1:] = np.where(full, windows.mean(axis=1), np.nan)
+    stats[1, window - 1:] = np.where(full, windows.max(axis=1), np.nan)
+    stats[2, window - 1:] = np.where(full, windows.std(axis=1, ddof=1), np.nan)
+    return stats
+
+def featurize(sample_df, speed_thres=0, window=2*5, interval="30s", method='ellipsoid'):
+    """[Resamples, fills and computes the window features of every activity in
+        one pass over contiguous arrays. Gives the same features as
+        predict.resample_activity, compute_speed_distance and window_features
+        for a single activity, and never fills or windows across activities.]
+    Args:
+        sample_df ([pandas df]): [records with time, position_lat, position_long,
+                                  altitude and activity_id columns]
+        speed_thres (int, optional): [Threshold for speed. Only keeps rows when
+                                       speed is >= this threshold]. Defaults to 0.
+        window (int, optional): [size of the moving window over which you
+                                 are calculating]. Defaults to 2*5.
+        interval ([string]): [interval at which you want to resample] Defaults to 30s
+        method (str, optional): [see predict.compute_speed_distance]. Defaults to 'ellipsoid'.
+    Returns:
+        [tuple of pandas df]: [resampled records with distance, delta_alt,
+                               time_delta and speed, and the window features for
+                               the rows that have them, indexed by resampled row]
+    """
+    times = pd.to_datetime(sample_df['time'], utc=True).dt.tz_localize(tz=None).values.astype('datetime64[ns]')
+    activity_ids = sample_df['activity_id'].values
+    order = np.lexsort((times, activity_ids))
+    columns = [sample_df[column].values.astype(np.float64 if sample_df[column].dtype.kind != 'f'
+                                                else sample_df[column].dtype)[order]
+               for column in VALUE_COLUMNS]
+    ids, bin_times, (lat, lon, alt) = resample_arrays(activity_ids[order], times[order], columns, interval)
+    resampled = pd.DataFrame({'activity_id': ids, 'time': bin_times,
+                              'position_lat': lat, 'position_long': lon, 'altitude': alt})
+    distance, delta_alt, time_delta, speed = speed_distance_arrays(ids, bin_times, lat, lon, alt, method)
+    resampled['distance'] = distance
+    resampled['delta_alt'] = delta_alt
+    resampled['time_delta'] = time_delta
+    resampled['speed'] = speed
+
+    keep = np.flatnonzero(speed >= speed_thres)
+    kept_ids = ids[keep]
+    features = np.concatenate([rolling_stats(column[keep], kept_ids, window)
+                               for column in (distance, speed, delta_alt)])
+    month = pd.DatetimeIndex(bin_times[keep]).month
+    features = pd.DataFrame(np.vstack([features, month]).T, index=keep, columns=FEATURE_COLUMNS)
+    return resampled, features.dropna()
@@ -0,0 +1,233 @@
+from fitparse.processors import UTC_REFERENCE
+from fitparse.profile import MESSAGE_TYPES
+from fitparse.records import BASE_TYPES
+import numpy as np
+
+RECORD_MESG_NUM = 20
+FILE_ID_MESG_NUM = 0
+
+NUMPY_TYPES = {'enum': 'u1', 'sint8': 'i1', 'uint8': 'u1', 'uint8z': 'u1',
+               'sint16': 'i2', 'uint16': 'u2', 'uint16z': 'u2',
+               'sint32': 'i4', 'uint32': 'u4', 'uint32z': 'u4',
+               'sint64': 'i8', 'float32': 'f4', 'float64': 'f8'}
+
+INVALID_VALUES = {'enum': 0xFF, 'sint8': 0x7F, 'uint8': 0xFF, 'uint8z': 0,
+                  'sint16': 0x7FFF, 'uint16': 0xFFFF, 'uint16z': 0,
+                  'sint32': 0x7FFFFFFF, 'uint32': 0xFFFFFFFF, 'uint32z': 0,
+                  'sint64': 0x7FFFFFFFFFFFFFFF}
+
+def read_definitions(data, until=None):
+    """[Walks the messages of a fit file, keeping only the position of
+        each data message rather than decoding it]
+    Args:
+        data ([bytes]): [contents of the fit file]
+        until ([int], optional): [stop at the first data message of this
+                                  mesg_num]. Defaults to None, read every message.
+    Returns:
+        [list]: [one dictionary per definition message with mesg_num, endian,
+                 fields (def_num, size, base type) and offsets of the data
+                 messages that use it]
+    """
+    definitions = []
+    local = {}
+    start = 0
+    while start < len(data):
+        if data[start + 8:start + 12] != b'.FIT':
+            raise ValueError('Invalid .FIT file header')
+        pos = start + data[start]
+        end = pos + int.from_bytes(data[start + 4:start + 8], 'little')
+        if end + 2 > len(data):
+            raise ValueError('Truncated .FIT file')
+        while pos < end:
+            header = data[pos]
+            if header & 0x80:
+                raise NotImplementedError('compressed timestamp headers')
+            if header & 0x40:
+                endian = '>' if data[pos + 2] else '<'
+                mesg_num = int.from_bytes(data[pos + 3:pos + 5], 'big' if endian == '>' else 'little')
+                num_fields = data[pos + 5]
+                fields = [tuple(data[pos + 6 + 3*i:pos + 9 + 3*i]) for i in range(num_fields)]
+                pos += 6 + 3*num_fields
+                size = sum(field[1] for field in fields)
+                has_dev_fields = bool(header & 0x20)
+                if has_dev_fields:
+                    num_dev_fields = data[pos]
+                    size += sum(data[pos + 2 + 3*i] for i in range(num_dev_fields))
+                    pos += 1 + 3*num_dev_fields
+                local[header & 0xF] = {'mesg_num': mesg_num, 'endian': endian, 'fields': fields,
+                                       'size': size, 'has_dev_fields': has_dev_fields, 'offsets': []}
+                definitions.append(local[header & 0xF])
+            else:
+                definition = local[header & 0xF]
+                definition['offsets'].append(pos)
+                if definition['mesg_num'] == until:
+                    return definitions
+                pos += 1 + definition['size']
+        if pos != end:
+            raise ValueError('Truncated .FIT file')
+        start = end + 2
+    return definitions
+
+def gather_field(buf, offsets, field_offset, size, dtype):
+    """[Reads one field out of every data message in a single vectorized step]
+    Args:
+        buf ([numpy array]): [contents of the fit file as uint8]
+        offsets ([numpy array]): [positions of the data messages]
+        field_offset ([int]): [position of the field within the message]
+        size ([int]): [size of the field in bytes]
+        dtype ([numpy dtype]): [type of the field, including byte order]
+    Returns:
+        [numpy array]: [value of the field in each message]
+    """
+    cells = buf[offsets[:, None] + field_offset + np.arange(size)]
+    return np.ascontiguousarray(cells).view(dtype).ravel()
+
+def render(field, values, valid):
+    """[Applies the type processing fitparse does by default to a field]
+    Args:
+        field ([fitparse Field]): [profile field the values belong to]
+        values ([numpy array]): [scaled values]
+        valid ([numpy array]): [boolean mask of values that are not invalid]
+    Returns:
+        [tuple]: [kind (int, float or datetime) and the rendered values]
+    """
+    if getattr(field.type, 'values', None) and np.isin(values[valid], list(field.type.values)).any():
+        raise NotImplementedError(f'enumerated values for {field.name}')
+    if field.type.name == 'date_time':
+        if (values[valid] < 0x10000000).any():
+            raise NotImplementedError(f'relative date_time values for {field.name}')
+        return 'datetime', (values.astype(np.int64) + UTC_REFERENCE).astype('datetime64[s]')
+    if field.type.name in ('bool', 'local_date_time', 'localtime_into_day'):
+        raise NotImplementedError(f'{field.type.name} values for {field.name}')
+    return ('float' if values.dtype.kind == 'f' else 'int'), values
+
+def scale_offset(field, values):
+    """[Applies the scale and offset of a field or component the same way fitparse does]
+    Args:
+        field ([fitparse Field or ComponentField]): [field with scale and offset]
+        values ([numpy array]): [raw values]
+    Returns:
+        [numpy array]: [scaled values]
+    """
+    if field.scale:
+        values = values.astype(np.float64) / field.scale
+    if field.offset:
+        values = values - field.offset
+    return values
+
+def decode_definition(buf, definition, offsets):
+    """[Decodes every field of the record messages that share a definition]
+    Args:
+        buf ([numpy array]): [contents of the fit file as uint8]
+        definition ([dictionary]): [see output of read_definitions]
+        offsets ([numpy array]): [positions of the data messages]
+    Returns:
+        [dictionary]: [field name -> (kind, values, valid mask), in the order
+                       fitparse yields the fields of a message. A later field
+                       with the same name replaces an earlier one.]
+    """
+    if definition['has_dev_fields']:
+        raise NotImplementedError('developer fields')
+    mesg_type = MESSAGE_TYPES[RECORD_MESG_NUM]
+    columns = {}
+    field_offset = 1
+    for def_num, size, base_type_num in definition['fields']:
+        base_type = BASE_TYPES.get(base_type_num)
+        if base_type is None or base_type.name not in NUMPY_TYPES or size != base_type.size:
+            raise NotImplementedError(f'field {def_num} of size {size} and base type {base_type_num}')
+        dtype = np.dtype(NUMPY_TYPES[base_type.name]).newbyteorder(definition['endian'])
+        raw = gather_field(buf, offsets, field_offset, size, dtype)
+        field_offset += size
+        if dtype.kind == 'f':
+            valid = ~np.isnan(raw)
+        else:
+            valid = raw != INVALID_VALUES[base_type.name]
+        field = mesg_type.fields.get(def_num)
+        if field is None:
+            columns[f'unknown_{def_num}'] = ('float' if dtype.kind == 'f' else 'int', raw, valid)
+            continue
+        if field.subfields:
+            raise NotImplementedError(f'subfields of {field.name}')
+        for component in field.components or []:
+            if component.accumulate:
+                raise NotImplementedError(f'accumulated component of {field.name}')
+            cmp_field = mesg_type.fields[component.def_num]
+            if cmp_field.subfields:
+                raise NotImplementedError(f'subfields of {cmp_field.name}')
+            cmp_raw = (raw.astype(np.int64) >> component.bit_offset) & ((1 << component.bits) - 1)
+            kind, values = render(cmp_field, scale_offset(component, cmp_raw), valid)
+            columns[cmp_field.name] = (kind, values, valid)
+        kind, values = render(field, raw, valid)
+        values = scale_offset(field, values)
+        columns[field.name] = ('float' if values.dtype.kind == 'f' else kind, values, valid)
+    return columns
+
+def combine_column(parts, n):
+    """[Combines one field from every definition into a single typed array]
+    Args:
+        parts ([list]): [(rows, kind, values, valid) for each definition
+                         with the field]
+        n ([int]): [total number of records]
+    Returns:
+        [numpy array]: [int64 if the field is valid in every record, float64
+                        with NaN for missing records if numeric, datetime64 with
+                        NaT for timestamps, None objects if never valid]
+    """
+    kinds = {kind for _, kind, _, valid in parts if valid.any()}
+    if not kinds:
+        return np.full(n, None, dtype=object)
+    if kinds == {'int'} and sum(valid.sum() for _, _, _, valid in parts) == n:
+        column = np.empty(n, dtype=np.int64)
+    elif kinds <= {'int', 'float'}:
+        column = np.full(n, np.nan)
+    elif kinds == {'datetime'}:
+        column = np.full(n, np.datetime64('NaT'), dtype='datetime64[ns]')
+    else:
+        raise NotImplementedError(f'mixed value types {kinds}')
+    for rows, _, values, valid in parts:
+        column[rows[valid]] = values[valid]
+    return column
+
+def record_columns(data):
+    """[Decodes the record messages of a fit file into columns]
+    Args:
+        data ([bytes]): [contents of the fit file]
+    Returns:
+        [dictionary]: [field name -> numpy array with one value per record, with
+                       the same names, order and values fitparse gives. Raises
+                       NotImplementedError for files that use fit features this
+                       decoder does not cover. Unlike fitparse the CRC is not checked.]
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    definitions = [d for d in read_definitions(data) if d['mesg_num'] == RECORD_MESG_NUM and d['offsets']]
+    definitions.sort(key=lambda d: d['offsets'][0])
+    positions = np.sort(np.concatenate([d['offsets'] for d in definitions])) if definitions else np.empty(0, int)
+    columns = {}
+    for definition in definitions:
+        offsets = np.array(definition['offsets'])
+        rows = np.searchsorted(positions, offsets)
+        for name, (kind, values, valid) in decode_definition(buf, definition, offsets).items():
+            columns.setdefault(name, []).append((rows, kind, values, valid))
+    return {name: combine_column(parts, len(positions)) for name, parts in columns.items()}
+
+def device_info(data):
+    """[Reads the manufacturer and product of the device that recorded a fit
+        file from its first file_id message]
+    Args:
+        data ([bytes]): [contents of the fit file]
+    Returns:
+        [dictionary]: [manufacturer and product numbers, empty if not recorded]
+    """
+    for definition in read_definitions(data, until=FILE_ID_MESG_NUM):
+        if definition['mesg_num'] != FILE_ID_MESG_NUM or not definition['offsets']:
+            continue
+        info = {}
+        pos = definition['offsets'][0] + 1
+        for def_num, size, _ in definition['fields']:
+            if def_num in (1, 2) and size == 2:
+                value = int.from_bytes(data[pos:pos + 2], 'big' if definition['endian'] == '>' else 'little')
+                if value != 0xFFFF:
+                    info['manufacturer' if def_num == 1 else 'product'] = value
+            pos += size
+        return info
+    return {}
@@ -0,0 +1,177 @@
+import json
+import numpy as np
+import os
+
+def float32_below(threshold):
+    """[Largest float32 at or below each threshold. Features are float32, as
+        sklearn casts them before descending a tree, so x <= threshold and
+        x <= float32_below(threshold) agree for every feature value.]
+    Args:
+        threshold ([numpy array]): [float64 split thresholds]
+    Returns:
+        [numpy array]: [float32 thresholds]
+    """
+    rounded = threshold.astype(np.float32)
+    above = rounded.astype(np.float64) > threshold
+    rounded[above] = np.nextafter(rounded[above], np.float32(-np.inf))
+    return rounded
+
+def flatten_forest(clf, value_dtype=np.float32):
+    """[Flattens the trees of a fitted RandomForestClassifier into one set of
+        node arrays. Split nodes of every tree come first and leaves after
+        them, so only leaves need a row in the class probability table.
+        Leaves are their own children, so descending past a leaf stays put
+        and every row can take the same number of steps.]
+    Args:
+        clf ([RandomForestClassifier]): [fit classifier]
+        value_dtype ([numpy dtype], optional): [dtype of the leaf class
+                                                probabilities]. Defaults to np.float32.
+    Returns:
+        [dictionary]: [roots, feature, threshold, children (left, right of
+                       each node) and leaf_value arrays, classes, n_features,
+                       n_splits (node id of the first leaf) and depth]
+    """
+    trees = [estimator.tree_ for estimator in clf.estimators_]
+    is_leaf = [tree.children_left == -1 for tree in trees]
+    n_splits = sum(int((~leaf).sum()) for leaf in is_leaf)
+    roots, features, thresholds, children, values = [], [], [], [], []
+    split_offset, leaf_offset = 0, n_splits
+    for tree, leaf in zip(trees, is_leaf):
+        node_id = np.where(leaf, leaf_offset + np.cumsum(leaf) - 1, split_offset + np.cumsum(~leaf) - 1)
+        roots.append(node_id[0])
+        features.append(tree.feature[~leaf])
+        thresholds.append(tree.threshold[~leaf])
+        children.append(np.column_stack([node_id[tree.children_left[~leaf]],
+                                         node_id[tree.children_right[~leaf]]]))
+        value = tree.value[leaf, 0, :]
+        values.append(value / value.sum(axis=1, keepdims=True))
+        split_offset += int((~leaf).sum())
+        leaf_offset += int(leaf.sum())
+    leaves = np.arange(n_splits, leaf_offset)
+    index_dtype = np.int32 if leaf_offset < 2**31 else np.int64
+    return {'roots': np.array(roots, dtype=index_dtype),
+            'feature': np.r_[np.concatenate(features), np.zeros(len(leaves), dtype=np.int64)].astype(
+                np.int16 if clf.n_features_in_ < 2**15 else np.int32),
+            'threshold': np.r_[float32_below(np.concatenate(thresholds)), np.zeros(len(leaves), dtype=np.float32)],
+            'children': np.concatenate(children + [np.column_stack([leaves, leaves])]).astype(index_dtype),
+            'leaf_value': np.concatenate(values).astype(value_dtype),
+            'classes': clf.classes_, 'n_features': int(clf.n_features_in_), 'n_splits': n_splits,
+            'depth': max(tree.max_depth for tree in trees)}
+
+ARRAYS = ['roots', 'feature', 'threshold', 'children', 'leaf_value']
+META = ['n_features', 'n_splits', 'depth']
+
+def save_forest(forest, directory):
+    """[Saves a flattened forest as one .npy file per array, which load_forest
+        can memory map]
+    Args:
+        forest ([dictionary]): [see output of flatten_forest]
+        directory ([string]): [output directory]
+    """
+    os.makedirs(directory, exist_ok=True)
+    for name in ARRAYS:
+        np.save(os.path.join(directory, f'{name}.npy'), forest[name])
+    with open(os.path.join(directory, 'meta.json'), 'w') as f:
+        json.dump(dict({'classes': forest['classes'].tolist()}, **{key: forest[key] for key in META}), f)
+
+def load_forest(directory, mmap=True):
+    """[Loads a flattened forest. Memory mapped arrays are paged in as the
+        evaluator touches them, so loading takes milliseconds.]
+    Args:
+        directory ([string]): [directory written by save_forest]
+        mmap (bool, optional): [memory map the arrays]. Defaults to True.
+    Returns:
+        [dictionary]: [see output of flatten_forest]
+    """
+    forest = {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r' if mmap else None)
+              for name in ARRAYS}
+    with open(os.path.join(directory, 'meta.json')) as f:
+        meta = json.load(f)
+    forest['classes'] = np.array(meta['classes'])
+    forest.update({key: meta[key] for key in META})
+    return forest
+
+def export_forest(clf, directory, value_dtype=np.float32):
+    """[Flattens a fitted RandomForestClassifier and saves it]
+    Args:
+        clf ([RandomForestClassifier]): [fit classifier]
+        directory ([string]): [output directory]
+        value_dtype ([numpy dtype], optional): [see flatten_forest]. Defaults to np.float32.
+    """
+    save_forest(flatten_forest(clf, value_dtype), directory)
+
+def forest_leaves(forest, X, first_tree=0, last_tree=None):
+    """[Descends a run of trees for every row at once, one level per step,
+        each step a few gathers over flat arrays. Rows are laid out tree by
+        tree so neighbouring lookups hit the same tree's nodes.]
+    Args:
+        forest ([dictionary]): [see output of flatten_forest]
+        X ([numpy array]): [float32 features, n rows x n_features]
+        first_tree (int, optional): [first tree to descend]. Defaults to 0.
+        last_tree ([int], optional): [tree after the last one]. Defaults to None, all.
+    Returns:
+        [numpy array]: [leaf row of each row in each tree, n trees x n rows]
+    """
+    feature, threshold = forest['feature'], forest['threshold']
+    children = np.asarray(forest['children']).reshape(-1)
+    roots = np.asarray(forest['roots'][first_tree:last_tree])
+    node = np.repeat(roots, len(X))
+    offsets = np.tile(np.arange(len(X), dtype=children.dtype) * X.shape[1], len(roots))
+    values = X.reshape(-1)
+    for _ in range(forest['depth']):
+        right = values[offsets + feature[node]] > threshold[node]
+        node = children[2 * node + right]
+    return (node - forest['n_splits']).reshape(len(roots), len(X))
+
+def forest_proba(forest, X, batch_size=8192, block_size=65536):
+    """[Class probabilities, the mean of the trees' leaf probabilities as
+        RandomForestClassifier.predict_proba computes them. Large batches
+        are descended a few trees at a time so the nodes being visited stay
+        in cache; a single window descends every tree in one go.]
+    Args:
+        forest ([dictionary]): [see output of flatten_forest]
+        X ([numpy array]): [features, n rows x n_features]
+        batch_size (int, optional): [rows evaluated at a time]. Defaults to 8192.
+        block_size (int, optional): [rows x trees descended together]. Defaults to 65536.
+    Returns:
+        [numpy array]: [n rows x n classes probabilities]
+    """
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    leaf_value = forest['leaf_value']
+    n_trees = len(forest['roots'])
+    proba = np.zeros((len(X), leaf_value.shape[1]))
+    for start in range(0, len(X), batch_size):
+        batch = X[start:start + batch_size]
+        total = proba[start:start + batch_size]
+        trees_per_block = max(1, block_size // len(batch))
+        for first_tree in range(0, n_trees, trees_per_block):
+            for leaves in forest_leaves(forest, batch, first_tree, first_tree + trees_per_block):
+                total += leaf_value[leaves]
+    return proba / n_trees
+
+def forest_predict(forest, X, batch_size=8192):
+    """[Predicted class of each row]
+    Args:
+        forest ([dictionary]): [see output of flatten_forest]
+        X ([numpy array]): [features, n rows x n_features]
+        batch_size (int, optional): [rows evaluated at a time]. Defaults to 8192.
+    Returns:
+        [numpy array]: [predicted class of each row]
+    """
+    return forest['classes'][np.argmax(forest_proba(forest, X, batch_size), axis=1)]
+
+class CompiledForest:
+    """[Flattened forest with the predict/predict_proba/classes_ interface of
+        the RandomForestClassifier it was exported from, so it can be passed
+        anywhere a clf is expected]
+    """
+    def __init__(self, forest):
+        self.forest = forest
+        self.classes_ = forest['classes']
+        self.n_features_in_ = forest['n_features']
+
+    def predict_proba(self, X):
+        return forest_proba(self.forest, X)
+
+    def predict(self, X):
+        return forest_predict(self.forest, X)
@@ -0,0 +1,82 @@
+import numpy as np
+
+EARTH_RADIUS = 6371008.8
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = WGS84_A * (1 - WGS84_F)
+
+def haversine(lat1, lon1, lat2, lon2):
+    """[Great circle distance on a sphere of the mean earth radius]
+    Args:
+        lat1 ([numpy array]): [latitudes of the first points in degrees]
+        lon1 ([numpy array]): [longitudes of the first points in degrees]
+        lat2 ([numpy array]): [latitudes of the second points in degrees]
+        lon2 ([numpy array]): [longitudes of the second points in degrees]
+    Returns:
+        [numpy array]: [distance in metres between each pair of points]
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(x, dtype=np.float64)) for x in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def vincenty(lat1, lon1, lat2, lon2, tol=1e-12, max_iter=200):
+    """[Distance on the WGS-84 ellipsoid using Vincenty's inverse formula,
+        iterated for all pairs at once. Agrees with geopy's geodesic distance
+        to well under 1 mm except for nearly antipodal points, which do not
+        occur between consecutive track points.]
+    Args:
+        lat1 ([numpy array]): [latitudes of the first points in degrees]
+        lon1 ([numpy array]): [longitudes of the first points in degrees]
+        lat2 ([numpy array]): [latitudes of the second points in degrees]
+        lon2 ([numpy array]): [longitudes of the second points in degrees]
+        tol (float, optional): [convergence tolerance on lambda]. Defaults to 1e-12.
+        max_iter (int, optional): [maximum number of iterations]. Defaults to 200.
+    Returns:
+        [numpy array]: [distance in metres between each pair of points]
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(x, dtype=np.float64)) for x in (lat1, lon1, lat2, lon2))
+    L = lon2 - lon1
+    U1 = np.arctan((1 - WGS84_F) * np.tan(lat1))
+    U2 = np.arctan((1 - WGS84_F) * np.tan(lat2))
+    sinU1, cosU1, sinU2, cosU2 = np.sin(U1), np.cos(U1), np.sin(U2), np.cos(U2)
+    lam = L.copy()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for _ in range(max_iter):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.sqrt((cosU2 * sin_lam)**2 + (cosU1 * sinU2 - sinU1 * cosU2 * cos_lam)**2)
+            cos_sigma = sinU1 * sinU2 + cosU1 * cosU2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(sin_sigma == 0, 0, cosU1 * cosU2 * sin_lam / sin_sigma)
+            cos2_alpha = 1 - sin_alpha**2
+            cos_2sigma_m = np.where(cos2_alpha == 0, 0, cos_sigma - 2 * sinU1 * sinU2 / cos2_alpha)
+            C = WGS84_F / 16 * cos2_alpha * (4 + WGS84_F * (4 - 3 * cos2_alpha))
+            lam_previous = lam
+            lam = L + (1 - C) * WGS84_F * sin_alpha * (
+                sigma + C * sin_sigma * (cos_2sigma_m + C * cos_sigma * (-1 + 2 * cos_2sigma_m**2)))
+            if np.nanmax(np.abs(lam - lam_previous), initial=0) < tol:
+                break
+        u2 = cos2_alpha * (WGS84_A**2 - WGS84_B**2) / WGS84_B**2
+        A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+        B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+        delta_sigma = B * sin_sigma * (cos_2sigma_m + B / 4 * (
+            cos_sigma * (-1 + 2 * cos_2sigma_m**2)
+            - B / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma**2) * (-3 + 4 * cos_2sigma_m**2)))
+    return WGS84_B * A * (sigma - delta_sigma)
+
+def distance(lat1, lon1, lat2, lon2, method='haversine'):
+    """[Distance between pairs of points]
+    Args:
+        lat1 ([numpy array]): [latitudes of the first points in degrees]
+        lon1 ([numpy array]): [longitudes of the first points in degrees]
+        lat2 ([numpy array]): [latitudes of the second points in degrees]
+        lon2 ([numpy array]): [longitudes of the second points in degrees]
+        method (str, optional): [haversine for a spherical earth or ellipsoid
+                                 for WGS-84]. Defaults to 'haversine'.
+    Returns:
+        [numpy array]: [distance in metres between each pair of points]
+    """
+    if method == 'haversine':
+        return haversine(lat1, lon1, lat2, lon2)
+    if method == 'ellipsoid':
+        return vincenty(lat1, lon1, lat2, lon2)
+    raise ValueError(f'Unknown distance method {method}')
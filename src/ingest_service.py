@@ -0,0 +1,417 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import copy
+import json
+import numpy as np
+import os
+import pandas as pd
+import time
+from urllib.parse import parse_qs, urlsplit
+import instrument
+import peak
+import pipeline_to_parquet
+import simplify
+
+STATUS_TEXT = {200: 'OK', 202: 'Accepted', 400: 'Bad Request', 404: 'Not Found',
+               405: 'Method Not Allowed', 413: 'Payload Too Large', 500: 'Internal Server Error',
+               503: 'Service Unavailable'}
+
+def new_service(people, n_workers=None, max_queue=100, poll_interval=5.0, check='mtime',
+                max_upload_mb=100, latency_window=1000):
+    """[State of the ingest service]
+    Args:
+        people ([list]): [names of the folders in ../data whose activities.csv
+                          and activity files are watched]
+        n_workers (int, optional): [parse worker processes]. Defaults to None, one per core.
+        max_queue (int, optional): [activities waiting to be parsed before
+                                    the watcher waits and uploads are
+                                    refused]. Defaults to 100.
+        poll_interval (float, optional): [seconds between scans of the watched
+                                          folders, 0 to not watch]. Defaults to 5.0.
+        check (str, optional): [see pipeline_to_parquet.file_signature]. Defaults to 'mtime'.
+        max_upload_mb (int, optional): [largest upload accepted]. Defaults to 100.
+        latency_window (int, optional): [latencies kept for the
+                                         percentiles]. Defaults to 1000.
+    Returns:
+        [dictionary]: [service state]
+    """
+    return {'people': list(people), 'n_workers': n_workers or os.cpu_count(), 'max_queue': max_queue,
+            'poll_interval': poll_interval, 'check': check, 'max_upload_mb': max_upload_mb,
+            'queue': None, 'results': None, 'manifests': {}, 'pending': {}, 'in_flight': 0,
+            'counts': {'queued': 0, 'committed': 0, 'failed': 0, 'refused': 0, 'commits': 0},
+            'waits': deque(maxlen=latency_window), 'latencies': deque(maxlen=latency_window),
+            'started': time.time()}
+
+def manifest(service, person):
+    """[The manifest of a person, read once and then kept by the service,
+        which is its only writer while it runs]
+    Args:
+        service ([dictionary]): [see new_service]
+        person ([string]): [The name of the folder in ../data]
+    Returns:
+        [dictionary]: [see pipeline_to_parquet.read_manifest]
+    """
+    if person not in service['manifests']:
+        service['manifests'][person] = pipeline_to_parquet.read_manifest(person)
+    return service['manifests'][person]
+
+async def enqueue(service, job, wait=True):
+    """[Puts an activity on the bounded queue, waiting while it is full]
+    Args:
+        service ([dictionary]): [see new_service]
+        job ([dictionary]): [person, action (parse or delete), activity_id and
+                             for parse the activity record from get_activities]
+        wait (bool, optional): [wait for room, otherwise raise
+                                asyncio.QueueFull if the queue is full]. Defaults to True.
+    """
+    job['queued'] = time.monotonic()
+    service['pending'].setdefault(job['person'], set()).add(str(job['activity_id']))
+    if wait:
+        await service['queue'].put(job)
+    else:
+        service['queue'].put_nowait(job)
+    service['counts']['queued'] += 1
+
+async def watch(service):
+    """[Scans the watched folders for activities that are new, changed or
+        deleted since they were last committed and queues them. Activities
+        already queued are skipped, and while the queue is full the scan
+        waits, so a large export is taken in as fast as it can be parsed.]
+    Args:
+        service ([dictionary]): [see new_service]
+    """
+    while True:
+        for person in service['people']:
+            try:
+                act_df = await asyncio.to_thread(pipeline_to_parquet.get_activities, person)
+                new, changed, deleted = await asyncio.to_thread(pipeline_to_parquet.activity_changes, act_df,
+                                                                copy.deepcopy(manifest(service, person)),
+                                                                service['check'])
+            except Exception as e:
+                instrument.record_failure('watch', repr(e), person=person)
+                continue
+            pending = service['pending'].get(person, set())
+            for t in new + changed:
+                if str(t['activity_id']) not in pending and t['exists']:
+                    await enqueue(service, {'person': person, 'action': 'parse',
+                                            'activity_id': t['activity_id'], 'activity': t})
+            for activity_id in deleted:
+                if activity_id not in pending:
+                    await enqueue(service, {'person': person, 'action': 'delete', 'activity_id': activity_id})
+        await asyncio.sleep(service['poll_interval'])
+
+async def parse_worker(service, executor):
+    """[Takes activities off the queue and parses each to its parquet part on
+        the process pool. One job per worker is in the pool at a time, so
+        parsing, not the pool's own queue, sets how fast the queue drains.]
+    Args:
+        service ([dictionary]): [see new_service]
+        executor ([ProcessPoolExecutor]): [pool parse_to_part runs on]
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        job = await service['queue'].get()
+        job['started'] = time.monotonic()
+        service['waits'].append(job['started'] - job['queued'])
+        if job['action'] == 'parse':
+            service['in_flight'] += 1
+            t = job['activity']
+            try:
+                job['result'] = await loop.run_in_executor(executor, pipeline_to_parquet.parse_to_part, t['filename'],
+                                                           t['activity_id'], job['person'], service['check'])
+            except Exception as e:
+                job['error'] = repr(e)
+            finally:
+                service['in_flight'] -= 1
+        await service['results'].put(job)
+        service['queue'].task_done()
+
+def write_commit(person, snapshot, partitions):
+    """[Rewrites the partitions touched by a commit, then the manifest. Each
+        partition and the manifest is replaced in a rename, so a reader sees a
+        partition either before or after the commit.]
+    Args:
+        person ([string]): [The name of the folder in ../data]
+        snapshot ([dictionary]): [manifest after the commit]
+        partitions ([list]): [year, month partitions to rewrite]
+    """
+    pipeline_to_parquet.write_partitions(person, snapshot, partitions)
+    pipeline_to_parquet.write_manifest(person, snapshot)
+
+def refresh_derived(person, invalidated):
+    """[Brings the simplified tracks and the cluster model of a person up to
+        date after a commit]
+    Args:
+        person ([string]): [The name of the folder in ../data]
+        invalidated ([list]): [activities whose simplified tracks are dropped]
+    """
+    simplify.invalidate_tracks(person, invalidated)
+    peak.refresh_cluster_model(person)
+
+async def commit(service, person, jobs):
+    """[Applies parsed and deleted activities of a person to a copy of the
+        manifest and writes the partitions they touch in one commit. The
+        service's manifest is replaced by the copy, and the parts it no
+        longer points at deleted, only once the commit is written, so a
+        failed commit leaves both as they were for the jobs to be retried.]
+    Args:
+        service ([dictionary]): [see new_service]
+        person ([string]): [The name of the folder in ../data]
+        jobs ([list]): [finished jobs, see parse_worker]
+    """
+    before = manifest(service, person)
+    person_manifest = copy.deepcopy(before)
+    partitions, invalidated, failed = [], [], 0
+    for job in jobs:
+        activity_id = str(job['activity_id'])
+        if job['action'] == 'delete':
+            partition = pipeline_to_parquet.drop_activity(person_manifest, activity_id)
+        elif 'error' in job:
+            pipeline_to_parquet.record_part_failure(person_manifest, job['activity'], job['error'], service['check'])
+            failed += 1
+            continue
+        else:
+            partition = person_manifest['partitions'].get(activity_id)
+            partitions.append(pipeline_to_parquet.record_part(person_manifest, job['activity'], *job['result']))
+        if partition is not None:
+            partitions.append(partition)
+        invalidated.append(job['activity_id'])
+    try:
+        with instrument.stage('commit', person=person) as info:
+            info['rows'] = len(jobs)
+            await asyncio.to_thread(write_commit, person, person_manifest, partitions)
+    except Exception:
+        # the parts parsed for this commit are not in the service's manifest
+        await asyncio.to_thread(pipeline_to_parquet.remove_parts, person, person_manifest, before)
+        raise
+    service['manifests'][person] = person_manifest
+    await asyncio.to_thread(pipeline_to_parquet.remove_parts, person, before, person_manifest)
+    done = time.monotonic()
+    for job in jobs:
+        service['latencies'].append(done - job['queued'])
+        service['pending'].get(person, set()).discard(str(job['activity_id']))
+    service['counts']['failed'] += failed
+    service['counts']['committed'] += len(jobs)
+    service['counts']['commits'] += 1
+    instrument.emit({'event': 'ingest_commit', 'person': person, 'activities': len(jobs),
+                     'latency_max': max(done - job['queued'] for job in jobs)})
+    await asyncio.to_thread(refresh_derived, person, invalidated)
+
+async def committer(service):
+    """[Commits finished activities. Whatever has finished by the time the
+        previous commit is written goes into the next one, so commits are
+        small and quick when uploads trickle in and batch up under load.]
+    Args:
+        service ([dictionary]): [see new_service]
+    """
+    while True:
+        jobs = [await service['results'].get()]
+        while not service['results'].empty():
+            jobs.append(service['results'].get_nowait())
+        by_person = {}
+        for job in jobs:
+            by_person.setdefault(job['person'], []).append(job)
+        for person, person_jobs in by_person.items():
+            try:
+                await commit(service, person, person_jobs)
+            except Exception as e:
+                instrument.record_failure('commit', repr(e), person=person)
+                for job in person_jobs:
+                    service['pending'].get(person, set()).discard(str(job['activity_id']))
+
+def percentiles(values):
+    """[Percentiles of the latencies kept]
+    Args:
+        values ([iterable]): [latencies in seconds]
+    Returns:
+        [dictionary]: [p50, p95 and p99, None if there are none yet]
+    """
+    values = np.asarray(values)
+    if len(values) == 0:
+        return {'p50': None, 'p95': None, 'p99': None}
+    return {f'p{q}': float(np.percentile(values, q)) for q in (50, 95, 99)}
+
+def status(service):
+    """[Queue depth, progress and latency of the service]
+    Args:
+        service ([dictionary]): [see new_service]
+    Returns:
+        [dictionary]: [queue_depth, parsing, awaiting_commit, counts,
+                       queue_wait and latency percentiles (seconds from
+                       queued to parse started and to committed),
+                       uptime and the stage totals]
+    """
+    return {'queue_depth': service['queue'].qsize(), 'max_queue': service['max_queue'],
+            'parsing': service['in_flight'], 'awaiting_commit': service['results'].qsize(),
+            'counts': dict(service['counts']), 'queue_wait': percentiles(service['waits']),
+            'latency': percentiles(service['latencies']), 'uptime': time.time() - service['started'],
+            'stages': instrument.STATE['stages']}
+
+async def report(service, interval=60):
+    """[Emits the status every interval, for the pipeline log]
+    Args:
+        service ([dictionary]): [see new_service]
+        interval (int, optional): [seconds between reports]. Defaults to 60.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        event = status(service)
+        event.pop('stages')
+        instrument.emit(dict(event, event='ingest_status'))
+
+def upload_date(value):
+    """[Start of an uploaded activity, which picks its partition]
+    Args:
+        value ([string]): [ISO 8601 date, naive ones are taken as UTC, None for now]
+    Returns:
+        [timestamp]: [naive UTC timestamp]
+    """
+    date = pd.Timestamp(value) if value else pd.Timestamp.now(tz='UTC')
+    return date.tz_convert('UTC').tz_localize(None) if date.tzinfo is not None else date
+
+def save_upload(person, activity_id, activity_date, name, body):
+    """[Writes an uploaded activity file to the person's activities folder
+        and adds it to activities.csv, so batch ingests keep it too]
+    Args:
+        person ([string]): [The name of the folder in ../data]
+        activity_id ([int]): [id of the activity]
+        activity_date ([timestamp]): [start of the activity]
+        name ([string]): [uploaded file name, its extension picks the parser]
+        body ([bytes]): [file contents]
+    Returns:
+        [dictionary]: [activity record, as get_activities returns]
+    """
+    kind = pipeline_to_parquet.file_format(name)
+    relative = f'activities/{activity_id}.{kind}'
+    filename = pipeline_to_parquet.full_path(person, relative)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(f'{filename}.tmp', 'wb') as f:
+        f.write(body)
+    os.replace(f'{filename}.tmp', filename)
+    pipeline_to_parquet.add_activity(person, activity_id, activity_date, relative)
+    return {'activity_id': activity_id, 'activity_date': activity_date, 'filename': filename, 'exists': True}
+
+async def upload(service, query, body):
+    """[Handles POST /activities?person=...&activity_id=...&name=...&date=...
+        with the activity file as the body. Refused with 503 while the queue
+        is full, so clients back off rather than the service buffering
+        uploads it cannot parse yet. If the queue filled up while the file
+        was saved it is still refused, and the watcher takes the saved file
+        in once there is room.]
+    Args:
+        service ([dictionary]): [see new_service]
+        query ([dictionary]): [query parameters]
+        body ([bytes]): [activity file]
+    Returns:
+        [tuple]: [HTTP status and response dictionary]
+    """
+    person = query.get('person')
+    if person not in service['people']:
+        return 404, {'error': f'unknown person {person}'}
+    try:
+        activity_id = int(query['activity_id'])
+        activity_date = upload_date(query.get('date'))
+    except (KeyError, ValueError) as e:
+        return 400, {'error': f'activity_id and an optional ISO date are needed: {e!r}'}
+    name = query.get('name', '')
+    if pipeline_to_parquet.file_format(name) is None:
+        return 400, {'error': 'name must end in .fit.gz, .gpx or .gpx.gz'}
+    if service['queue'].full():
+        service['counts']['refused'] += 1
+        return 503, {'error': 'queue full', 'queue_depth': service['queue'].qsize()}
+    pending = service['pending'].setdefault(person, set())
+    if str(activity_id) in pending:
+        return 503, {'error': 'activity is already being ingested', 'activity_id': activity_id}
+    pending.add(str(activity_id))
+    try:
+        t = await asyncio.to_thread(save_upload, person, activity_id, activity_date, name, body)
+        await enqueue(service, {'person': person, 'action': 'parse', 'activity_id': activity_id, 'activity': t},
+                      wait=False)
+    except asyncio.QueueFull:
+        pending.discard(str(activity_id))
+        service['counts']['refused'] += 1
+        return 503, {'error': 'queue full', 'queue_depth': service['queue'].qsize()}
+    except Exception:
+        pending.discard(str(activity_id))
+        raise
+    return 202, {'activity_id': activity_id, 'queue_depth': service['queue'].qsize()}
+
+async def handle_connection(service, reader, writer):
+    """[Serves one HTTP/1.1 request: POST /activities to upload, see upload,
+        and GET /status, see status. Any other error is recorded and answered
+        with 500, so the client always gets a response.]
+    Args:
+        service ([dictionary]): [see new_service]
+        reader ([asyncio.StreamReader]): [request]
+        writer ([asyncio.StreamWriter]): [response]
+    """
+    try:
+        method, target, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+        headers = {}
+        while (line := (await reader.readline()).decode('latin-1').strip()):
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+        url = urlsplit(target)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        length = int(headers.get('content-length', 0))
+        if url.path == '/status' and method == 'GET':
+            code, response = 200, status(service)
+        elif url.path == '/activities' and method == 'POST':
+            if length > service['max_upload_mb'] * 1e6:
+                code, response = 413, {'error': 'upload too large'}
+            else:
+                code, response = await upload(service, query, await reader.readexactly(length))
+        elif url.path in ('/status', '/activities'):
+            code, response = 405, {'error': f'{method} not allowed'}
+        else:
+            code, response = 404, {'error': f'no route {url.path}'}
+    except (ValueError, asyncio.IncompleteReadError) as e:
+        code, response = 400, {'error': repr(e)}
+    except Exception as e:
+        instrument.record_failure('handle_connection', repr(e))
+        code, response = 500, {'error': repr(e)}
+    body = json.dumps(response, default=str).encode()
+    writer.write(f'HTTP/1.1 {code} {STATUS_TEXT[code]}\r\nContent-Type: application/json\r\n'
+                 f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+    try:
+        await writer.drain()
+    finally:
+        writer.close()
+
+async def run_service(service, host='127.0.0.1', port=8765, report_interval=60):
+    """[Runs the ingest service until cancelled: the folder watcher, one
+        parse worker per process, the committer, the status reports and the
+        HTTP endpoint]
+    Args:
+        service ([dictionary]): [see new_service]
+        host (str, optional): [address to listen on]. Defaults to '127.0.0.1'.
+        port (int, optional): [port to listen on, None for no HTTP endpoint]. Defaults to 8765.
+        report_interval (int, optional): [seconds between status reports]. Defaults to 60.
+    """
+    service['queue'] = asyncio.Queue(maxsize=service['max_queue'])
+    service['results'] = asyncio.Queue()
+    for person in service['people']:
+        os.makedirs(f'../data/{person}/parts', exist_ok=True)
+    with ProcessPoolExecutor(max_workers=service['n_workers']) as executor:
+        tasks = [asyncio.create_task(parse_worker(service, executor)) for _ in range(service['n_workers'])]
+        tasks += [asyncio.create_task(committer(service)), asyncio.create_task(report(service, report_interval))]
+        if service['poll_interval']:
+            tasks.append(asyncio.create_task(watch(service)))
+        server = None
+        if port is not None:
+            server = await asyncio.start_server(lambda r, w: handle_connection(service, r, w), host, port)
+            print(f'Ingest service listening on http://{host}:{port}')
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            if server is not None:
+                server.close()
+            for task in tasks:
+                task.cancel()
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(run_service(new_service(['Example_Strava'])))
+    except KeyboardInterrupt:
+        pass
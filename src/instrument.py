@@ -0,0 +1,263 @@
+from collections import deque
+from contextlib import contextmanager
+import cProfile
+import json
+import logging
+import os
+import time
+import tracemalloc
+
+logger = logging.getLogger('pipeline')
+
+GROUP_FIELDS = ('format', 'device')
+
+KEEP_FAILURES = int(os.environ.get('PIPELINE_KEEP_FAILURES', 1000))
+
+STATE = {'sinks': [], 'stages': {}, 'groups': {}, 'failures': deque(maxlen=KEEP_FAILURES), 'slowest': [],
+         'active': [], 'capturing': False, 'profile': os.environ.get('PIPELINE_PROFILE') == '1',
+         'trace_memory': os.environ.get('PIPELINE_TRACEMALLOC') == '1',
+         'keep_slowest': int(os.environ.get('PIPELINE_KEEP_SLOWEST', 5)),
+         'profile_dir': os.environ.get('PIPELINE_PROFILE_DIR', '../data/profiles')}
+
+def configure(log_file=None, profile=None, trace_memory=None, keep_slowest=None, profile_dir=None):
+    """[Turns on the optional outputs. Settings are also put in the
+        environment so worker processes started afterwards use them too.]
+    Args:
+        log_file ([string], optional): [append every event to this JSON lines file]. Defaults to None.
+        profile ([bool], optional): [cProfile the stages that ask for it and
+                                     keep the profiles of the slowest]. Defaults to None, unchanged.
+        trace_memory ([bool], optional): [measure the peak Python allocations of
+                                          those stages with tracemalloc]. Defaults to None, unchanged.
+        keep_slowest ([int], optional): [number of slowest captures to keep]. Defaults to None, unchanged.
+        profile_dir ([string], optional): [where captures are written]. Defaults to None, unchanged.
+    """
+    settings = {'profile': ('PIPELINE_PROFILE', profile), 'trace_memory': ('PIPELINE_TRACEMALLOC', trace_memory),
+                'keep_slowest': ('PIPELINE_KEEP_SLOWEST', keep_slowest),
+                'profile_dir': ('PIPELINE_PROFILE_DIR', profile_dir)}
+    for key, (variable, value) in settings.items():
+        if value is not None:
+            STATE[key] = value
+            os.environ[variable] = str(int(value) if isinstance(value, bool) else value)
+    if log_file is not None:
+        os.environ['PIPELINE_LOG'] = log_file
+        add_sink(json_lines_sink(log_file))
+
+def json_lines_sink(filename):
+    """[Sink appending each event to a JSON lines file. Each event is one
+        short append, so several processes can share the file.]
+    Args:
+        filename ([string]): [log file]
+    Returns:
+        [function]: [sink]
+    """
+    def sink(event):
+        with open(filename, 'a') as f:
+            f.write(json.dumps(event, default=str) + '\n')
+    sink.filename = filename
+    return sink
+
+def add_sink(sink):
+    """[Sends every event to sink as well as the pipeline logger]
+    Args:
+        sink ([function]): [called with each event dictionary]
+    """
+    filenames = [getattr(s, 'filename', None) for s in STATE['sinks']]
+    if getattr(sink, 'filename', None) is None or sink.filename not in filenames:
+        STATE['sinks'].append(sink)
+
+if os.environ.get('PIPELINE_LOG'):
+    add_sink(json_lines_sink(os.environ['PIPELINE_LOG']))
+
+def emit(event):
+    """[Sends a structured event to the pipeline logger and every sink]
+    Args:
+        event ([dictionary]): [event fields]
+    """
+    event = dict(event, time=time.time(), pid=os.getpid())
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps(event, default=str))
+    for sink in STATE['sinks']:
+        sink(event)
+
+def annotate(**fields):
+    """[Adds fields to the innermost running stage, e.g. the device a parser
+        finds in a file is reported by the parse and not by the stages that
+        contain it]
+    Args:
+        fields: [fields to add]
+    """
+    if STATE['active']:
+        STATE['active'][-1].update(fields)
+
+def add_totals(totals, seconds, info, failed):
+    """[Adds a stage run to running totals]
+    Args:
+        totals ([dictionary]): [count, failed, seconds, max_seconds, rows and bytes, updated in place]
+        seconds ([float]): [wall seconds of the run]
+        info ([dictionary]): [fields of the run]
+        failed ([bool]): [whether it raised]
+    """
+    totals['count'] = totals.get('count', 0) + 1
+    totals['failed'] = totals.get('failed', 0) + int(failed)
+    totals['seconds'] = totals.get('seconds', 0) + seconds
+    totals['max_seconds'] = max(totals.get('max_seconds', 0), seconds)
+    for key in ['rows', 'bytes']:
+        totals[key] = totals.get(key, 0) + int(info.get(key) or 0)
+
+def keep_capture(name, info, seconds, profiler, snapshot):
+    """[Writes the profile and allocation statistics of one of the
+        keep_slowest slowest runs so far, removing the capture it displaces]
+    Args:
+        name ([string]): [stage name]
+        info ([dictionary]): [fields of the run]
+        seconds ([float]): [wall seconds of the run]
+        profiler ([cProfile.Profile]): [profile of the run, or None]
+        snapshot ([tracemalloc.Snapshot]): [allocations at the run's end, or None]
+    """
+    slowest = STATE['slowest']
+    os.makedirs(STATE['profile_dir'], exist_ok=True)
+    key = info.get('activity_id', info.get('filename', len(slowest)))
+    base = os.path.join(STATE['profile_dir'], f'{name}-{os.path.basename(str(key))}')
+    files = []
+    if profiler is not None:
+        profiler.dump_stats(f'{base}.prof')
+        files.append(f'{base}.prof')
+    if snapshot is not None:
+        with open(f'{base}.alloc.txt', 'w') as f:
+            f.writelines(f'{stat}\n' for stat in snapshot.statistics('lineno')[:25])
+        files.append(f'{base}.alloc.txt')
+    slowest.append({'stage': name, 'seconds': seconds, 'key': str(key), 'files': files})
+    trim_slowest()
+
+def trim_slowest():
+    """[Keeps the keep_slowest slowest captures, deleting the files of the rest]"""
+    slowest = STATE['slowest']
+    slowest.sort(key=lambda capture: -capture['seconds'])
+    for capture in slowest[STATE['keep_slowest']:]:
+        for filename in capture['files']:
+            if os.path.exists(filename):
+                os.remove(filename)
+    del slowest[STATE['keep_slowest']:]
+
+@contextmanager
+def stage(name, profile=False, **fields):
+    """[Times a stage of the pipeline. The caller can set rows and bytes on
+        the yielded dictionary. A structured event is emitted when the stage
+        ends and its totals are kept for write_metrics. A stage that raises
+        is counted as failed, with the exception as the reason in its event,
+        and re-raised for the caller to handle and record_failure. Stages
+        run with profile=True are captured with cProfile and tracemalloc
+        when those are configured, unless they run inside a stage that is
+        already being captured.]
+    Args:
+        name ([string]): [stage name]
+        profile (bool, optional): [whether this stage may be profiled, e.g.
+                                   a single file parse]. Defaults to False.
+        fields: [fields to report with the stage, e.g. activity_id]
+    Yields:
+        [dictionary]: [fields of the run]
+    """
+    info = dict(fields)
+    capture = profile and not STATE['capturing']
+    profiler = cProfile.Profile() if capture and STATE['profile'] else None
+    trace = capture and STATE['trace_memory']
+    STATE['capturing'] = STATE['capturing'] or capture
+    if trace:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+    STATE['active'].append(info)
+    failed = None
+    start, cpu_start = time.perf_counter(), time.process_time()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield info
+    except BaseException as e:
+        failed = e
+        raise
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        seconds, cpu_seconds = time.perf_counter() - start, time.process_time() - cpu_start
+        STATE['active'].pop()
+        if capture:
+            STATE['capturing'] = False
+        slowest = STATE['slowest']
+        slow = STATE['keep_slowest'] > 0 and (len(slowest) < STATE['keep_slowest'] or
+                                              seconds > slowest[-1]['seconds'])
+        snapshot = None
+        if trace:
+            info['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / 1e6
+            snapshot = tracemalloc.take_snapshot() if slow else None
+        add_totals(STATE['stages'].setdefault(name, {}), seconds, info, failed is not None)
+        for field in GROUP_FIELDS:
+            if info.get(field) is not None:
+                add_totals(STATE['groups'].setdefault(name, {}).setdefault(f'{field}={info[field]}', {}),
+                           seconds, info, failed is not None)
+        event = dict(info, event='stage', stage=name, seconds=seconds, cpu_seconds=cpu_seconds,
+                     status='ok' if failed is None else 'failed')
+        if failed is not None:
+            event['reason'] = repr(failed)
+        emit(event)
+        if slow and (profiler is not None or snapshot is not None):
+            keep_capture(name, info, seconds, profiler, snapshot)
+
+def record_failure(name, reason, **fields):
+    """[Records a failure that was handled, e.g. a file that could not be
+        parsed. Only the last KEEP_FAILURES are kept for the metrics, every
+        one is emitted]
+    Args:
+        name ([string]): [stage or function where it failed]
+        reason ([string]): [why it failed]
+        fields: [fields identifying what failed, e.g. filename]
+    """
+    STATE['failures'].append(dict(fields, stage=name, reason=reason))
+    emit(dict(fields, event='failure', stage=name, reason=reason))
+
+def take_metrics():
+    """[Returns and clears the totals collected in this process, for a
+        worker to hand its metrics back to the parent]
+    Returns:
+        [dictionary]: [stages, groups, failures and slowest captures]
+    """
+    metrics = {key: STATE[key] for key in ['stages', 'groups', 'slowest']}
+    metrics['failures'] = list(STATE['failures'])
+    STATE.update(stages={}, groups={}, failures=deque(maxlen=KEEP_FAILURES), slowest=[])
+    return metrics
+
+def merge_totals(into, totals):
+    """[Adds totals to totals]
+    Args:
+        into ([dictionary]): [totals, updated in place]
+        totals ([dictionary]): [totals to add]
+    """
+    for key, value in totals.items():
+        into[key] = max(into.get(key, 0), value) if key == 'max_seconds' else into.get(key, 0) + value
+
+def merge(metrics):
+    """[Adds the metrics of a worker to this process's]
+    Args:
+        metrics ([dictionary]): [see output of take_metrics]
+    """
+    for name, totals in metrics['stages'].items():
+        merge_totals(STATE['stages'].setdefault(name, {}), totals)
+    for name, groups in metrics['groups'].items():
+        for group, totals in groups.items():
+            merge_totals(STATE['groups'].setdefault(name, {}).setdefault(group, {}), totals)
+    STATE['failures'].extend(metrics['failures'])
+    STATE['slowest'].extend(metrics['slowest'])
+    trim_slowest()
+
+def write_metrics(filename):
+    """[Writes the totals of every stage, broken down by file format and
+        device where known, the failures and the slowest captures]
+    Args:
+        filename ([string]): [metrics file, replaced atomically]
+    """
+    metrics = {key: STATE[key] for key in ['stages', 'groups', 'slowest']}
+    metrics['failures'] = list(STATE['failures'])
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    with open(f'{filename}.tmp', 'w') as f:
+        json.dump(metrics, f, indent=1, default=str)
+    os.replace(f'{filename}.tmp', filename)
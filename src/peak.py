@@ -1,7 +1,14 @@
+import cluster_model
 import folium
+import geo
+import instrument
 import itertools
 import numpy as np
+import os
 import pandas as pd
+import simplify
+import tiles
+import track_store
 from sklearn.cluster import DBSCAN
 
 def max_altitude(act):
@@ -20,6 +27,24 @@ def max_altitude(act):
     highest_pt['gain'] = diff
     return highest_pt
 
+def activity_extremes(df):
+    """[Finds the highest point and the altitude range of every activity
+        with one groupby aggregation rather than a Python call per activity]
+    Args:
+        df ([pandas dataframe]): [activities df with activity_id and altitude columns]
+    Returns:
+        [pandas dataframe]: [one row per activity, indexed by activity_id,
+        holding the row where the highest point was acheived plus columns
+        min_altitude and gain, the difference between the highest and
+        lowest point]
+    """
+    with_alt = df.dropna(subset=['altitude']).reset_index(drop=True)
+    grouped = with_alt.groupby('activity_id')['altitude']
+    extremes = with_alt.loc[grouped.idxmax().values].set_index('activity_id', drop=False)
+    extremes['min_altitude'] = grouped.min()
+    extremes['gain'] = extremes['altitude'] - extremes['min_altitude']
+    return extremes
+
 def peak_detector(df, gain_threshold):
     """[Filters activities df retaining activities where the gain 
         in altitude is more than the specified threshold]
@@ -31,45 +56,100 @@ def peak_detector(df, gain_threshold):
         [pandas dataframe]: [df containing activities where the 
         altitude gain is great than the specified gain threshold]
     """
-    with_alt = df.dropna(subset=['altitude'])
-    peaks = with_alt.groupby('activity_id').apply(max_altitude)
+    peaks = activity_extremes(df)
     peaks = peaks[peaks['gain'] > gain_threshold]
     return peaks
 
-def plot_one_cluster(m, df, activities_ids, steps, color):
+def track_extremes(store, activity_ids=None):
+    """[activity_extremes on the track store: the highest and lowest altitude
+        of every activity are reduced over its slice of the altitude array,
+        so only the altitude column is read and no dataframe is built]
+    Args:
+        store ([dictionary]): [see track_store.load_track_store]
+        activity_ids ([list], optional): [activities to look at]. Defaults to None, all.
+    Returns:
+        [pandas dataframe]: [see activity_extremes]
+    """
+    altitude = store['columns']['altitude']
+    if activity_ids is None:
+        ids, offsets = store['activity_ids'], store['offsets']
+        starts, stops = offsets[:-1], offsets[1:]
+    else:
+        ids = np.array([int(a) for a in activity_ids if int(a) in store['slices']], dtype=np.int64)
+        bounds = np.array([store['slices'][a] for a in ids], dtype=np.int64).reshape(-1, 2)
+        starts, stops = bounds[:, 0], bounds[:, 1]
+    nonempty = stops > starts
+    ids, starts, stops = ids[nonempty], starts[nonempty], stops[nonempty]
+    sizes = stops - starts
+    if activity_ids is None:
+        values, rows = altitude, np.arange(0)
+    else:
+        rows = np.concatenate([np.arange(start, stop) for start, stop in zip(starts, stops)] + [np.arange(0)])
+        values = altitude[rows]
+    local_starts = np.r_[0, np.cumsum(sizes)[:-1]].astype(np.int64)
+    highest = np.fmax.reduceat(values, local_starts) if len(ids) else np.empty(0, dtype=altitude.dtype)
+    lowest = np.fmin.reduceat(values, local_starts) if len(ids) else np.empty(0, dtype=altitude.dtype)
+    segment = np.repeat(np.arange(len(ids)), sizes)
+    hits = np.flatnonzero(np.asarray(values) == highest[segment])
+    first = hits[np.r_[True, segment[hits][1:] != segment[hits][:-1]]] if len(hits) else hits
+    found = segment[first]
+    index = first if activity_ids is None else rows[first]
+    columns = store['columns']
+    extremes = pd.DataFrame({'activity_id': ids[found], 'position_lat': columns['position_lat'][index],
+                             'position_long': columns['position_long'][index], 'altitude': highest[found],
+                             'min_altitude': lowest[found]}).set_index('activity_id', drop=False)
+    extremes['gain'] = extremes['altitude'] - extremes['min_altitude']
+    return extremes
+
+def detect_peaks(store, gain_threshold, activity_ids=None):
+    """[peak_detector on the track store]
+    Args:
+        store ([dictionary]): [see track_store.load_track_store]
+        gain_threshold ([float]): [see peak_detector]
+        activity_ids ([list], optional): [activities to look at]. Defaults to None, all.
+    Returns:
+        [pandas dataframe]: [see peak_detector]
+    """
+    peaks = track_extremes(store, activity_ids)
+    return peaks[peaks['gain'] > gain_threshold]
+
+def plot_one_cluster(m, tracks, activities_ids, color):
     """[Adds plots lat/long position for each activity 
-        in the list of activities_ids to a folium map]
+        in the list of activities_ids to a folium map, as one GeoJSON
+        multi-line so the map holds one element per cluster and folium
+        does not validate every point]
     Args:
         m ([folium map object]): [a folium map object where the plot]
-        df ([pandas dataframe]): [df with colums position_lat, position_long, and activity_id]
+        tracks ([dictionary]): [activity_id to simplified lat/long, see simplify.simplified_tracks]
         activities_ids ([list]): [list of activity_id for which you wish to plot the path taken]
-        steps ([int]): [plots every steps-th lat/long]
     """
-    for activity_id in activities_ids:
-        locations = df.query(f'activity_id=={activity_id}')[['position_lat', 'position_long']].iloc[::steps]
-        locations.dropna(inplace=True)
-        points = locations.values.tolist()
-        folium.PolyLine(points, color=color, weight=2.5, opacity=0.5).add_to(m)
+    lines = [simplify.to_locations(tracks[activity_id][:, ::-1]) for activity_id in activities_ids]
+    lines = [line for line in lines if len(line) > 1]
+    if lines:
+        style = {'color': color, 'weight': 2.5, 'opacity': 0.5}
+        folium.GeoJson({'type': 'Feature', 'properties': {},
+                        'geometry': {'type': 'MultiLineString', 'coordinates': lines}},
+                       style_function=lambda feature: style).add_to(m)
 
-def plot_multiple_clusters(df, peaks, colormap, cluster_series, steps):   
+def plot_multiple_clusters(tracks, peaks, colormap, cluster_series, tiles='Stamen Terrain'):
     """[Plots multiple clusters of peaks on a folium map]
     Args:
-        df ([pandas dataframe]): [df with colums position_lat, position_long, and activity_id]
+        tracks ([dictionary]): [activity_id to simplified lat/long, see simplify.simplified_tracks]
         peaks ([pandas dataframe]): [df with peaks lat/long]
         colormap ([array]): [array of colors to use]
         cluster_series ([type]): [description]
-        steps ([int]): [plots every steps-th lat/long]
+        tiles (str, optional): [folium tile layer, None for no base map]. Defaults to 'Stamen Terrain'.
     Returns:
         [folium map object]: [folium map object]
     """
-    central_lat, central_long = peaks.query(f'cluster=={cluster_series.idxmax()}')[['position_lat', 'position_long']].mean()
-    n = len(list(cluster_series.index))
-    m = folium.Map(location=[central_lat, central_long],tiles='Stamen Terrain', zoom_start=12)
-    peak_positions = peaks.groupby('cluster')[['position_lat', 'position_long']].mean()
-    for i, val in enumerate(list(cluster_series.index)):
+    clustered = peaks[peaks['cluster'] != -1]
+    members = clustered.groupby('cluster').groups
+    peak_positions = clustered.groupby('cluster')[['position_lat', 'position_long']].mean()
+    central_lat, central_long = peak_positions.loc[cluster_series.idxmax()]
+    m = folium.Map(location=[central_lat, central_long],tiles=tiles, zoom_start=12)
+    for val in cluster_series.index:
         color = next(colormap)
-        activities_ids = list(peaks.query(f'cluster=={val}').index)
-        plot_one_cluster(m, df, activities_ids, steps, color)
+        plot_one_cluster(m, tracks, members[val], color)
         peak = peak_positions.loc[val]
         folium.CircleMarker(location=[peak['position_lat'], peak['position_long']],radius=10, color=color).add_to(m)
     return m
@@ -78,37 +158,185 @@ def peak_clustering(peaks, epsilon, min_samples=2):
     """[Clusters activities]
     Args:
         peaks ([pandas dataframe]): [df with peaks lat/long]
-        epsilon ([float]): [parameter for DBSCAN local radius for expanding clusters]
+        epsilon ([float]): [parameter for DBSCAN local radius for expanding clusters, in metres]
         min_samples (int, optional): [minimun number of samples for cluster]. Defaults to 2.
     Returns:
         [pandas series]: [index is cluster number, values are number of activities belonging to that cluster]
     """
-    clustering = DBSCAN(eps=epsilon, metric='haversine', min_samples=min_samples).fit(peaks[['position_lat', 'position_long']])
+    coords = np.radians(peaks[['position_lat', 'position_long']].values.astype(np.float64))
+    clustering = DBSCAN(eps=epsilon / geo.EARTH_RADIUS, metric='haversine', algorithm='ball_tree',
+                        min_samples=min_samples).fit(coords)
     peaks['cluster'] = clustering.labels_ 
     frequency = peaks['cluster'].value_counts().sort_values(ascending=False)
     cluster_series = frequency[frequency.index != -1]
     return cluster_series
 
-def save_cluster_plot(person, epsilon, colormap, filename, gain_threshold=400, steps=10):
-    """[Saves the clusterplot.]
+def part_signatures(person, activity_ids):
+    """[Size and modification time of the parquet part of each activity,
+        which changes whenever the activity is parsed again]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where activity files are.]
+        activity_ids ([list]): [activities to sign]
+    Returns:
+        [dictionary]: [activity_id -> [size, mtime], None for activities
+                       without a part, e.g. from pipeline_to_parquet.parquet_activities]
+    """
+    signatures = {}
+    for activity_id in activity_ids:
+        path = f'../data/{person}/parts/{activity_id}.parquet'
+        stat = os.stat(path) if os.path.exists(path) else None
+        signatures[int(activity_id)] = [stat.st_size, stat.st_mtime_ns] if stat else None
+    return signatures
+
+def update_cluster_model(person, epsilon, gain_threshold=400, min_samples=2, refit=False, filename=None,
+                         rebuild=False):
+    """[Brings the person's persistent cluster model up to date with the
+        dataset. Only the peaks of activities added since the last update, or
+        parsed again since (see part_signatures), are detected and assigned
+        to the existing clusters; removed and changed activities are dropped
+        first. The model is fitted from scratch the first time, when its
+        parameters change or on request, and reclustered when a removed
+        core peak may have split a cluster (see cluster_model.remove_peaks).]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where activity files are.]
+        epsilon ([float]): [parameter for DBSCAN local radius for expanding clusters, in metres]
+        gain_threshold (float, optional): [filter df keeping activities
+        where altitude gain more than this threshold]. Defaults to 400.
+        min_samples (int, optional): [minimun number of samples for cluster]. Defaults to 2.
+        refit (bool, optional): [recluster every peak from scratch, also done
+                                 whenever the model is dirty]. Defaults to False.
+        filename ([string], optional): [model file]. Defaults to ../data/{person}/cluster_model.pkl.
+        rebuild (bool, optional): [detect every peak again and fit from scratch]. Defaults to False.
+    Returns:
+        [dictionary]: [see cluster_model.fit_cluster_model]
+    """
+    filename = filename or f'../data/{person}/cluster_model.pkl'
+    store = track_store.update_track_store(person)
+    signatures = part_signatures(person, store['activity_ids'])
+    model = None if rebuild else cluster_model.load_cluster_model(filename)
+    if model is None or 'signatures' not in model or \
+            (model['epsilon'], model['min_samples'], model['gain_threshold']) != (epsilon, min_samples, gain_threshold):
+        peaks = detect_peaks(store, gain_threshold)
+        model = cluster_model.fit_cluster_model(peaks.dropna(subset=['position_lat', 'position_long']),
+                                                epsilon, min_samples)
+        model['gain_threshold'] = gain_threshold
+    else:
+        seen = model['signatures']
+        removed = [a for a in seen if a not in signatures]
+        changed = [a for a in signatures if a in seen and seen[a] != signatures[a]]
+        added = [a for a in signatures if a not in seen]
+        if removed or changed:
+            cluster_model.remove_peaks(model, removed + changed)
+        if added or changed:
+            peaks = detect_peaks(store, gain_threshold, sorted(added + changed))
+            cluster_model.assign_peaks(model, peaks.dropna(subset=['position_lat', 'position_long']))
+        if refit or model.get('dirty'):
+            model = cluster_model.refit_cluster_model(model)
+    model['signatures'] = signatures
+    cluster_model.save_cluster_model(model, filename)
+    return model
+
+def refresh_cluster_model(person, rebuild=False, filename=None):
+    """[Keeps an existing cluster model up to date after an ingest, with the
+        parameters it was fitted with, reclustering it if deletes or edits
+        left it dirty. Does nothing if there is no model yet.]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where activity files are.]
+        rebuild (bool, optional): [see update_cluster_model, for when the
+                                   whole dataset was rewritten]. Defaults to False.
+        filename ([string], optional): [model file]. Defaults to ../data/{person}/cluster_model.pkl.
+    Returns:
+        [dictionary]: [see cluster_model.fit_cluster_model, None if there is no model]
+    """
+    filename = filename or f'../data/{person}/cluster_model.pkl'
+    model = cluster_model.load_cluster_model(filename)
+    if model is None:
+        return None
+    return update_cluster_model(person, model['epsilon'], model['gain_threshold'], model['min_samples'],
+                                filename=filename, rebuild=rebuild)
+
+def save_cluster_tiles(person, peaks, colormap, cluster_series, directory, min_zoom=8, max_zoom=16):
+    """[Writes the cluster tracks and peak markers as GeoJSON tiles with a
+        map that only fetches the tiles in view. Each zoom level has its own
+        tracks, simplified to a pixel at that zoom.]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where activity files are.]
+        peaks ([pandas dataframe]): [df with peaks lat/long and cluster, indexed by activity_id]
+        colormap ([array]): [array of colors to use]
+        cluster_series ([pandas series]): [index is cluster number, values are
+        number of activities belonging to that cluster]
+        directory ([string]): [directory the tiles and index.html are written to]
+        min_zoom (int, optional): [lowest zoom level with tiles]. Defaults to 8.
+        max_zoom (int, optional): [highest zoom level with tiles]. Defaults to 16.
+    Returns:
+        [folium map object]: [folium map object]
+    """
+    clustered = peaks[peaks['cluster'] != -1]
+    peak_positions = clustered.groupby('cluster')[['position_lat', 'position_long']].mean()
+    colors = {cluster: next(colormap) for cluster in cluster_series.index}
+    layers = {'tracks': {}, 'peaks': {}}
+    for zoom in range(min_zoom, max_zoom + 1):
+        tracks = simplify.simplified_tracks(person, clustered.index, zoom=zoom)
+        track_tiles, peak_tiles = {}, {}
+        for activity_id, cluster in zip(clustered.index, clustered['cluster']):
+            style = {'color': colors[cluster], 'weight': 2.5, 'opacity': 0.5}
+            tiles.add_line(track_tiles, tracks[activity_id], zoom,
+                           {'activity_id': int(activity_id), 'cluster': int(cluster), 'style': style})
+        for cluster, count in cluster_series.items():
+            peak = peak_positions.loc[cluster]
+            tiles.add_point(peak_tiles, peak['position_lat'], peak['position_long'], zoom,
+                            {'cluster': int(cluster), 'popup': f'{count} summits',
+                             'style': {'color': colors[cluster], 'radius': 10}})
+        layers['tracks'][zoom] = tiles.write_layer(directory, 'tracks', zoom, track_tiles)
+        layers['peaks'][zoom] = tiles.write_layer(directory, 'peaks', zoom, peak_tiles)
+    central_lat, central_long = peak_positions.loc[cluster_series.idxmax()]
+    return tiles.save_tiled_map(directory, [central_lat, central_long], 12, layers)
+
+def save_cluster_plot(person, epsilon, colormap, filename, gain_threshold=400, detail_zoom=14, tolerance=None,
+                      refit=False, export='html', min_zoom=8, max_zoom=16):
+    """[Saves the clusterplot. Clusters come from the person's persistent
+        cluster model, so only newly uploaded activities are read and
+        assigned. Tracks of clustered activities are simplified to about a
+        pixel at detail_zoom, or to tolerance metres, and cached per activity.]
     Args:
         person ([string]): [The name of the folder in ../data 
         where activity files are.]
-        epsilon ([float]): [parameter for DBSCAN local radius for expanding clusters]
+        epsilon ([float]): [parameter for DBSCAN local radius for expanding clusters, in metres]
         colormap ([array]): [array of colors to use]
         filename ([string]): [name of the output file]
         gain_threshold (float, optional): [filter df keeping activities 
         where altitude gain more than this threshold]. Defaults to 400.
-        steps (int, optional): [plots every steps-th lat/long]. Defaults to 10.
+        detail_zoom (int, optional): [zoom level at which simplified tracks
+        are still accurate to a pixel]. Defaults to 14.
+        tolerance ([float], optional): [simplification tolerance in metres,
+        used instead of detail_zoom]. Defaults to None.
+        refit (bool, optional): [recluster every peak from scratch]. Defaults to False.
+        export (str, optional): [html for a single folium file in ../html, or
+        tiles for GeoJSON tiles and an index.html in ../html/{filename}, see
+        save_cluster_tiles]. Defaults to 'html'.
+        min_zoom (int, optional): [lowest zoom level with tiles]. Defaults to 8.
+        max_zoom (int, optional): [highest zoom level with tiles]. Defaults to 16.
     Returns:
         [pandas series]: [index is cluster number, values are number of activities belonging to that cluster]
     """
-    person_df = pd.read_parquet(f'../data/{person}/df.parquet')
-    peaks = peak_detector(person_df, gain_threshold)
-    peaks = peaks.dropna(subset=['position_lat', 'position_long'])
-    cluster_series = peak_clustering(peaks, epsilon)
-    m = plot_multiple_clusters(person_df, peaks, colormap, cluster_series, steps)
-    m.save(f'../html/{filename}.html')
+    with instrument.stage('update_cluster_model', person=person):
+        model = update_cluster_model(person, epsilon, gain_threshold, refit=refit)
+    peaks = cluster_model.cluster_peaks(model)
+    cluster_series = cluster_model.cluster_counts(model)
+    with instrument.stage('render_map', person=person, export=export) as info:
+        if export == 'tiles':
+            save_cluster_tiles(person, peaks, colormap, cluster_series, f'../html/{filename}', min_zoom, max_zoom)
+            return cluster_series
+        clustered = peaks.index[peaks['cluster'] != -1]
+        zoom = detail_zoom if tolerance is None else None
+        tracks = simplify.simplified_tracks(person, clustered, zoom=zoom, tolerance=tolerance)
+        info['rows'] = sum(len(track) for track in tracks.values())
+        m = plot_multiple_clusters(tracks, peaks, colormap, cluster_series)
+        m.save(f'../html/{filename}.html')
     return cluster_series
 
 if __name__ == '__main__':
@@ -117,7 +345,7 @@ if __name__ == '__main__':
             '#cab2d6','#6a3d9a','#ffff99','#b15928']
     colormap = itertools.cycle(colors)
     
-    epsilon = 0.001 
+    epsilon = 110
 
     person = 'Example_Strava'
     b = save_cluster_plot(person, epsilon, colormap, 'Example')
@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+import pickle
+from sklearn.cluster import DBSCAN
+from sklearn.neighbors import BallTree
+import geo
+import track_store
+from peak import detect_peaks
+
+def detect_all_peaks(people, gain_threshold=400):
+    """[Detects the peak of every activity with enough gain from each
+        person's track store, reading only its altitude column]
+    Args:
+        people ([list]): [names of the folders in ../data]
+        gain_threshold (float, optional): [see peak.peak_detector]. Defaults to 400.
+    Returns:
+        [pandas dataframe]: [peaks with person, activity_id, position_lat,
+                             position_long, altitude and gain]
+    """
+    peaks = []
+    for person in people:
+        store = track_store.update_track_store(person)
+        person_peaks = detect_peaks(store, gain_threshold).dropna(subset=['position_lat', 'position_long'])
+        person_peaks['person'] = person
+        peaks.append(person_peaks.reset_index(drop=True))
+    return pd.concat(peaks, ignore_index=True)
+
+def build_peak_index(peaks, leaf_size=40):
+    """[Builds a spatial index over peaks, stored in radians in a BallTree
+        with the haversine metric]
+    Args:
+        peaks ([pandas dataframe]): [see output of detect_all_peaks]
+        leaf_size (int, optional): [BallTree leaf size]. Defaults to 40.
+    Returns:
+        [dictionary]: [tree and the peaks in the order they are stored in it]
+    """
+    peaks = peaks.reset_index(drop=True)
+    coords = np.radians(peaks[['position_lat', 'position_long']].values.astype(np.float64))
+    return {'tree': BallTree(coords, leaf_size=leaf_size, metric='haversine'), 'peaks': peaks}
+
+def summits_near(index, lat, lon, radius):
+    """[Finds the peaks within a radius of a point]
+    Args:
+        index ([dictionary]): [see output of build_peak_index]
+        lat ([float]): [latitude in degrees]
+        lon ([float]): [longitude in degrees]
+        radius ([float]): [radius in metres]
+    Returns:
+        [pandas dataframe]: [peaks within the radius]
+    """
+    point = np.radians([[lat, lon]])
+    rows = index['tree'].query_radius(point, r=radius / geo.EARTH_RADIUS)[0]
+    return index['peaks'].iloc[np.sort(rows)]
+
+def count_summits_near(index, lat, lon, radius):
+    """[Counts how many times anyone summited within a radius of a point]
+    Args:
+        index ([dictionary]): [see output of build_peak_index]
+        lat ([float]): [latitude in degrees]
+        lon ([float]): [longitude in degrees]
+        radius ([float]): [radius in metres]
+    Returns:
+        [int]: [number of peaks within the radius]
+    """
+    point = np.radians([[lat, lon]])
+    return int(index['tree'].query_radius(point, r=radius / geo.EARTH_RADIUS, count_only=True)[0])
+
+def cluster_index(index, epsilon, min_samples=2):
+    """[Clusters the indexed peaks with DBSCAN, using a haversine ball tree
+        for the neighbour search so it scales to many athletes]
+    Args:
+        index ([dictionary]): [see output of build_peak_index]
+        epsilon ([float]): [DBSCAN radius for expanding clusters, in metres]
+        min_samples (int, optional): [minimun number of samples for cluster]. Defaults to 2.
+    Returns:
+        [pandas series]: [index is cluster number, values are number of
+                          activities belonging to that cluster. The cluster of
+                          each peak is stored in the index's peaks.]
+    """
+    coords = np.asarray(index['tree'].data)
+    clustering = DBSCAN(eps=epsilon / geo.EARTH_RADIUS, min_samples=min_samples,
+                        metric='haversine', algorithm='ball_tree').fit(coords)
+    index['peaks']['cluster'] = clustering.labels_
+    frequency = index['peaks']['cluster'].value_counts().sort_values(ascending=False)
+    return frequency[frequency.index != -1]
+
+def save_peak_index(index, filename):
+    """[Saves the peak index]
+    Args:
+        index ([dictionary]): [see output of build_peak_index]
+        filename ([string]): [output file]
+    """
+    with open(filename, 'wb') as f:
+        pickle.dump(index, f)
+
+def load_peak_index(filename):
+    """[Loads a saved peak index]
+    Args:
+        filename ([string]): [file written by save_peak_index]
+    Returns:
+        [dictionary]: [see output of build_peak_index]
+    """
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+if __name__ == '__main__':
+    index = build_peak_index(detect_all_peaks(['Example_Strava']))
+    print(cluster_index(index, epsilon=110))
+    save_peak_index(index, '../data/peak_index.pkl')
+    print(count_summits_near(index, 40.0149, -105.2927, radius=200))
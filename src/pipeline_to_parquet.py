@@ -1,8 +1,26 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import clean
+import copy
+import csv
+import dataset
 from fitparse import FitFile
+import fit_columnar
 import gpxpy
 import gzip
+import hashlib
+import instrument
+import io
+import json
+import numpy as np
 import os
 import pandas as pd
+import peak
+import pyarrow as pa
+import pyarrow.parquet as pq
+import simplify
+import sys
+import uuid
+from xml.etree import ElementTree
 
 def semicir_to_degs(semicirc):
     """[Converts from semicircle to degrees]
@@ -30,6 +48,34 @@ def parse_fit(handle):
         return df
     except Exception as e:
         print(f'Issue reading fit file {handle}')
+        instrument.annotate(error=repr(e))
+
+def parse_fit_columnar(handle):
+    """[Parses fit files decoding each field of the record messages straight
+       into a typed numpy array instead of building a dictionary per record.
+       Falls back to parse_fit for files using fit features the columnar
+       decoder does not cover.]
+    Args:
+        handle: [the handle of the file to be parsed]
+    Returns:
+        [pandas dataframe]: [same columns as parse_fit, with semicircle
+                              lat/long converted to degrees in one step]
+    """
+    try:
+        data = handle.read()
+        try:
+            df = pd.DataFrame(fit_columnar.record_columns(data))
+            device = fit_columnar.device_info(data)
+        except NotImplementedError:
+            return parse_fit(io.BytesIO(data))
+        if device:
+            instrument.annotate(device=f"{device.get('manufacturer')}/{device.get('product')}")
+        df['position_lat'] = semicir_to_degs(df['position_lat'])
+        df['position_long'] = semicir_to_degs(df['position_long'])
+        return df
+    except Exception as e:
+        print(f'Issue reading fit file {handle}')
+        instrument.annotate(error=repr(e))
 
 def parse_gpx(handle):
     """[Parses gpx files]
@@ -48,24 +94,120 @@ def parse_gpx(handle):
     df = pd.DataFrame(track_coords, columns=['timestamp', 'position_lat', 'position_long', 'altitude'])
     return df
 
+def gpx_chunk(times, lats, longs, eles):
+    """[Builds a columnar chunk of gpx track points]
+    Args:
+        times ([list]): [time strings of the points]
+        lats ([list]): [latitudes of the points]
+        longs ([list]): [longitudes of the points]
+        eles ([list]): [elevation strings of the points, None if missing]
+    Returns:
+        [pandas dataframe]: [dataframe with columns of timestamp, position_lat
+                            position_long(in degrees), 'altitude']
+    """
+    return pd.DataFrame({'timestamp': dataset.to_timestamps(times).values,
+                         'position_lat': np.array(lats, dtype=np.float64),
+                         'position_long': np.array(longs, dtype=np.float64),
+                         'altitude': np.array(eles, dtype=np.float64)})
+
+def iter_gpx_chunks(handle, chunk_size=100000):
+    """[Streams the track points of a gpx file in fixed size chunks,
+       parsing the xml incrementally and discarding each point once read
+       so memory does not grow with the length of the track]
+    Args:
+        handle: [the handle of the file to be parsed]
+        chunk_size (int, optional): [number of points per chunk]. Defaults to 100000.
+    Yields:
+        [pandas dataframe]: [see output of gpx_chunk. Timestamps written
+                            with a UTC offset are converted to UTC.]
+    """
+    times, lats, longs, eles = [], [], [], []
+    segment = None
+    yielded = False
+    for event, elem in ElementTree.iterparse(handle, events=('start', 'end')):
+        tag = elem.tag.rpartition('}')[2]
+        if tag == 'trkseg':
+            segment = elem if event == 'start' else None
+        elif tag == 'trkpt' and event == 'end':
+            lats.append(elem.get('lat'))
+            longs.append(elem.get('lon'))
+            times.append(None)
+            eles.append(None)
+            for child in elem:
+                name = child.tag.rpartition('}')[2]
+                if name == 'time':
+                    times[-1] = child.text
+                elif name == 'ele':
+                    eles[-1] = child.text
+            if segment is not None:
+                segment.remove(elem)
+            elem.clear()
+            if len(lats) == chunk_size:
+                yield gpx_chunk(times, lats, longs, eles)
+                yielded = True
+                times, lats, longs, eles = [], [], [], []
+    if lats or not yielded:
+        yield gpx_chunk(times, lats, longs, eles)
+
+def parse_gpx_streaming(handle):
+    """[Parses gpx files without building the gpxpy document]
+    Args:
+        handle: [the handle of the file to be parsed]
+    Returns:
+        [pandas dataframe]: [dataframe with columns of timestamp, position_lat
+                            position_long(in degrees), 'altitude']
+    """
+    return pd.concat(iter_gpx_chunks(handle), ignore_index=True)
+
+def file_format(filename):
+    """[Format of an activity file from its extension]
+    Args:
+        filename: [the name of the file]
+    Returns:
+        [string]: [fit.gz, gpx or gpx.gz, None if there is no parser for it]
+    """
+    return next((kind for kind in ('fit.gz', 'gpx', 'gpx.gz') if filename.endswith(f'.{kind}')), None)
+
 def parse_file(filename):
-    """[Parses file method depends on file type]
+    """[Parses file method depends on file type. Each parse is timed as a
+        parse_file stage, see instrument.stage, and a parser that fails
+        returns None and reports why as the error of the stage]
     Args:
         filename: [the name of the file you want to parse]
     Returns:
         [dataframe]: [see output of corresponding parser above]
     """
-    if filename.endswith('.fit.gz'):
-        handle = gzip.open(filename)
-        return parse_fit(handle)
-    elif filename.endswith('.gpx'):
-        handle = open(filename)
-        return parse_gpx(handle)
+    kind = file_format(filename)
+    if kind is None:
+        print(f'Add parser for {filename} to parse_file function.')
+        instrument.record_failure('parse_file', 'no parser for this file type', filename=filename)
+        return None
+    with instrument.stage('parse_file', profile=True, filename=filename, format=kind) as info:
+        info['bytes'] = os.path.getsize(filename)
+        with (open(filename, 'rb') if kind == 'gpx' else gzip.open(filename)) as handle:
+            df = parse_fit_columnar(handle) if kind == 'fit.gz' else parse_gpx_streaming(handle)
+        info['rows'] = 0 if df is None else len(df)
+    return df
+
+def iter_file_chunks(filename, chunk_size=100000):
+    """[Parses file in chunks, gpx files are streamed so only one chunk
+       is held in memory at a time]
+    Args:
+        filename: [the name of the file you want to parse]
+        chunk_size (int, optional): [number of gpx points per chunk]. Defaults to 100000.
+    Yields:
+        [dataframe]: [see output of corresponding parser above]
+    """
+    if filename.endswith('.gpx'):
+        with open(filename, 'rb') as handle:
+            yield from iter_gpx_chunks(handle, chunk_size)
     elif filename.endswith('.gpx.gz'):
-        handle = gzip.open(filename)
-        return parse_gpx(handle)
+        with gzip.open(filename) as handle:
+            yield from iter_gpx_chunks(handle, chunk_size)
     else:
-        print(f'Add parser for {filename} to parse_file function.')
+        df = parse_file(filename)
+        if df is not None:
+            yield df
 
 def full_path(directory, filename):
     """[Joins directory and filename to give full path to the file]
@@ -112,32 +254,389 @@ def get_activities(directory):
     df['exists'] = df['filename'].map(check_file_exists)
     return df.sort_values('activity_date')
 
+def add_activity(person, activity_id, activity_date, filename, name='Upload'):
+    """[Adds an activity to activities.csv, or replaces its row if the
+       activity is already there, rewriting the file atomically]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where the activity overview file is.]
+        activity_id ([int]): [id of the activity]
+        activity_date ([timestamp]): [start of the activity]
+        filename ([string]): [activity file relative to ../data/{person}]
+        name (str, optional): [activity name]. Defaults to 'Upload'.
+    """
+    path = f'../data/{person}/activities.csv'
+    with open(path, newline='') as f:
+        rows = list(csv.reader(f))
+    header = rows[0]
+    row = [''] * len(header)
+    values = {'Activity ID': str(activity_id), 'Activity Name': name, 'Filename': filename,
+              'Activity Date': pd.Timestamp(activity_date).strftime('%b %d, %Y, %I:%M:%S %p')}
+    for column, value in values.items():
+        row[header.index(column)] = value
+    rows = [rows[0]] + [r for r in rows[1:] if r and r[0] != str(activity_id)] + [row]
+    with open(f'{path}.tmp', 'w', newline='') as f:
+        csv.writer(f).writerows(rows)
+    os.replace(f'{path}.tmp', path)
+
 def parquet_activities(person):
-    """[Creates a parquet file of the dataframe]
+    """[Creates the parquet dataset partitions of the person, with the
+       records cleaned, see clean.clean_records]
     Args:
         person ([string]): [The name of the folder in ../data 
         where the activity overview file is.]
     """
-    act_df = get_activities(person)
-    act_df['person'] = person
-    print(f'Reading {len(act_df)} activities for {person}. Please be patient as this might take a while!')
-    dfs = []
-    for i, t in enumerate(act_df.to_dict(orient='records')):
-        if i % 40 == 0:
-            print(f'{round(100*i/len(act_df),0)} % complete')
+    with instrument.stage('parquet_activities', person=person):
+        act_df = get_activities(person)
+        act_df['person'] = person
+        print(f'Reading {len(act_df)} activities for {person}. Please be patient as this might take a while!')
+        dfs = []
+        for i, t in enumerate(act_df.to_dict(orient='records')):
+            if i % 40 == 0:
+                print(f'{round(100*i/len(act_df),0)} % complete')
+            try:
+                tmp = parse_file(t['filename'])
+                if tmp is None:
+                    instrument.record_failure('parquet_activities', 'no records parsed',
+                                              activity_id=t['activity_id'], filename=t['filename'])
+                    continue
+                tmp['activity_id'] = t['activity_id']
+                tmp['person'] = t['person']
+                dfs.append(tmp)
+            except Exception as e:
+                instrument.record_failure('parquet_activities', repr(e),
+                                          activity_id=t['activity_id'], filename=t['filename'])
+        print('Creating parquet dataset')
+        with instrument.stage('write_dataset', person=person) as info:
+            df = pd.concat(dfs)
+            df['timestamp'] = dataset.to_timestamps(df['timestamp']).values
+            df = clean.clean_records(df)
+            dates = act_df.set_index('activity_id')['activity_date']
+            df['year'] = df['activity_id'].map(dates.dt.year)
+            df['month'] = df['activity_id'].map(dates.dt.month)
+            dataset.write_person(df, person)
+            info['rows'] = len(df)
+        simplify.clear_tracks(person)
+        peak.refresh_cluster_model(person, rebuild=True)
+    instrument.write_metrics(f'../data/{person}/metrics.json')
+
+def read_manifest(person):
+    """[Reads the ingest manifest recording which activities have
+       already been written to their own parquet part]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where the activity overview file is.]
+    Returns:
+        [dictionary]: [manifest with keys done (activity_id -> part file),
+                       failed (activity_id -> reason), signatures
+                       (activity_id -> file signature when it was parsed) and
+                       partitions (activity_id -> [year, month])]
+    """
+    path = f'../data/{person}/manifest.json'
+    manifest = {'done': {}, 'failed': {}, 'signatures': {}, 'partitions': {}}
+    if check_file_exists(path):
+        with open(path) as f:
+            manifest.update(json.load(f))
+    return manifest
+
+def write_manifest(person, manifest):
+    """[Writes the ingest manifest, replacing the old one atomically
+       so a crash mid-write never leaves a truncated manifest]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where the activity overview file is.]
+        manifest ([dictionary]): [see output of read_manifest]
+    """
+    path = f'../data/{person}/manifest.json'
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(f'{path}.tmp', path)
+
+def file_signature(filename, check='mtime'):
+    """[Summarises a file so a later run can tell if it has changed]
+    Args:
+        filename ([string]): [path to the activity file]
+        check (str, optional): [mtime compares size and modification time,
+                                hash compares size and a sha1 of the
+                                contents]. Defaults to 'mtime'.
+    Returns:
+        [list]: [size and mtime or content hash, None if the file is missing]
+    """
+    if not check_file_exists(filename):
+        return None
+    stat = os.stat(filename)
+    if check == 'hash':
+        sha1 = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+        return [stat.st_size, sha1.hexdigest()]
+    return [stat.st_size, stat.st_mtime_ns]
+
+def parse_to_part(filename, activity_id, person, check='mtime'):
+    """[Parses a single activity file, cleans it (see clean.clean_records)
+       and writes it to a new parquet part in ../data/{person}/parts, so the
+       part the manifest points at is only replaced once the manifest is.
+       Activities longer than a chunk of iter_file_chunks are cleaned a
+       chunk at a time. Runs inside a worker process, and hands the
+       worker's metrics back with the result.]
+    Args:
+        filename ([string]): [path to the activity file]
+        activity_id ([int]): [id of the activity]
+        person ([string]): [The name of the folder in ../data
+        where the activity overview file is.]
+        check (str, optional): [see file_signature]. Defaults to 'mtime'.
+    Returns:
+        [tuple]: [filename of the part relative to the parts directory,
+                  the signature of the file that was parsed and the worker's
+                  metrics, see instrument.take_metrics]
+    """
+    signature = file_signature(filename, check)
+    part = f'{activity_id}.{uuid.uuid4().hex[:12]}.parquet'
+    path = os.path.join(f'../data/{person}/parts', part)
+    writer = None
+    with instrument.stage('parse_to_part', profile=True, activity_id=activity_id,
+                          filename=filename, format=file_format(filename)) as info:
+        info['bytes'], info['rows'] = os.path.getsize(filename), 0
         try:
-            tmp = parse_file(t['filename'])
-            tmp['activity_id'] = t['activity_id']
-            tmp['person'] = t['person']
-            dfs.append(tmp)
-        except Exception as e:
-            pass
-    print('Creating parquet file')
-    df = pd.concat(dfs)
-    df['timestamp'] = pd.to_datetime(df['timestamp'].map(lambda x: str(x)[:19]))
-    df.to_parquet(f'../data/{person}/df.parquet')
+            for tmp in iter_file_chunks(filename):
+                tmp['activity_id'] = activity_id
+                tmp['person'] = person
+                tmp['timestamp'] = dataset.to_timestamps(tmp['timestamp']).values
+                tmp = clean.clean_records(tmp)
+                table = pa.Table.from_pandas(tmp, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(f'{path}.tmp', table.schema)
+                writer.write_table(table)
+                info['rows'] += len(tmp)
+            if writer is None:
+                raise ValueError(f'No records parsed from {filename}')
+            writer.close()
+        except Exception:
+            if writer is not None:
+                writer.close()
+                os.remove(f'{path}.tmp')
+            raise
+        os.replace(f'{path}.tmp', path)
+    return part, signature, instrument.take_metrics()
+
+def write_partitions(person, manifest, partitions):
+    """[Rewrites the given dataset partitions from the parquet parts of the
+       activities that belong to them]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where the activity overview file is.]
+        manifest ([dictionary]): [see output of read_manifest]
+        partitions ([iterable]): [(year, month) partitions to rewrite]
+    """
+    for year, month in sorted(set(map(tuple, partitions))):
+        parts = [os.path.join(f'../data/{person}/parts', manifest['done'][a])
+                 for a, partition in manifest['partitions'].items()
+                 if tuple(partition) == (year, month) and a in manifest['done']]
+        df = pd.concat([pd.read_parquet(part) for part in parts]) if parts else None
+        dataset.write_partition(df, person, year, month)
+
+def record_part(manifest, t, part, signature, metrics):
+    """[Records a parsed activity in the manifest]
+    Args:
+        manifest ([dictionary]): [see output of read_manifest, updated in place]
+        t ([dictionary]): [activity record from get_activities]
+        part ([string]): [see output of parse_to_part]
+        signature ([list]): [see output of parse_to_part]
+        metrics ([dictionary]): [see output of parse_to_part]
+    Returns:
+        [list]: [year and month partition of the activity]
+    """
+    activity_id = str(t['activity_id'])
+    manifest['done'][activity_id], manifest['signatures'][activity_id] = part, signature
+    manifest['partitions'][activity_id] = [t['activity_date'].year, t['activity_date'].month]
+    manifest['failed'].pop(activity_id, None)
+    instrument.merge(metrics)
+    return manifest['partitions'][activity_id]
+
+def record_part_failure(manifest, t, reason, check='mtime'):
+    """[Records an activity that could not be parsed in the manifest, with
+       the signature of its file so it is not retried until the file changes]
+    Args:
+        manifest ([dictionary]): [see output of read_manifest, updated in place]
+        t ([dictionary]): [activity record from get_activities]
+        reason ([string]): [why it failed]
+        check (str, optional): [see file_signature]. Defaults to 'mtime'.
+    """
+    activity_id = str(t['activity_id'])
+    manifest['failed'][activity_id] = reason
+    instrument.record_failure('parse_to_part', reason, activity_id=t['activity_id'], filename=t['filename'])
+    manifest['signatures'][activity_id] = file_signature(t['filename'], check)
+
+def drop_activity(manifest, activity_id):
+    """[Removes an activity from the manifest. Its parquet part is left until
+       the change is written, see remove_parts]
+    Args:
+        manifest ([dictionary]): [see output of read_manifest, updated in place]
+        activity_id ([string]): [id of the activity]
+    Returns:
+        [list]: [year and month partition the activity was in, None if it was in none]
+    """
+    manifest['done'].pop(activity_id, None)
+    manifest['failed'].pop(activity_id, None)
+    manifest['signatures'].pop(activity_id, None)
+    return manifest['partitions'].pop(activity_id, None)
+
+def remove_parts(person, before, after):
+    """[Deletes the parquet parts a manifest no longer points at, once the
+       manifest and the partitions built from them are written]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where the activity overview file is.]
+        before ([dictionary]): [manifest before the change, see output of read_manifest]
+        after ([dictionary]): [manifest after the change]
+    """
+    for part in set(before['done'].values()) - set(after['done'].values()):
+        path = os.path.join(f'../data/{person}/parts', part)
+        if check_file_exists(path):
+            os.remove(path)
+
+def ingest_parts(person, tasks, manifest, n_workers=None, flush_every=20, check='mtime'):
+    """[Parses activities across a process pool, recording each finished
+       or failed activity in the manifest as it completes]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where the activity overview file is.]
+        tasks ([list]): [activity records from get_activities to parse]
+        manifest ([dictionary]): [see output of read_manifest, updated in place]
+        n_workers (int, optional): [number of worker processes]. Defaults to
+                                    None, one per core.
+        flush_every (int, optional): [write the manifest after this many
+                                      completed activities]. Defaults to 20.
+        check (str, optional): [see file_signature]. Defaults to 'mtime'.
+    """
+    os.makedirs(f'../data/{person}/parts', exist_ok=True)
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(parse_to_part, t['filename'], t['activity_id'], person, check): t
+                   for t in tasks}
+        for i, future in enumerate(as_completed(futures)):
+            t = futures[future]
+            try:
+                record_part(manifest, t, *future.result())
+            except Exception as e:
+                record_part_failure(manifest, t, repr(e), check)
+            if (i + 1) % flush_every == 0:
+                write_manifest(person, manifest)
+                print(f'{round(100*(i + 1)/len(tasks),0)} % complete')
+    write_manifest(person, manifest)
+
+def stale_partitions(person, manifest):
+    """[Partitions with a parquet part newer than the partition file, or no
+       partition file yet: those of activities parsed since the partition was
+       last written, including by a run that crashed before writing it]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where the activity overview file is.]
+        manifest ([dictionary]): [see output of read_manifest]
+    Returns:
+        [list]: [year, month partitions to rewrite]
+    """
+    written, stale = {}, set()
+    for activity_id, part in manifest['done'].items():
+        partition = tuple(manifest['partitions'][activity_id])
+        if partition in stale:
+            continue
+        if partition not in written:
+            path = os.path.join(dataset.partition_dir(person, *partition), 'part-0.parquet')
+            written[partition] = os.stat(path).st_mtime_ns if check_file_exists(path) else None
+        part_path = os.path.join(f'../data/{person}/parts', part)
+        if written[partition] is None or os.stat(part_path).st_mtime_ns > written[partition]:
+            stale.add(partition)
+    return sorted(stale)
+
+def parquet_activities_parallel(person, n_workers=None, flush_every=20):
+    """[Creates the parquet dataset partitions of the person, parsing files across a
+       process pool. Each activity is written to its own parquet part and
+       recorded in the manifest, so re-running after a crash only parses
+       the activities that are not done yet. Only the partitions those
+       activities belong to are rewritten, see stale_partitions.]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where the activity overview file is.]
+        n_workers (int, optional): [number of worker processes]. Defaults to
+                                    None, one per core.
+        flush_every (int, optional): [write the manifest after this many
+                                      completed activities]. Defaults to 20.
+    """
+    act_df = get_activities(person)
+    manifest = read_manifest(person)
+    todo = [t for t in act_df.to_dict(orient='records') if str(t['activity_id']) not in manifest['done']]
+    print(f'{len(act_df) - len(todo)} of {len(act_df)} activities for {person} already done, reading {len(todo)}.')
+    with instrument.stage('ingest_parts', person=person):
+        ingest_parts(person, todo, manifest, n_workers, flush_every)
+    print('Creating parquet dataset')
+    with instrument.stage('write_partitions', person=person):
+        write_partitions(person, manifest, stale_partitions(person, manifest))
+    simplify.invalidate_tracks(person, [t['activity_id'] for t in todo])
+    peak.refresh_cluster_model(person)
+    instrument.write_metrics(f'../data/{person}/metrics.json')
+
+def activity_changes(act_df, manifest, check='mtime'):
+    """[Compares the activities in activities.csv against the manifest]
+    Args:
+        act_df ([pandas dataframe]): [see output of get_activities]
+        manifest ([dictionary]): [see output of read_manifest]
+        check (str, optional): [see file_signature]. Defaults to 'mtime'.
+    Returns:
+        [tuple]: [lists of activity records that are new, activity records
+                  whose file changed, and activity ids (as strings) that are
+                  no longer in activities.csv]
+    """
+    new, changed = [], []
+    for t in act_df.to_dict(orient='records'):
+        activity_id = str(t['activity_id'])
+        if activity_id not in manifest['signatures']:
+            new.append(t)
+        elif file_signature(t['filename'], check) != manifest['signatures'][activity_id]:
+            changed.append(t)
+    current = set(act_df['activity_id'].astype(str))
+    deleted = [a for a in manifest['signatures'] if a not in current]
+    return new, changed, deleted
+
+def parquet_activities_incremental(person, n_workers=None, check='mtime'):
+    """[Brings the parquet dataset up to date with activities.csv, parsing only
+       activities that are new or whose file has changed since they were
+       last parsed and dropping activities that have been deleted. Only the
+       partitions holding those activities are rewritten, then the
+       simplified tracks and any cluster model are brought up to date.]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where the activity overview file is.]
+        n_workers (int, optional): [number of worker processes]. Defaults to
+                                    None, one per core.
+        check (str, optional): [see file_signature]. Defaults to 'mtime'.
+    """
+    act_df = get_activities(person)
+    manifest = read_manifest(person)
+    before = copy.deepcopy(manifest)
+    new, changed, deleted = activity_changes(act_df, manifest, check)
+    print(f'{len(new)} new, {len(changed)} changed and {len(deleted)} deleted activities for {person}.')
+    if not (new or changed or deleted):
+        return
+    partitions = [[t['activity_date'].year, t['activity_date'].month] for t in new + changed]
+    for activity_id in deleted + [str(t['activity_id']) for t in changed]:
+        partition = drop_activity(manifest, activity_id)
+        if partition is not None:
+            partitions.append(partition)
+    with instrument.stage('ingest_parts', person=person):
+        ingest_parts(person, new + changed, manifest, n_workers, check=check)
+    print('Updating parquet dataset')
+    with instrument.stage('write_partitions', person=person):
+        write_partitions(person, manifest, partitions)
+    remove_parts(person, before, manifest)
+    simplify.invalidate_tracks(person, deleted + [t['activity_id'] for t in changed])
+    peak.refresh_cluster_model(person)
+    instrument.write_metrics(f'../data/{person}/metrics.json')
 
 if __name__ == "__main__":
 
-    parquet_activities('Example_Strava')
+    if '--incremental' in sys.argv[1:]:
+        parquet_activities_incremental('Example_Strava')
+    else:
+        parquet_activities('Example_Strava')
 
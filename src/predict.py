@@ -1,11 +1,30 @@
 from branca.element import Template, MacroElement
+import featurize
 import folium
-from functools import partial
-from geopy import distance
+import forest
+import geo
+import instrument
 import numpy as np
+import os
 import pandas as pd
 import pickle
 import legend_helper
+import simplify
+import tiles
+import track_store
+
+def load_model(path):
+    """[Loads the activity mode classifier]
+    Args:
+        path ([string]): [a pickled classifier, or a directory written by
+                          forest.export_forest, which is memory mapped]
+    Returns:
+        [model]: [classifier with predict and classes_]
+    """
+    if os.path.isdir(path):
+        return forest.CompiledForest(forest.load_forest(path))
+    with open(path, 'rb') as f:
+        return pickle.load(f)
 
 def resample_activity(df, interval="30s"):
     """[resamples from the dataframe]
@@ -18,11 +37,14 @@ def resample_activity(df, interval="30s"):
     """
     return df.resample(interval).mean().drop('activity_id', axis='columns')
 
-def compute_speed_distance(df):
+def compute_speed_distance(df, method='ellipsoid'):
     """[Takes df with position_lat, position_long, altitude, and time and 
         calculates change in altitude, time, distance, speed]
     Args:
         df ([pandas dataframe]): [df with position_lat, position_long, altitude, and time]
+        method (str, optional): [ellipsoid to match geopy's WGS-84 distance the
+                                 mode model was trained on, or haversine, see
+                                 geo.distance]. Defaults to 'ellipsoid'.
     Returns:
         [pandas dataframe]: [df with distance, change in time, change in altitude, speed]
     """
@@ -32,10 +54,11 @@ def compute_speed_distance(df):
     df['alt_previous'] = df['altitude'].shift(1)
     df['time_previous'] = df['time'].shift(1)
     df = df.fillna(method='bfill')
-    df['distance_dis_2d'] = df.apply(lambda x: distance.distance((x['lat_previous'], x['lon_previous']), (x['position_lat'], x['position_long'])).m, axis = 1)
-    df['delta_alt'] = df.apply(lambda x: x['altitude']- x['alt_previous'], axis=1)
-    df['distance'] = df.apply(lambda x: np.sqrt(x['distance_dis_2d']**2 + (x['delta_alt'])**2), axis=1)
-    df['time_delta'] = df.apply(lambda x: (x['time'] - x['time_previous']).total_seconds(), axis=1)
+    df['distance_dis_2d'] = geo.distance(df['lat_previous'].values, df['lon_previous'].values,
+                                         df['position_lat'].values, df['position_long'].values, method)
+    df['delta_alt'] = df['altitude'] - df['alt_previous']
+    df['distance'] = np.sqrt(df['distance_dis_2d']**2 + df['delta_alt']**2)
+    df['time_delta'] = (df['time'] - df['time_previous']).dt.total_seconds()
     df['speed'] = df['distance'].divide(df['time_delta'])
     return df
 
@@ -72,12 +95,12 @@ def window_features(df, speed_thres=0, window=2*5):
                   'delta_alt', 'delta_alt_max', 'delta_alt_std', 'month']
     return final_df
 
-def evaluate_mode(filename, clf, speed_thres=0, window=2*5, interval="30s"):
-    """[Imports activity, converts to dataframe, predicts activity type
-        for each segment of activity]
+def featurize_records(sample_df, speed_thres=0, window=2*5, interval="30s"):
+    """[Resamples activity records and computes the window features the
+        model is trained on, each activity separately, see featurize.featurize]
     Args:
-        filename ([string]): [filepath]
-        clf ([model]): [fit classification model]
+        sample_df ([pandas df]): [records with time, position_lat, position_long,
+                                  altitude and activity_id columns]
         speed_thres (int, optional): [Threshold for speed. Only keeps rows when
                                        speed is >= this threshold]. Defaults to 0.
         window (int, optional): [size of the moving window over which you
@@ -85,53 +108,126 @@ def evaluate_mode(filename, clf, speed_thres=0, window=2*5, interval="30s"):
                                  resampling]. Defaults to 2*5, when resampling is 30s
                                  this is a window of 5 min.
         interval ([string]): [interval at which you want to resample] Defaults to 30s
+    Returns:
+        [tuple of pandas df]: [resampled records with speed and distance, and the
+                               window features for the rows that have them]
+    """
+    return featurize.featurize(sample_df, speed_thres, window, interval)
+
+def predict_mode(sample_df, clf, speed_thres=0, window=2*5, interval="30s"):
+    """[Predicts activity type for each segment of the activity records]
+    Args:
+        sample_df ([pandas df]): [records with time, position_lat, position_long,
+                                  altitude and activity_id columns]
+        clf ([model]): [fit classification model]
+        speed_thres (int, optional): [see featurize_records]. Defaults to 0.
+        window (int, optional): [see featurize_records]. Defaults to 2*5.
+        interval ([string]): [see featurize_records] Defaults to 30s
     Returns:
         [pandas df]: [dataframe for activity including predictions of activity
                       type for each segment]
     """
-    sample_df = pd.read_parquet(filename)
-    sample_df['time'] = pd.to_datetime(sample_df['time'], utc=True)
-    sample_df['time'] = sample_df['time'].dt.tz_localize(tz=None)
-    sample_df.set_index('time', inplace=True)
-    resample_activity_instance = partial(resample_activity, interval=interval)
-    sample_df = sample_df.groupby(['activity_id']).apply(resample_activity_instance).reset_index().set_index('time')
-    sample_df = sample_df.fillna(method='ffill')
-    sample_df = sample_df.fillna(method='bfill')
-    sample_df = compute_speed_distance(sample_df)
-    sample_data = window_features(sample_df, speed_thres, window)
-    sample_data = sample_data.dropna()
+    sample_df, sample_data = featurize_records(sample_df, speed_thres, window, interval)
     X = sample_data.values
     sample_df.loc[ sample_data.index , 'predicted_mode'] = clf.predict(X)
     return sample_df[['time', 'position_lat', 'position_long', 'predicted_mode']].dropna(axis=0)
 
-def visualize_prediction(df, color_dict, save_to):
+def evaluate_mode(filename, clf, speed_thres=0, window=2*5, interval="30s"):
+    """[Imports activity, converts to dataframe, predicts activity type
+        for each segment of activity]
+    Args:
+        filename ([string]): [filepath]
+        clf ([model]): [fit classification model]
+        speed_thres (int, optional): [see predict_mode]. Defaults to 0.
+        window (int, optional): [see predict_mode]. Defaults to 2*5.
+        interval ([string]): [see predict_mode] Defaults to 30s
+    Returns:
+        [pandas df]: [dataframe for activity including predictions of activity
+                      type for each segment]
+    """
+    with instrument.stage('evaluate_mode', filename=filename) as info:
+        sample_df = pd.read_parquet(filename)
+        info['rows'] = len(sample_df)
+        return predict_mode(sample_df, clf, speed_thres, window, interval)
+
+def evaluate_activity(person, activity_id, clf, speed_thres=0, window=2*5, interval="30s"):
+    """[Reads a single activity from its slice of the person's track store
+        and predicts activity type for each segment of activity]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where activity files are.]
+        activity_id ([int]): [id of the activity]
+        clf ([model]): [fit classification model]
+        speed_thres (int, optional): [see predict_mode]. Defaults to 0.
+        window (int, optional): [see predict_mode]. Defaults to 2*5.
+        interval ([string]): [see predict_mode] Defaults to 30s
+    Returns:
+        [pandas df]: [dataframe for activity including predictions of activity
+                      type for each segment]
+    """
+    with instrument.stage('evaluate_mode', person=person, activity_id=activity_id) as info:
+        store = track_store.update_track_store(person)
+        sample_df = track_store.tracks_frame(store, [activity_id])
+        sample_df = sample_df.rename(columns={'timestamp': 'time'})
+        info['rows'] = len(sample_df)
+        return predict_mode(sample_df, clf, speed_thres, window, interval)
+
+def mode_segments(modes):
+    """[Run length encodes predicted modes]
+    Args:
+        modes ([numpy array]): [predicted_mode of each row, in time order]
+    Returns:
+        [tuple of numpy arrays]: [start and stop row of each run of the same mode]
+    """
+    if len(modes) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    starts = np.flatnonzero(np.r_[True, modes[1:] != modes[:-1]])
+    return starts, np.r_[starts[1:], len(modes)]
+
+def visualize_prediction(df, color_dict, save_to, detail_zoom=16, tolerance=None, export='html', min_zoom=10, max_zoom=18):
     """[Creates folium map of activity path colored by predicted activity type]
     Args:
         df ([pandas df]): [dataframe of activity data including position_lat, position_long
                             and predicted_mode, the predicted activity type]
         color_dict ([dictionary]): [keys are activity types, values are colors]
         save_to ([string]): [filepath where folium map is saved]
+        detail_zoom (int, optional): [zoom level at which the simplified path
+                                      is still accurate to a pixel]. Defaults to 16.
+        tolerance ([float], optional): [simplification tolerance in metres,
+                                        used instead of detail_zoom]. Defaults to None.
+        export (str, optional): [html for a single folium file, or tiles for
+                                 GeoJSON tiles and an index.html in the
+                                 directory save_to, each zoom level simplified
+                                 to a pixel at that zoom]. Defaults to 'html'.
+        min_zoom (int, optional): [lowest zoom level with tiles]. Defaults to 10.
+        max_zoom (int, optional): [highest zoom level with tiles]. Defaults to 18.
     Returns:
         [folium.Map object]: [folium map of activity path colored by predicted activity type]
     """
-    df['break'] = df['predicted_mode']==df['predicted_mode'].shift(1)
-    df['segment'] = None
-    segment = 0
-    rows = []
-    for row in df.to_dict(orient='records'):
-        if not row['break']:
-            row['segment'] = segment
-            segment += 1
-        rows.append(row)            
-    df = pd.DataFrame(rows).fillna(method='ffill')
+    modes = df['predicted_mode'].values
+    starts, stops = mode_segments(modes)
+    lat = df['position_lat'].values
+    long = df['position_long'].values
 
-    central_lat = df.position_lat.mean()
-    central_long = df.position_long.mean()
+    central_lat = np.nanmean(lat)
+    central_long = np.nanmean(long)
+    if export == 'tiles':
+        layers = {'segments': {}}
+        for zoom in range(min_zoom, max_zoom + 1):
+            zoom_tolerance = simplify.zoom_tolerance(zoom, central_lat)
+            segment_tiles = {}
+            for start, stop in zip(starts, stops):
+                locations = simplify.simplify_track(lat[start:stop], long[start:stop], zoom_tolerance)
+                style = {'color': color_dict[modes[start]], 'weight': 2.5, 'opacity': 0.9}
+                tiles.add_line(segment_tiles, locations, zoom, {'predicted_mode': str(modes[start]), 'style': style})
+            layers['segments'][zoom] = tiles.write_layer(save_to, 'segments', zoom, segment_tiles)
+        return tiles.save_tiled_map(save_to, [central_lat, central_long], 14.5, layers, legend_helper.legend_string)
+    if tolerance is None:
+        tolerance = simplify.zoom_tolerance(detail_zoom, central_lat)
     m = folium.Map(location=[central_lat,central_long],tiles="Stamen Terrain",zoom_start=14.5)
-    for segment in df.segment.unique():
-        locations = df.query(f"segment=={segment}")[['position_lat', 'position_long']]
-        act_type = df.query(f"segment=={segment}")[['predicted_mode']].values[0][0]
-        folium.PolyLine(locations.values.tolist(), color=color_dict[act_type], weight=2.5, opacity=0.9).add_to(m)
+    for start, stop in zip(starts, stops):
+        locations = simplify.simplify_track(lat[start:stop], long[start:stop], tolerance)
+        folium.PolyLine(simplify.to_locations(locations), color=color_dict[modes[start]], weight=2.5, opacity=0.9).add_to(m)
     macro = MacroElement()
     macro._template = Template(legend_helper.legend_string)
     m.add_child(macro)
@@ -139,8 +235,7 @@ def visualize_prediction(df, color_dict, save_to):
     return m
 
 if __name__ == '__main__':
-    with open('../data/model.pkl', 'rb') as f:
-        clf = pickle.load(f)
+    clf = load_model('../data/model.pkl')
     activity_id = 4408957556
     filename = f'../data/samples/sample{activity_id}.parquet'
     final_df = evaluate_mode(filename, clf)
@@ -0,0 +1,103 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import time
+import track_store
+from predict import featurize_records, load_model
+
+RECORD_COLUMNS = ['timestamp', 'position_lat', 'position_long', 'altitude', 'activity_id']
+
+def featurize_activities(person, activity_ids, speed_thres=0, window=2*5, interval="30s"):
+    """[Reads a group of activities from the track store, which the parent
+        brought up to date, and featurizes them together. Runs inside a
+        worker process.]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where activity files are.]
+        activity_ids ([list]): [activities to featurize]
+        speed_thres (int, optional): [see predict.featurize_records]. Defaults to 0.
+        window (int, optional): [see predict.featurize_records]. Defaults to 2*5.
+        interval ([string]): [see predict.featurize_records] Defaults to 30s
+    Returns:
+        [tuple]: [pandas df with activity_id, time, position_lat and position_long
+                  of each featurized row, numpy array of features for those rows]
+    """
+    records = track_store.tracks_frame(track_store.load_track_store(person), activity_ids, RECORD_COLUMNS)
+    records = records.rename(columns={'timestamp': 'time'})
+    sample_df, sample_data = featurize_records(records, speed_thres, window, interval)
+    key = sample_df.loc[sample_data.index, ['activity_id', 'time', 'position_lat', 'position_long']]
+    return key.reset_index(drop=True), sample_data.values
+
+def predict_person(person, clf, save_to=None, n_workers=None, activities_per_task=50,
+                   rows_per_batch=200000, speed_thres=0, window=2*5, interval="30s"):
+    """[Predicts activity type for every activity of a person. Activities are
+        featurized across a process pool and the model, loaded once, predicts
+        large batches of rows at a time. Predicted segments are appended to a
+        parquet file as each batch completes. Activities without a featurized
+        row are skipped, and if nothing is predicted an earlier output is
+        removed rather than left in place.]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where activity files are.]
+        clf ([model]): [fit classification model]
+        save_to ([string], optional): [output parquet file]. Defaults to
+                                       ../data/{person}/predictions.parquet.
+        n_workers (int, optional): [number of worker processes]. Defaults to
+                                    None, one per core.
+        activities_per_task (int, optional): [activities read and featurized by
+                                              a worker at a time]. Defaults to 50.
+        rows_per_batch (int, optional): [rows passed to clf.predict at a time]. Defaults to 200000.
+        speed_thres (int, optional): [see predict.featurize_records]. Defaults to 0.
+        window (int, optional): [see predict.featurize_records]. Defaults to 2*5.
+        interval ([string]): [see predict.featurize_records] Defaults to 30s
+    Returns:
+        [float]: [throughput in activities per second]
+    """
+    save_to = save_to or f'../data/{person}/predictions.parquet'
+    activity_ids = track_store.update_track_store(person)['activity_ids']
+    tasks = [list(activity_ids[i:i + activities_per_task])
+             for i in range(0, len(activity_ids), activities_per_task)]
+    print(f'Predicting {len(activity_ids)} activities for {person}.')
+    start = time.perf_counter()
+    writer = None
+    keys, features = [], []
+
+    def flush():
+        nonlocal writer, keys, features
+        if not keys:
+            return
+        batch = pd.concat(keys, ignore_index=True)
+        batch['predicted_mode'] = clf.predict(np.concatenate(features))
+        table = pa.Table.from_pandas(batch, preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(f'{save_to}.tmp', table.schema)
+        writer.write_table(table)
+        keys, features = [], []
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        results = executor.map(featurize_activities, [person] * len(tasks), tasks,
+                               [speed_thres] * len(tasks), [window] * len(tasks), [interval] * len(tasks))
+        for key, X in results:
+            if len(key) == 0:
+                continue
+            keys.append(key)
+            features.append(X)
+            if sum(len(x) for x in features) >= rows_per_batch:
+                flush()
+    flush()
+    if writer is not None:
+        writer.close()
+        os.replace(f'{save_to}.tmp', save_to)
+    elif os.path.exists(save_to):
+        os.remove(save_to)
+    elapsed = time.perf_counter() - start
+    print(f'Predicted {len(activity_ids)} activities in {elapsed:.1f} s '
+          f'({len(activity_ids)/elapsed:.1f} activities/sec)')
+    return len(activity_ids) / elapsed
+
+if __name__ == '__main__':
+    clf = load_model('../data/model.pkl')
+    predict_person('Example_Strava', clf)
@@ -0,0 +1,296 @@
+import functools
+import hashlib
+import json
+import numpy as np
+import os
+import pandas as pd
+import pickle
+import cluster_model
+import geo
+import peak
+import track_store
+
+def cache_file(person, epsilon, gain_threshold, interval):
+    """[File the summary of a person is cached in, one per set of clustering
+        and prediction parameters]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where activity files are.]
+        epsilon ([float]): [see peak.update_cluster_model]
+        gain_threshold ([float]): [see peak.update_cluster_model]
+        interval ([string]): [interval the predictions were made at]
+    Returns:
+        [string]: [pickle file]
+    """
+    return f'../data/{person}/query_cache/summary-epsilon={epsilon},gain={gain_threshold},interval={interval}.pkl'
+
+def model_file(person, epsilon, gain_threshold, min_samples=2):
+    """[Cluster model file a summary is built from. The person's shared
+        model is used when it was fitted with the same parameters, otherwise
+        the query keeps its own model for them, so queries never refit the
+        shared model with other parameters.]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where activity files are.]
+        epsilon ([float]): [see peak.update_cluster_model]
+        gain_threshold ([float]): [see peak.update_cluster_model]
+        min_samples (int, optional): [see peak.update_cluster_model]. Defaults to 2.
+    Returns:
+        [string]: [pickle file]
+    """
+    shared = f'../data/{person}/cluster_model.pkl'
+    model = cluster_model.load_cluster_model(shared)
+    if model is not None and \
+            (model['epsilon'], model['min_samples'], model.get('gain_threshold')) == (epsilon, min_samples, gain_threshold):
+        return shared
+    return f'../data/{person}/query_cache/cluster_model-epsilon={epsilon},gain={gain_threshold}.pkl'
+
+def source_key(person):
+    """[Key that changes whenever the dataset or the predictions of a person
+        are written, so cached summaries of older data are not used]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where activity files are.]
+    Returns:
+        [string]: [sha1 of the dataset signature and the predictions file signature]
+    """
+    sources = track_store.dataset_signature(person)
+    predictions = f'../data/{person}/predictions.parquet'
+    if os.path.exists(predictions):
+        stat = os.stat(predictions)
+        sources[predictions] = [stat.st_size, stat.st_mtime_ns]
+    return hashlib.sha1(json.dumps(sources, sort_keys=True).encode()).hexdigest()
+
+def track_stats(store, chunk_rows=1 << 20):
+    """[Distance, ascent, altitude range and duration of every activity in
+        the track store, reduced over chunks of whole activities so memory
+        stays bounded]
+    Args:
+        store ([dictionary]): [see track_store.load_track_store]
+        chunk_rows (int, optional): [records reduced at a time]. Defaults to 1 << 20.
+    Returns:
+        [pandas dataframe]: [indexed by activity_id, with start, elapsed_s,
+                             records, distance_m (2D, between consecutive
+                             fixes), ascent_m (sum of climbs between
+                             consecutive altitudes), neither counted across
+                             the long gaps between segments, max_altitude,
+                             min_altitude and gain, their difference]
+    """
+    ids, offsets, columns = store['activity_ids'], store['offsets'], store['columns']
+    stats = {key: np.full(len(ids), np.nan) for key in ['distance_m', 'ascent_m', 'max_altitude', 'min_altitude']}
+    stats['start'] = np.full(len(ids), np.datetime64('NaT'), dtype='datetime64[ns]')
+    stats['end'] = stats['start'].copy()
+    first = 0
+    while first < len(ids):
+        last = max(first + 1, int(np.searchsorted(offsets, offsets[first] + chunk_rows, 'right')) - 1)
+        start, stop = offsets[first], offsets[last]
+        sizes = np.diff(offsets[first:last + 1])
+        activity = np.repeat(np.arange(last - first), sizes)
+        segment = columns['segment'][start:stop]
+        lat = np.asarray(columns['position_lat'][start:stop], dtype=np.float64)
+        lon = np.asarray(columns['position_long'][start:stop], dtype=np.float64)
+        altitude = np.asarray(columns['altitude'][start:stop], dtype=np.float64)
+        fix = ~(np.isnan(lat) | np.isnan(lon))
+        fix_activity, fix_segment, lat, lon = activity[fix], segment[fix], lat[fix], lon[fix]
+        steps = geo.distance(lat[:-1], lon[:-1], lat[1:], lon[1:])
+        steps[(fix_activity[1:] != fix_activity[:-1]) | (fix_segment[1:] != fix_segment[:-1])] = 0
+        stats['distance_m'][first:last] = np.bincount(fix_activity[1:], weights=steps, minlength=last - first)
+        has_altitude = ~np.isnan(altitude)
+        altitude_activity, altitude_segment = activity[has_altitude], segment[has_altitude]
+        climbs = np.clip(np.diff(altitude[has_altitude]), 0, None)
+        climbs[(altitude_activity[1:] != altitude_activity[:-1]) | (altitude_segment[1:] != altitude_segment[:-1])] = 0
+        stats['ascent_m'][first:last] = np.bincount(altitude_activity[1:], weights=climbs, minlength=last - first)
+        local_starts = (offsets[first:last] - start).astype(np.int64)
+        altitude = np.asarray(columns['altitude'][start:stop])
+        stats['max_altitude'][first:last] = np.fmax.reduceat(altitude, local_starts)
+        stats['min_altitude'][first:last] = np.fmin.reduceat(altitude, local_starts)
+        times = columns['timestamp'][start:stop]
+        stats['start'][first:last] = times[local_starts]
+        stats['end'][first:last] = times[local_starts + sizes - 1]
+        first = last
+    stats = pd.DataFrame(stats, index=pd.Index(ids, name='activity_id'))
+    stats['elapsed_s'] = (stats.pop('end') - stats['start']).dt.total_seconds()
+    stats['records'] = np.diff(offsets)
+    stats['gain'] = stats['max_altitude'] - stats['min_altitude']
+    return stats
+
+def mode_seconds(person, interval="30s"):
+    """[Time spent in each predicted mode per activity, from the predictions
+        of predict_batch.predict_person, each predicted row covering one interval]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where activity files are.]
+        interval ([string]): [interval the predictions were made at] Defaults to 30s
+    Returns:
+        [pandas dataframe]: [seconds in each mode, indexed by activity_id
+                             with a column per mode, empty if there are no predictions]
+    """
+    filename = f'../data/{person}/predictions.parquet'
+    if not os.path.exists(filename):
+        return pd.DataFrame(index=pd.Index([], name='activity_id', dtype=np.int64))
+    predictions = pd.read_parquet(filename, columns=['activity_id', 'predicted_mode'])
+    counts = predictions.groupby(['activity_id', 'predicted_mode']).size().unstack(fill_value=0)
+    counts.columns = [str(mode) for mode in counts.columns]
+    return counts * pd.Timedelta(interval).total_seconds()
+
+def build_summary(person, epsilon=110, gain_threshold=400, interval="30s"):
+    """[Precomputes what queries are answered from: the stats and predicted
+        mode times of every activity and the peak clusters, brought up to
+        date with the dataset first, see model_file]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where activity files are.]
+        epsilon (int, optional): [see peak.update_cluster_model]. Defaults to 110.
+        gain_threshold (int, optional): [see peak.update_cluster_model]. Defaults to 400.
+        interval ([string]): [see mode_seconds] Defaults to 30s
+    Returns:
+        [dictionary]: [activities, a dataframe of track_stats with cluster,
+                       peak_lat, peak_long and the mode_seconds columns
+                       prefixed by seconds_, and clusters, a dataframe of
+                       cluster centroids and summit counts]
+    """
+    store = track_store.update_track_store(person)
+    model = peak.update_cluster_model(person, epsilon, gain_threshold,
+                                      filename=model_file(person, epsilon, gain_threshold))
+    activities = track_stats(store)
+    peaks = cluster_model.cluster_peaks(model)
+    activities['cluster'] = peaks['cluster'].reindex(activities.index).fillna(-1).astype(np.int64)
+    activities['peak_lat'] = peaks['position_lat'].reindex(activities.index)
+    activities['peak_long'] = peaks['position_long'].reindex(activities.index)
+    modes = mode_seconds(person, interval).add_prefix('seconds_')
+    activities = activities.join(modes)
+    clusters = cluster_model.cluster_centroids(model)
+    clusters = clusters[clusters['count'] > 0].rename(columns={'count': 'summits'})
+    return {'activities': activities, 'clusters': clusters.sort_values('summits', ascending=False, kind='stable')}
+
+@functools.lru_cache(maxsize=16)
+def cached_summary(person, epsilon, gain_threshold, interval, key):
+    """[Summary of a person for the given source key, kept in memory for
+        the most recently used keys and on disk for the latest one]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where activity files are.]
+        epsilon ([float]): [see build_summary]
+        gain_threshold ([float]): [see build_summary]
+        interval ([string]): [see build_summary]
+        key ([string]): [see source_key]
+    Returns:
+        [dictionary]: [see build_summary]
+    """
+    filename = cache_file(person, epsilon, gain_threshold, interval)
+    if os.path.exists(filename):
+        with open(filename, 'rb') as f:
+            cached = pickle.load(f)
+        if cached['key'] == key:
+            return cached['summary']
+    summary = build_summary(person, epsilon, gain_threshold, interval)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(f'{filename}.tmp', 'wb') as f:
+        pickle.dump({'key': key, 'summary': summary}, f)
+    os.replace(f'{filename}.tmp', filename)
+    return summary
+
+def load_summary(person, epsilon=110, gain_threshold=400, interval="30s"):
+    """[Summary of a person's current data. Ingesting activities writes the
+        dataset, which changes the source key, so the next query rebuilds
+        the summary once and the ones after are served from memory.]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where activity files are.]
+        epsilon (int, optional): [see build_summary]. Defaults to 110.
+        gain_threshold (int, optional): [see build_summary]. Defaults to 400.
+        interval ([string]): [see build_summary] Defaults to 30s
+    Returns:
+        [dictionary]: [see build_summary]
+    """
+    return cached_summary(person, epsilon, gain_threshold, interval, source_key(person))
+
+def summit_counts(person, **params):
+    """[How many times the person summited each peak]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where activity files are.]
+        params: [see load_summary]
+    Returns:
+        [pandas dataframe]: [position_lat, position_long and summits of each
+                             cluster, most summited first]
+    """
+    return load_summary(person, **params)['clusters']
+
+def nearest_cluster(person, lat, lon, radius=200, **params):
+    """[The peak cluster closest to a point]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where activity files are.]
+        lat ([float]): [latitude in degrees]
+        lon ([float]): [longitude in degrees]
+        radius (int, optional): [furthest the cluster centre may be, in metres]. Defaults to 200.
+        params: [see load_summary]
+    Returns:
+        [int]: [cluster number, None if no cluster is within radius]
+    """
+    clusters = summit_counts(person, **params)
+    if clusters.empty:
+        return None
+    distances = geo.distance(np.full(len(clusters), lat), np.full(len(clusters), lon),
+                             clusters['position_lat'].values, clusters['position_long'].values)
+    nearest = int(np.argmin(distances))
+    return int(clusters.index[nearest]) if distances[nearest] <= radius else None
+
+def summit_count(person, lat, lon, radius=200, **params):
+    """[How many times the person summited the peak at a point, e.g. the
+        summit of Mt. Victoria]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where activity files are.]
+        lat ([float]): [latitude in degrees]
+        lon ([float]): [longitude in degrees]
+        radius (int, optional): [see nearest_cluster]. Defaults to 200.
+        params: [see load_summary]
+    Returns:
+        [int]: [number of activities that summited it]
+    """
+    cluster = nearest_cluster(person, lat, lon, radius, **params)
+    return 0 if cluster is None else int(summit_counts(person, **params).loc[cluster, 'summits'])
+
+def peak_activities(person, cluster, **params):
+    """[Activities that summited a peak]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where activity files are.]
+        cluster ([int]): [cluster number, see summit_counts or nearest_cluster]
+        params: [see load_summary]
+    Returns:
+        [pandas dataframe]: [stats of the activities, see build_summary, oldest first]
+    """
+    activities = load_summary(person, **params)['activities']
+    return activities[activities['cluster'] == cluster].sort_values('start')
+
+def activity_stats(person, activity_id, **params):
+    """[Stats of one activity]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where activity files are.]
+        activity_id ([int]): [id of the activity]
+        params: [see load_summary]
+    Returns:
+        [dictionary]: [see build_summary, with modes, the seconds spent in
+                       each predicted mode. None if there is no such activity.]
+    """
+    activities = load_summary(person, **params)['activities']
+    if int(activity_id) not in activities.index:
+        return None
+    row = activities.loc[int(activity_id)]
+    stats = {key: value for key, value in row.items() if not key.startswith('seconds_')}
+    stats['modes'] = {key[len('seconds_'):]: float(value) for key, value in row.items()
+                      if key.startswith('seconds_') and not pd.isna(value) and value > 0}
+    return stats
+
+if __name__ == '__main__':
+    person = 'Example_Strava'
+    counts = summit_counts(person)
+    print(counts)
+    if not counts.empty:
+        cluster = int(counts.index[0])
+        print(peak_activities(person, cluster)[['start', 'distance_m', 'ascent_m', 'gain']])
+        print(activity_stats(person, peak_activities(person, cluster).index[0]))
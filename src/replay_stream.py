@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+import time
+import dataset
+import stream
+from featurize import FEATURE_COLUMNS
+from predict import featurize_records, load_model
+
+RECORD_COLUMNS = ['timestamp', 'position_lat', 'position_long', 'altitude', 'activity_id']
+
+def replay_records(person, activity_ids=None):
+    """[Reads records from the parquet dataset in the order a live feed of
+        every activity at once would deliver them, by timestamp]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where activity files are.]
+        activity_ids ([list], optional): [activities to replay]. Defaults to None, all.
+    Returns:
+        [pandas df]: [records with time, position_lat, position_long, altitude
+                      and activity_id columns]
+    """
+    records = dataset.read_records(person, columns=RECORD_COLUMNS, activity_ids=activity_ids)
+    records = records.rename(columns={'timestamp': 'time'})
+    return records.sort_values('time', kind='stable').reset_index(drop=True)
+
+def replay(records, clf, speed_thres=0, window=2*5, interval="30s", speedup=None):
+    """[Feeds records one at a time through the streaming featurizer and model,
+        timing each record that closes a tick from arrival to prediction.
+        Each activity ends after its last record.]
+    Args:
+        records ([pandas df]): [see replay_records]
+        clf ([model]): [fit classification model, see predict.load_model]
+        speed_thres (int, optional): [see featurize.featurize]. Defaults to 0.
+        window (int, optional): [see featurize.featurize]. Defaults to 2*5.
+        interval ([string]): [see featurize.featurize] Defaults to 30s
+        speedup ([float], optional): [replay at this many times real time,
+                                      sleeping between records]. Defaults to None,
+                                      as fast as possible.
+    Returns:
+        [tuple]: [pandas df of ticks, numpy array of seconds from the arrival of
+                  the record closing each tick to its prediction]
+    """
+    times = pd.to_datetime(records['time'], utc=True).dt.tz_localize(tz=None).values.astype(np.int64)
+    activity_ids = records['activity_id'].values
+    last_record = pd.Series(np.arange(len(records))).groupby(activity_ids).max()
+    ends = dict(zip(last_record.values, last_record.index))
+    dtype = records['position_lat'].dtype
+    columns = zip(activity_ids.tolist(), times.tolist(), records['position_lat'].tolist(),
+                  records['position_long'].tolist(), records['altitude'].tolist())
+    streams, ticks, latency = {}, [], []
+    started = time.perf_counter()
+    for i, (activity_id, t, lat, lon, alt) in enumerate(columns):
+        if speedup:
+            wait = (t - times[0]) / 1e9 / speedup - (time.perf_counter() - started)
+            if wait > 0:
+                time.sleep(wait)
+        start = time.perf_counter()
+        closed = stream.feed(streams, clf, activity_id, t, lat, lon, alt, speed_thres=speed_thres,
+                             window=window, interval=interval, dtype=dtype)
+        if i in ends:
+            closed += stream.end_activity(streams, clf, activity_id)
+        if closed:
+            latency += [time.perf_counter() - start] * len(closed)
+            ticks += closed
+    ticks = pd.DataFrame(ticks, columns=['activity_id', 'time', 'position_lat', 'position_long',
+                                         'altitude', 'distance', 'delta_alt', 'time_delta',
+                                         'speed', 'features', 'predicted_mode'])
+    return ticks, np.array(latency)
+
+def compare_with_batch(records, ticks, speed_thres=0, window=2*5, interval="30s"):
+    """[Compares streamed ticks with featurize.featurize of the complete
+        records. They differ only before an activity's first value of a
+        column, which the batch fills backward and a stream cannot.]
+    Args:
+        records ([pandas df]): [see replay_records]
+        ticks ([pandas df]): [see output of replay]
+        speed_thres (int, optional): [see featurize.featurize]. Defaults to 0.
+        window (int, optional): [see featurize.featurize]. Defaults to 2*5.
+        interval ([string]): [see featurize.featurize] Defaults to 30s
+    Returns:
+        [dictionary]: [resampled rows of each, rows with features of each,
+                       rows with features in both and largest feature difference]
+    """
+    resampled, features = featurize_records(records, speed_thres, window, interval)
+    batch = resampled.loc[features.index, ['activity_id', 'time']].assign(
+        batch_features=list(features[FEATURE_COLUMNS].values))
+    streamed = ticks.dropna(subset=['features'])[['activity_id', 'time', 'features']]
+    both = batch.merge(streamed, on=['activity_id', 'time'])
+    difference = (np.abs(np.vstack(both['features']) - np.vstack(both['batch_features'])).max()
+                  if len(both) else np.nan)
+    return {'resampled': (len(resampled), len(ticks)), 'featurized': (len(batch), len(streamed)),
+            'matched': len(both), 'max_difference': difference}
+
+if __name__ == '__main__':
+    clf = load_model('../data/model.pkl')
+    records = replay_records('Example_Strava')
+    start = time.perf_counter()
+    ticks, latency = replay(records, clf)
+    elapsed = time.perf_counter() - start
+    print(f'Replayed {len(records)} records of {records["activity_id"].nunique()} activities '
+          f'in {elapsed:.1f} s ({len(records)/elapsed:,.0f} records/sec), '
+          f'{ticks["predicted_mode"].notna().sum()} of {len(ticks)} ticks labelled')
+    p50, p95, p99 = np.percentile(latency, [50, 95, 99]) * 1e3
+    print(f'Per tick latency: p50 {p50:.2f} ms, p95 {p95:.2f} ms, p99 {p99:.2f} ms, '
+          f'max {latency.max()*1e3:.2f} ms')
+    print(compare_with_batch(records, ticks))
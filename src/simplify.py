@@ -0,0 +1,215 @@
+import numpy as np
+import os
+import pickle
+import shutil
+import geo
+import track_store
+
+METRES_PER_PIXEL = 156543.03392804097
+
+def local_xy(lat, lon):
+    """[Projects coordinates to metres on a plane touching the earth at the
+        mean latitude, accurate enough over the extent of one track]
+    Args:
+        lat ([numpy array]): [latitudes in degrees]
+        lon ([numpy array]): [longitudes in degrees]
+    Returns:
+        [tuple of numpy arrays]: [x and y in metres]
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    lat0 = np.radians(lat.mean()) if len(lat) else 0.0
+    return geo.EARTH_RADIUS * np.radians(lon) * np.cos(lat0), geo.EARTH_RADIUS * np.radians(lat)
+
+def segment_distance(px, py, ax, ay, bx, by):
+    """[Distance from points to the segments between a and b]
+    Args:
+        px, py ([numpy array]): [points]
+        ax, ay ([numpy array]): [first end of each point's segment]
+        bx, by ([numpy array]): [second end of each point's segment]
+    Returns:
+        [numpy array]: [distance, in the units of the inputs]
+    """
+    dx, dy = bx - ax, by - ay
+    length = dx**2 + dy**2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.where(length > 0, ((px - ax) * dx + (py - ay) * dy) / length, 0)
+    t = np.clip(t, 0, 1)
+    return np.hypot(px - ax - t * dx, py - ay - t * dy)
+
+def douglas_peucker(lat, lon, tolerance):
+    """[Douglas-Peucker simplification run breadth first: every pass splits
+        all unfinished segments at once at their farthest point, so the work
+        is a few array operations per level of the recursion]
+    Args:
+        lat ([numpy array]): [latitudes in degrees, no NaN]
+        lon ([numpy array]): [longitudes in degrees, no NaN]
+        tolerance ([float]): [maximum distance in metres between the track
+                              and its simplification]
+    Returns:
+        [numpy array]: [boolean mask of the points to keep]
+    """
+    n = len(lat)
+    keep = np.zeros(n, dtype=bool)
+    keep[[0, n - 1] if n else []] = True
+    if n <= 2:
+        return keep
+    x, y = local_xy(lat, lon)
+    undecided = np.ones(n, dtype=bool)
+    undecided[[0, n - 1]] = False
+    while undecided.any():
+        kept = np.flatnonzero(keep)
+        points = np.flatnonzero(undecided)
+        segment = np.searchsorted(kept, points, side='right') - 1
+        a, b = kept[segment], kept[segment + 1]
+        d = segment_distance(x[points], y[points], x[a], y[a], x[b], y[b])
+        starts = np.flatnonzero(np.r_[True, segment[1:] != segment[:-1]])
+        sizes = np.diff(np.r_[starts, len(points)])
+        farthest = np.maximum.reduceat(d, starts)
+        is_farthest = np.flatnonzero(d == np.repeat(farthest, sizes))
+        _, first = np.unique(segment[is_farthest], return_index=True)
+        split = points[is_farthest[first][farthest > tolerance]]
+        keep[split] = True
+        undecided[split] = False
+        undecided[points[np.repeat(farthest <= tolerance, sizes)]] = False
+    return keep
+
+def simplify_track(lat, lon, tolerance):
+    """[Simplifies a track, dropping points without a position]
+    Args:
+        lat ([numpy array]): [latitudes in degrees]
+        lon ([numpy array]): [longitudes in degrees]
+        tolerance ([float]): [see douglas_peucker]
+    Returns:
+        [numpy array]: [n x 2 float32 array of the kept latitude, longitude]
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    valid = ~(np.isnan(lat) | np.isnan(lon))
+    lat, lon = lat[valid], lon[valid]
+    keep = douglas_peucker(lat, lon, tolerance)
+    return np.column_stack([lat[keep], lon[keep]]).astype(np.float32)
+
+def to_locations(track, decimals=6):
+    """[Converts a simplified track to the list folium.PolyLine takes,
+        rounded so the map html does not carry float32 noise]
+    Args:
+        track ([numpy array]): [n x 2 array of latitude, longitude]
+        decimals (int, optional): [decimals kept, 6 is about 10 cm]. Defaults to 6.
+    Returns:
+        [list]: [list of [lat, long]]
+    """
+    return np.round(track.astype(np.float64), decimals).tolist()
+
+def zoom_tolerance(zoom, lat, pixels=1.0):
+    """[Size of a web map pixel on the ground]
+    Args:
+        zoom ([float]): [web map zoom level]
+        lat ([float]): [latitude in degrees]
+        pixels (float, optional): [number of pixels]. Defaults to 1.0.
+    Returns:
+        [float]: [distance in metres]
+    """
+    return pixels * METRES_PER_PIXEL * np.cos(np.radians(lat)) / 2**zoom
+
+def cache_file(person, zoom=None, tolerance=None, pixels=1.0):
+    """[File holding the simplified tracks of a person for one zoom level or tolerance]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where activity files are.]
+        zoom ([float], optional): [zoom level whose pixel is the tolerance]. Defaults to None.
+        tolerance ([float], optional): [tolerance in metres, used if zoom is None]. Defaults to None.
+        pixels (float, optional): [tolerance in pixels at zoom]. Defaults to 1.0.
+    Returns:
+        [string]: [path to the cache file]
+    """
+    name = f'zoom={zoom:g},pixels={pixels:g}' if zoom is not None else f'tolerance={tolerance:g}'
+    return f'../data/{person}/track_cache/{name}.pkl'
+
+def load_cache(filename):
+    """[Loads simplified tracks]
+    Args:
+        filename ([string]): [see cache_file]
+    Returns:
+        [dictionary]: [activity_id to n x 2 array of latitude, longitude]
+    """
+    if not os.path.exists(filename):
+        return {}
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+def save_cache(tracks, filename):
+    """[Saves simplified tracks, atomically replacing the previous file]
+    Args:
+        tracks ([dictionary]): [see load_cache]
+        filename ([string]): [see cache_file]
+    """
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(f'{filename}.tmp', 'wb') as f:
+        pickle.dump(tracks, f)
+    os.replace(f'{filename}.tmp', filename)
+
+def simplified_tracks(person, activity_ids, zoom=None, tolerance=None, pixels=1.0):
+    """[Simplified tracks of activities, read from the cache and computed
+        from the full resolution track store only for activities not cached
+        yet. Activities not in the store are returned empty but not cached,
+        so they are simplified once they are ingested.]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where activity files are.]
+        activity_ids ([list]): [activities to return]
+        zoom ([float], optional): [simplify to pixels pixels at this zoom
+                                   level, the tolerance following each
+                                   activity's latitude]. Defaults to None.
+        tolerance ([float], optional): [tolerance in metres, used if zoom is None]. Defaults to None.
+        pixels (float, optional): [tolerance in pixels at zoom]. Defaults to 1.0.
+    Returns:
+        [dictionary]: [activity_id to n x 2 array of latitude, longitude]
+    """
+    filename = cache_file(person, zoom, tolerance, pixels)
+    cache = load_cache(filename)
+    missing = [int(a) for a in activity_ids if int(a) not in cache]
+    if missing:
+        store = track_store.update_track_store(person)
+        missing = [a for a in missing if a in store['slices']]
+        for activity_id in missing:
+            track = track_store.activity_track(store, activity_id, ['position_lat', 'position_long'])
+            lat, lon = track['position_lat'], track['position_long']
+            if zoom is not None:
+                tolerance_m = zoom_tolerance(zoom, np.nanmean(lat) if len(lat) else 0, pixels)
+            else:
+                tolerance_m = tolerance
+            cache[activity_id] = simplify_track(lat, lon, tolerance_m)
+        if missing:
+            save_cache(cache, filename)
+    empty = np.empty((0, 2), dtype=np.float32)
+    return {int(a): cache.get(int(a), empty) for a in activity_ids}
+
+def invalidate_tracks(person, activity_ids):
+    """[Drops activities from every cached zoom level and tolerance of a
+        person, so changed tracks are simplified again on the next map build]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where activity files are.]
+        activity_ids ([list]): [activities to drop]
+    """
+    directory = f'../data/{person}/track_cache'
+    if not os.path.exists(directory):
+        return
+    activity_ids = {int(a) for a in activity_ids}
+    for name in os.listdir(directory):
+        if not name.endswith('.pkl'):
+            continue
+        filename = os.path.join(directory, name)
+        cache = load_cache(filename)
+        if activity_ids & cache.keys():
+            save_cache({a: t for a, t in cache.items() if a not in activity_ids}, filename)
+
+def clear_tracks(person):
+    """[Drops every cached simplified track of a person, for when the whole
+        dataset of the person was rewritten]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where activity files are.]
+    """
+    shutil.rmtree(f'../data/{person}/track_cache', ignore_errors=True)
@@ -0,0 +1,197 @@
+import numpy as np
+import pandas as pd
+import featurize
+
+DAY = 24 * 3600 * 10**9
+
+def to_ns(time):
+    """[Nanoseconds since the epoch of a record time, naive times taken as
+        UTC as featurize.featurize does]
+    Args:
+        time ([int, numpy datetime64, pandas Timestamp or string]): [record time,
+                                                                     ints are taken as nanoseconds]
+    Returns:
+        [int]: [nanoseconds since the epoch]
+    """
+    if isinstance(time, (int, np.integer)):
+        return int(time)
+    time = pd.Timestamp(time)
+    if time.tzinfo is not None:
+        time = time.tz_convert('UTC').tz_localize(None)
+    return time.value
+
+def new_stream(activity_id, speed_thres=0, window=2*5, interval="30s", method='ellipsoid', dtype=np.float32):
+    """[State of one live activity. Holds the sums of the open resampling bin,
+        the last resampled row and the last window rows of distance, speed and
+        delta_alt, so it stays the same size however long the activity runs.]
+    Args:
+        activity_id ([int]): [activity the records belong to]
+        speed_thres (int, optional): [see featurize.featurize]. Defaults to 0.
+        window (int, optional): [see featurize.featurize]. Defaults to 2*5.
+        interval ([string]): [see featurize.featurize] Defaults to 30s
+        method (str, optional): [see predict.compute_speed_distance]. Defaults to 'ellipsoid'.
+        dtype ([numpy dtype], optional): [dtype the records are stored in, bin
+                                          means are rounded to it as in
+                                          featurize.resample_arrays]. Defaults to np.float32.
+    Returns:
+        [dictionary]: [stream state]
+    """
+    return {'activity_id': activity_id, 'speed_thres': speed_thres, 'window': window,
+            'freq': pd.Timedelta(interval).value, 'method': method, 'dtype': np.dtype(dtype),
+            'origin': None, 'bin': None, 'sums': np.zeros(3), 'counts': np.zeros(3),
+            'previous': None, 'recent': np.full((3, window), np.nan), 'n_kept': 0, 'late': 0}
+
+def close_bin(stream):
+    """[Turns the open bin into a resampled row: the bin mean of each column,
+        filled forward from the previous row where the bin has no values, its
+        distance, delta_alt, time_delta and speed from the previous row and,
+        once window rows have passed speed_thres, the window features]
+    Args:
+        stream ([dictionary]): [see new_stream, updated in place]
+    Returns:
+        [dictionary]: [activity_id, time, position_lat, position_long, altitude,
+                       distance, delta_alt, time_delta, speed and features, the
+                       numpy array of featurize.FEATURE_COLUMNS or None]
+    """
+    dtype = stream['dtype']
+    sums, counts = stream['sums'].astype(dtype), stream['counts'].astype(dtype)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        values = np.where(counts > 0, sums / counts, np.nan).astype(dtype)
+    time = stream['origin'] + stream['bin'] * stream['freq']
+    previous = stream['previous']
+    if previous is not None:
+        values = np.where(np.isnan(values), previous[1], values).astype(dtype)
+    else:
+        previous = (time, values)
+    rows = np.column_stack([previous[1], values])
+    times = np.array([previous[0], time], dtype='datetime64[ns]')
+    distance, delta_alt, time_delta, speed = (x[1] for x in featurize.speed_distance_arrays(
+        np.zeros(2, dtype=np.int64), times, rows[0], rows[1], rows[2], stream['method']))
+    stream['previous'] = (time, values)
+    stream['sums'][:] = 0
+    stream['counts'][:] = 0
+    features = None
+    if speed >= stream['speed_thres']:
+        recent = stream['recent']
+        recent[:, :-1] = recent[:, 1:]
+        recent[:, -1] = distance, speed, delta_alt
+        stream['n_kept'] += 1
+        if stream['n_kept'] >= stream['window']:
+            month = np.datetime64(time, 'ns').astype('datetime64[M]').astype(np.int64) % 12 + 1
+            features = np.column_stack([recent.mean(axis=1), recent.max(axis=1),
+                                        recent.std(axis=1, ddof=1)]).reshape(-1)
+            features = np.r_[features, month]
+            if np.isnan(features).any():
+                features = None
+    return {'activity_id': stream['activity_id'], 'time': np.datetime64(time, 'ns'),
+            'position_lat': values[0], 'position_long': values[1], 'altitude': values[2],
+            'distance': distance, 'delta_alt': delta_alt, 'time_delta': time_delta,
+            'speed': speed, 'features': features}
+
+def advance(stream, time):
+    """[Closes every bin that ends at or before time, including empty bins in
+        a gap, which are filled forward. Records are expected in time order;
+        calling it on a wall clock closes bins a lagging device has not
+        finished sending, and its late records are then dropped.]
+    Args:
+        stream ([dictionary]): [see new_stream, updated in place]
+        time ([int or datetime]): [see to_ns]
+    Returns:
+        [list]: [resampled rows closed, see close_bin]
+    """
+    if stream['bin'] is None:
+        return []
+    last = (to_ns(time) - stream['origin']) // stream['freq']
+    ticks = []
+    while stream['bin'] < last:
+        ticks.append(close_bin(stream))
+        stream['bin'] += 1
+    return ticks
+
+def push_record(stream, time, lat, lon, alt):
+    """[Adds a record to the open bin, first closing the bins before it]
+    Args:
+        stream ([dictionary]): [see new_stream, updated in place]
+        time ([int or datetime]): [record time, see to_ns]
+        lat ([float]): [latitude, NaN if missing]
+        lon ([float]): [longitude, NaN if missing]
+        alt ([float]): [altitude, NaN if missing]
+    Returns:
+        [list]: [resampled rows closed, see close_bin]
+    """
+    time = to_ns(time)
+    if stream['origin'] is None:
+        stream['origin'] = (time // DAY) * DAY
+        stream['bin'] = (time - stream['origin']) // stream['freq']
+    ticks = advance(stream, time)
+    if (time - stream['origin']) // stream['freq'] < stream['bin']:
+        stream['late'] += 1
+        return ticks
+    values = np.array([lat, lon, alt], dtype=stream['dtype']).astype(np.float64)
+    valid = ~np.isnan(values)
+    stream['sums'] += np.where(valid, values, 0)
+    stream['counts'] += valid
+    return ticks
+
+def flush(stream):
+    """[Closes the open bin when the activity ends]
+    Args:
+        stream ([dictionary]): [see new_stream, updated in place]
+    Returns:
+        [list]: [resampled rows closed, see close_bin]
+    """
+    if stream['bin'] is None or stream['counts'].sum() == 0:
+        return []
+    ticks = [close_bin(stream)]
+    stream['bin'] += 1
+    return ticks
+
+def label_ticks(clf, ticks):
+    """[Predicts the mode of the ticks that have window features, in one call
+        to the same model predict.predict_mode uses]
+    Args:
+        clf ([model]): [fit classification model, see predict.load_model]
+        ticks ([list]): [resampled rows, see close_bin, updated in place with
+                         predicted_mode, None where there are no features]
+    Returns:
+        [list]: [ticks]
+    """
+    ready = [tick for tick in ticks if tick['features'] is not None]
+    for tick in ticks:
+        tick['predicted_mode'] = None
+    if ready:
+        modes = clf.predict(np.vstack([tick['features'] for tick in ready]))
+        for tick, mode in zip(ready, modes):
+            tick['predicted_mode'] = mode
+    return ticks
+
+def feed(streams, clf, activity_id, time, lat, lon, alt, **params):
+    """[Routes a live record to its activity's stream, starting one for a new
+        activity, and labels the ticks it closes]
+    Args:
+        streams ([dictionary]): [activity_id to stream state, updated in place]
+        clf ([model]): [fit classification model]
+        activity_id ([int]): [activity of the record]
+        time ([int or datetime]): [record time, see to_ns]
+        lat ([float]): [latitude]
+        lon ([float]): [longitude]
+        alt ([float]): [altitude]
+        params: [passed to new_stream]
+    Returns:
+        [list]: [labelled ticks, see label_ticks]
+    """
+    if activity_id not in streams:
+        streams[activity_id] = new_stream(activity_id, **params)
+    return label_ticks(clf, push_record(streams[activity_id], time, lat, lon, alt))
+
+def end_activity(streams, clf, activity_id):
+    """[Closes an activity's last bin, labels it and drops its state]
+    Args:
+        streams ([dictionary]): [activity_id to stream state, updated in place]
+        clf ([model]): [fit classification model]
+        activity_id ([int]): [activity that ended]
+    Returns:
+        [list]: [labelled ticks, see label_ticks]
+    """
+    stream = streams.pop(activity_id, None)
+    return label_ticks(clf, flush(stream)) if stream is not None else []
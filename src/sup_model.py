@@ -1,21 +1,32 @@
+import json
 import matplotlib.pyplot as plt
 import numpy as np
+import os
 import pandas as pd
 import pickle
+import sys
+import time
+from feature_store import build_feature_store, read_features
+from forest import export_forest
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import confusion_matrix, ConfusionMatrixDisplay
-from sklearn.model_selection import RandomizedSearchCV
+from sklearn.model_selection import ParameterSampler, RandomizedSearchCV, StratifiedKFold
 
 def prepare_data(df):
     """[Splits df into features and target then splits into train, test split]
     Args:
-        df ([pandas df]): [df containing features and target column mode]
+        df ([pandas df or list]): [df containing features and target column mode,
+                                   or feature files from feature_store.build_feature_store,
+                                   read a file at a time]
     Returns:
         [tuple of numpy arrays]: [X_train, X_test, y_train, y_test]
     """
-    X = df.drop("mode", axis=1).values
-    y = df['mode'].copy().values
+    if isinstance(df, pd.DataFrame):
+        X = df.drop("mode", axis=1).values
+        y = df['mode'].copy().values
+    else:
+        X, y = read_features(df)
     return train_test_split(X, y)
 
 def search_for_model(X_train, y_train, random_grid, n_iter, cv):
@@ -43,6 +54,151 @@ def search_for_model(X_train, y_train, random_grid, n_iter, cv):
     clf_random.fit(X_train, y_train)
     return clf_random.best_estimator_
 
+def fit_candidate(fits, params, folds, X, y, resource, amount, random_state=None, deadline=None, step=25):
+    """[Fits one candidate on every fold with amount of the resource and
+        scores it on the held out part of the fold. With resource n_estimators
+        the forests are kept warm, so growing a candidate only fits the trees
+        it does not have yet, step trees at a time. The deadline is checked
+        between steps and after every fold.]
+    Args:
+        fits ([list]): [fitted forest of each fold, None if not fitted yet,
+                        updated in place]
+        params ([dictionary]): [RandomForestClassifier parameters]
+        folds ([list]): [train and test indices of each fold]
+        X ([numpy array]): [training features]
+        y ([numpy array]): [target]
+        resource ([string]): [n_estimators or n_samples]
+        amount ([int]): [number of trees, or of training rows per fold]
+        random_state ([int], optional): [random state of the forests]. Defaults to None.
+        deadline ([float], optional): [time.process_time after which fitting stops]. Defaults to None.
+        step (int, optional): [trees added to a warm forest at a time]. Defaults to 25.
+    Returns:
+        [list]: [accuracy on each fold, None if the deadline passed first]
+    """
+    def out_of_time():
+        return deadline is not None and time.process_time() >= deadline
+
+    scores = []
+    for i, (train, test) in enumerate(folds):
+        if resource == 'n_estimators':
+            if fits[i] is None:
+                fits[i] = RandomForestClassifier(warm_start=True, n_jobs=-1, random_state=random_state,
+                                                 **params)
+            grown = len(getattr(fits[i], 'estimators_', []))
+            while grown < amount:
+                if grown and out_of_time():
+                    return None
+                grown = min(grown + step, amount)
+                fits[i].set_params(n_estimators=grown)
+                fits[i].fit(X[train], y[train])
+        else:
+            fits[i] = RandomForestClassifier(n_jobs=-1, random_state=random_state, **params)
+            fits[i].fit(X[train[:amount]], y[train[:amount]])
+        scores.append(fits[i].score(X[test], y[test]))
+        if out_of_time() and i < len(folds) - 1:
+            return None
+    return scores
+
+def halving_search(X_train, y_train, random_grid, n_candidates=27, cv=3, resource='n_estimators',
+                   min_resource=None, max_resource=None, factor=3, cpu_budget=None,
+                   log_file='../data/search_log.jsonl', random_state=0):
+    """[Successive halving search for a random forest classifier. Every
+        sampled candidate is scored with a little of the resource, then only
+        the best 1/factor go on to the next round with factor times more.
+        The folds are made once and reused by every round. The search stops
+        once it has used cpu_budget seconds of CPU time, checked while the
+        forests grow, keeping the best candidate of the last round scored and
+        dropping a candidate it could not finish. It is appended to log_file.]
+    Args:
+        X_train ([numpy array]): [training features]
+        y_train ([numpy array]): [target]
+        random_grid ([dictionary]): [see search_for_model, without the resource]
+        n_candidates (int, optional): [number of parameter settings that are sampled]. Defaults to 27.
+        cv (int, optional): [number of cross-validation folds to use]. Defaults to 3.
+        resource (str, optional): [n_estimators to grow the forests of the
+                                   survivors, or n_samples to train them on
+                                   more rows]. Defaults to 'n_estimators'.
+        min_resource ([int], optional): [resource of the first round]. Defaults to
+                                         None, 25 trees or 1000 rows.
+        max_resource ([int], optional): [most resource of a round]. Defaults to
+                                         None, 600 trees or every row of a fold.
+        factor (int, optional): [candidates are cut and resource grown by
+                                 this factor each round]. Defaults to 3.
+        cpu_budget ([float], optional): [CPU seconds the search may use, counting
+                                         every core]. Defaults to None, no limit.
+        log_file (str, optional): [JSON lines file the search is appended to,
+                                   None to not log]. Defaults to '../data/search_log.jsonl'.
+        random_state (int, optional): [seeds the sampling, folds and forests]. Defaults to 0.
+    Returns:
+        [tuple]: [best parameters including the resource, their mean score]
+    """
+    folds = list(StratifiedKFold(n_splits=cv, shuffle=True, random_state=random_state).split(X_train, y_train))
+    if resource == 'n_samples':
+        folds = [(np.random.default_rng(random_state).permutation(train), test) for train, test in folds]
+        max_resource = max_resource or min(len(train) for train, _ in folds)
+        min_resource = min_resource or min(1000, max_resource)
+    else:
+        max_resource = max_resource or 600
+        min_resource = min_resource or min(25, max_resource)
+    candidates = list(ParameterSampler(random_grid, n_candidates, random_state=random_state))
+    fits = {i: [None] * cv for i in range(len(candidates))}
+    alive = list(range(len(candidates)))
+    start = time.process_time()
+    deadline = None if cpu_budget is None else start + cpu_budget
+    rounds, best = [], None
+    amount = min_resource
+    while alive:
+        scored = []
+        for i in alive:
+            if deadline is not None and time.process_time() >= deadline:
+                break
+            scores = fit_candidate(fits[i], candidates[i], folds, X_train, y_train, resource, amount,
+                                   random_state, deadline)
+            if scores is None:
+                break
+            scored.append({'candidate': i, 'params': candidates[i], 'scores': scores, 'mean': float(np.mean(scores))})
+        if scored:
+            rounds.append({'resource': amount, 'results': scored,
+                           'cpu_seconds': time.process_time() - start})
+            top = sorted(scored, key=lambda result: -result['mean'])
+            best = dict(top[0]['params'], **{resource: amount}), top[0]['mean']
+        if len(scored) < len(alive) or amount >= max_resource or len(alive) == 1:
+            break
+        alive = [result['candidate'] for result in top[:max(1, len(top) // factor)]]
+        for i in set(fits) - set(alive):
+            del fits[i]
+        amount = min(amount * factor, max_resource)
+    cpu_seconds = time.process_time() - start
+    print(f'Searched {len(candidates)} candidates in {len(rounds)} rounds using {cpu_seconds:.0f} CPU seconds, '
+          f'best {best[1]:.3f} with {best[0]}' if best else 'Budget too small to score a candidate')
+    if log_file is not None:
+        entry = {'time': pd.Timestamp.now().isoformat(), 'resource': resource, 'factor': factor, 'cv': cv,
+                 'n_rows': len(X_train), 'cpu_budget': cpu_budget, 'cpu_seconds': cpu_seconds,
+                 'rounds': rounds, 'best_params': best[0] if best else None,
+                 'best_score': best[1] if best else None}
+        os.makedirs(os.path.dirname(log_file) or '.', exist_ok=True)
+        with open(log_file, 'a') as f:
+            f.write(json.dumps(entry, default=lambda x: x.item() if hasattr(x, 'item') else str(x)) + '\n')
+    return best
+
+def read_search_log(log_file='../data/search_log.jsonl'):
+    """[Results of the logged searches, to compare them]
+    Args:
+        log_file (str, optional): [see halving_search]. Defaults to '../data/search_log.jsonl'.
+    Returns:
+        [pandas df]: [one row per candidate scored in a round of a search]
+    """
+    rows = []
+    with open(log_file) as f:
+        for line in f:
+            search = json.loads(line)
+            for number, round_ in enumerate(search['rounds']):
+                for result in round_['results']:
+                    rows.append(dict(result['params'], search=search['time'], round=number,
+                                     resource=search['resource'], amount=round_['resource'],
+                                     mean_score=result['mean'], cpu_seconds=round_['cpu_seconds']))
+    return pd.DataFrame(rows)
+
 def confusion_plot(X_test, y_test, clf):
     """[Plots the confusion matrix]
     Args:
@@ -58,19 +214,29 @@ def confusion_plot(X_test, y_test, clf):
     plt.show()
 
 if __name__ == '__main__':
-    df = pd.read_parquet("../data/featurized.parquet")
+    # python sup_model.py [--feature-store] [--save]
+    # --feature-store trains on the hand labelled activities in ../data/labelled
+    # --save writes the model and the flattened forest predict.load_model can map
+    if '--feature-store' in sys.argv[1:]:
+        df = build_feature_store(window=2*5, interval="30s")
+    else:
+        df = pd.read_parquet("../data/featurized.parquet")
     X_train, X_test, y_train, y_test = prepare_data(df)
     clf = RandomForestClassifier(bootstrap=False, max_depth=15, max_features='sqrt',
                       min_samples_split=5, n_estimators=600)
     clf.fit(X_train, y_train)
     confusion_plot(X_test, y_test, clf)
-    # with open('../data/model.pkl', 'wb') as f:
-    #     pickle.dump(clf, f)
+    if '--save' in sys.argv[1:]:
+        with open('../data/model.pkl', 'wb') as f:
+            pickle.dump(clf, f)
+        export_forest(clf, '../data/model_forest')
 
     # random_grid = {'bootstrap': [True, False],
     #          'max_depth': [4, 6, 8, 10, 15, 20, 30],
-    #          'max_features': ['auto', 'sqrt'],
+    #          'max_features': ['log2', 'sqrt'],
     #          'min_samples_leaf': [1, 2, 4, 6],
     #          'min_samples_split': [2, 5, 10, 15],
     #          'n_estimators': [100, 200, 400, 600]}
-    # print(search_for_model(X_train, y_train, random_grid, 10, 3))
\ No newline at end of file
+    # print(search_for_model(X_train, y_train, random_grid, 10, 3))
+    # del random_grid['n_estimators']
+    # params, score = halving_search(X_train, y_train, random_grid, cpu_budget=600)
\ No newline at end of file
@@ -0,0 +1,235 @@
+import gzip
+import numpy as np
+import os
+import pandas as pd
+import struct
+
+FIT_EPOCH = np.datetime64('1989-12-31T00:00:00', 's')
+METRES_PER_DEGREE = 111195.0
+
+def crc_table():
+    """[Byte table of the CRC-16 fit files end with]
+    Returns:
+        [list]: [crc of each byte value]
+    """
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+CRC_TABLE = crc_table()
+
+def fit_crc(data, crc=0):
+    """[CRC-16 of the bytes as the fit protocol computes it]
+    Args:
+        data ([bytes]): [bytes to check]
+        crc (int, optional): [crc so far]. Defaults to 0.
+    Returns:
+        [int]: [crc]
+    """
+    for byte in data:
+        crc = (crc >> 8) ^ CRC_TABLE[(crc ^ byte) & 0xFF]
+    return crc
+
+RECORD_DTYPE = np.dtype([('header', 'u1'), ('timestamp', '<u4'), ('position_lat', '<i4'),
+                         ('position_long', '<i4'), ('altitude', '<u2'), ('heart_rate', 'u1'),
+                         ('distance', '<u4'), ('speed', '<u2')])
+# field number, size and base type of each record field after the header
+RECORD_FIELDS = [(253, 4, 0x86), (0, 4, 0x85), (1, 4, 0x85), (2, 2, 0x84),
+                 (3, 1, 0x02), (5, 4, 0x86), (6, 2, 0x84)]
+FILE_ID_FIELDS = [(0, 1, 0x00), (1, 2, 0x84), (2, 2, 0x84), (3, 4, 0x8C), (4, 4, 0x86)]
+
+def definition_message(local, mesg_num, fields):
+    """[Fit definition message, little endian]
+    Args:
+        local ([int]): [local message type]
+        mesg_num ([int]): [global message number]
+        fields ([list]): [field number, size and base type of each field]
+    Returns:
+        [bytes]: [definition message]
+    """
+    return struct.pack('<BBBHB', 0x40 | local, 0, 0, mesg_num, len(fields)) + bytes(
+        value for field in fields for value in field)
+
+def fit_bytes(times, lat, lon, alt, heart_rate, device):
+    """[Encodes a track as a fit activity file: a file_id message then one
+        record message per point with timestamp, position, altitude, heart
+        rate, distance and speed. Missing positions get the invalid value.]
+    Args:
+        times ([numpy array]): [datetime64[s] of each point]
+        lat ([numpy array]): [latitude in degrees, NaN without a fix]
+        lon ([numpy array]): [longitude in degrees, NaN without a fix]
+        alt ([numpy array]): [altitude in metres]
+        heart_rate ([numpy array]): [beats per minute]
+        device ([tuple]): [manufacturer, product and serial number]
+    Returns:
+        [bytes]: [contents of the fit file]
+    """
+    seconds = (times - FIT_EPOCH).astype(np.int64)
+    step = np.r_[0, np.hypot(np.diff(np.nan_to_num(lat)), np.diff(np.nan_to_num(lon)) *
+                            np.cos(np.radians(np.nanmean(lat))))] * METRES_PER_DEGREE
+    step[np.isnan(lat) | np.r_[True, np.isnan(lat[:-1])]] = 0
+    records = np.zeros(len(times), dtype=RECORD_DTYPE)
+    records['header'] = 1
+    records['timestamp'] = seconds
+    for name, degrees in [('position_lat', lat), ('position_long', lon)]:
+        records[name] = np.where(np.isnan(degrees), 0x7FFFFFFF,
+                                 np.round(np.nan_to_num(degrees) * (2**31 / 180))).astype(np.int64)
+    records['altitude'] = np.round((alt + 500) * 5)
+    records['heart_rate'] = heart_rate
+    records['distance'] = np.round(np.cumsum(step) * 100)
+    records['speed'] = np.round(np.clip(step / np.maximum(np.r_[1, np.diff(seconds)], 1), 0, 65) * 1000)
+    manufacturer, product, serial_number = device
+    body = (definition_message(0, 0, FILE_ID_FIELDS) +
+            struct.pack('<BBHHII', 0, 4, manufacturer, product, serial_number, int(seconds[0])) +
+            definition_message(1, 20, RECORD_FIELDS) + records.tobytes())
+    header = struct.pack('<BBHI4s', 14, 0x10, 2132, len(body), b'.FIT')
+    header += struct.pack('<H', fit_crc(header))
+    return header + body + struct.pack('<H', fit_crc(body, fit_crc(header)))
+
+def gpx_bytes(times, lat, lon, alt, name):
+    """[Encodes a track as a gpx 1.1 file, leaving out points without a fix]
+    Args:
+        times ([numpy array]): [datetime64[s] of each point]
+        lat ([numpy array]): [latitude in degrees]
+        lon ([numpy array]): [longitude in degrees]
+        alt ([numpy array]): [altitude in metres]
+        name ([string]): [name of the track]
+    Returns:
+        [bytes]: [contents of the gpx file]
+    """
+    fix = ~np.isnan(lat)
+    stamps = np.datetime_as_string(times[fix], unit='s')
+    points = ''.join(f'<trkpt lat="{a:.7f}" lon="{o:.7f}"><ele>{e:.1f}</ele><time>{t}Z</time></trkpt>\n'
+                     for a, o, e, t in zip(lat[fix], lon[fix], alt[fix], stamps))
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<gpx version="1.1" creator="synthetic_data" xmlns="http://www.topografix.com/GPX/1/1">\n'
+            f'<trk><name>{name}</name><trkseg>\n{points}</trkseg></trk>\n</gpx>\n').encode()
+
+def random_peaks(rng, n_peaks):
+    """[Summits the synthetic athletes climb, spread over a few mountain ranges]
+    Args:
+        rng ([numpy Generator]): [random generator]
+        n_peaks ([int]): [number of summits]
+    Returns:
+        [numpy array]: [n_peaks x 3 array of latitude, longitude and altitude]
+    """
+    ranges = np.array([[39.6, -106.1], [46.5, 7.9], [45.9, 6.9], [-43.6, 170.2]])
+    centre = ranges[rng.integers(len(ranges), size=n_peaks)]
+    return np.column_stack([centre + rng.normal(scale=0.3, size=(n_peaks, 2)),
+                            rng.uniform(2000, 4300, size=n_peaks)])
+
+def leg(rng, start, end, n, shape):
+    """[Points from start to end along a wandering route]
+    Args:
+        rng ([numpy Generator]): [random generator]
+        start ([numpy array]): [latitude, longitude and altitude]
+        end ([numpy array]): [latitude, longitude and altitude]
+        n ([int]): [number of points]
+        shape ([float]): [exponent of the altitude profile]
+    Returns:
+        [numpy array]: [n x 3 array of latitude, longitude and altitude]
+    """
+    s = np.linspace(0, 1, n)
+    points = start + (end - start) * s[:, None]
+    points[:, 2] = start[2] + (end[2] - start[2]) * s**shape
+    bend = rng.uniform(100, 400) * np.sin(np.pi * s * rng.integers(1, 4))
+    cross = np.array([-(end - start)[1], (end - start)[0]])
+    cross = cross / max(np.hypot(*cross), 1e-9) / METRES_PER_DEGREE
+    points[:, :2] += bend[:, None] * cross
+    return points
+
+def synthetic_track(rng, peak, start):
+    """[A climb from a valley to a summit and a faster descent by another
+        route, recorded every 1 to 5 seconds with GPS noise and sometimes a
+        late first fix]
+    Args:
+        rng ([numpy Generator]): [random generator]
+        peak ([numpy array]): [latitude, longitude and altitude of the summit]
+        start ([numpy datetime64]): [start time]
+    Returns:
+        [tuple]: [numpy arrays of time, latitude, longitude, altitude and heart
+                  rate, and the distance and climb of the route before noise]
+    """
+    distance = rng.uniform(2000, 6000)
+    bearing = rng.uniform(0, 2 * np.pi)
+    gain = rng.uniform(200, 1500)
+    summit = peak + np.r_[rng.normal(scale=15 / METRES_PER_DEGREE, size=2), 0]
+    base = summit + np.r_[distance * np.cos(bearing) / METRES_PER_DEGREE,
+                          distance * np.sin(bearing) / METRES_PER_DEGREE / np.cos(np.radians(peak[0])), -gain]
+    interval = rng.choice([1, 1, 2, 5])
+    n_up = max(int(distance / rng.uniform(0.6, 1.5) / interval), 10)
+    n_top = int(rng.uniform(60, 600) / interval)
+    n_down = max(int(distance / rng.uniform(1.5, 8) / interval), 10)
+    points = np.concatenate([leg(rng, base, summit, n_up, 0.8), np.repeat(summit[None, :], n_top, axis=0),
+                             leg(rng, summit, base, n_down, 1.2)])
+    route = (np.hypot(np.diff(points[:, 0]), np.diff(points[:, 1]) * np.cos(np.radians(peak[0]))).sum()
+             * METRES_PER_DEGREE, gain)
+    points[:, :2] += rng.normal(scale=3 / METRES_PER_DEGREE, size=(len(points), 2))
+    points[:, 2] += rng.normal(scale=1.5, size=len(points))
+    times = start + np.arange(len(points)) * np.timedelta64(int(interval), 's')
+    no_fix = int(rng.integers(0, 30) / interval) if rng.random() < 0.2 else 0
+    points[:no_fix, :2] = np.nan
+    heart_rate = np.clip(120 + 40 * np.r_[np.ones(n_up), np.zeros(n_top + n_down)] +
+                         rng.normal(scale=5, size=len(points)), 60, 200)
+    return times, points[:, 0], points[:, 1], points[:, 2], heart_rate, route
+
+def generate_archive(person, n_activities, seed=0, n_peaks=None, fit_fraction=0.7, root='../data'):
+    """[Writes a synthetic athlete archive laid out like a Strava export:
+        ../data/{person}/activities.csv and an activities folder of
+        .fit.gz, .gpx and .gpx.gz files, each a climb of one of a set of
+        summits so peak detection and clustering have work to do]
+    Args:
+        person ([string]): [name of the folder to write in root]
+        n_activities ([int]): [number of activities]
+        seed (int, optional): [random seed]. Defaults to 0.
+        n_peaks ([int], optional): [number of summits]. Defaults to None, one
+                                    per 20 activities.
+        fit_fraction (float, optional): [share of fit files, the rest are gpx,
+                                         half of them compressed]. Defaults to 0.7.
+        root (str, optional): [data folder]. Defaults to '../data'.
+    Returns:
+        [pandas dataframe]: [the activities.csv written]
+    """
+    rng = np.random.default_rng(seed)
+    peaks = random_peaks(rng, n_peaks or max(n_activities // 20, 1))
+    devices = [(1, product, int(rng.integers(3900000000))) for product in (2697, 3113, 3290, 3589)]
+    directory = os.path.join(root, person, 'activities')
+    os.makedirs(directory, exist_ok=True)
+    first = np.datetime64('2018-01-01T06:00:00', 's')
+    starts = np.sort(first + rng.integers(0, 5 * 365 * 86400, size=n_activities).astype('timedelta64[s]'))
+    rows = []
+    for i, start in enumerate(starts):
+        times, lat, lon, alt, heart_rate, (distance, gain) = synthetic_track(rng, peaks[rng.integers(len(peaks))], start)
+        file_id = 2000000000 + i
+        kind = rng.random()
+        if kind < fit_fraction:
+            filename = f'activities/{file_id}.fit.gz'
+            data = fit_bytes(times, lat, lon, alt, heart_rate, devices[rng.integers(len(devices))])
+        else:
+            compress = kind > (1 + fit_fraction) / 2
+            filename = f'activities/{file_id}.gpx' + ('.gz' if compress else '')
+            data = gpx_bytes(times, lat, lon, alt, f'Synthetic {i}')
+        path = os.path.join(root, person, filename)
+        with (gzip.open(path, 'wb', compresslevel=1) if path.endswith('.gz') else open(path, 'wb')) as f:
+            f.write(data)
+        elapsed = int((times[-1] - times[0]).astype(int))
+        rows.append({'Activity ID': 1000000000 + i,
+                     'Activity Date': pd.Timestamp(start).strftime('%b %d, %Y, %I:%M:%S %p').replace(' 0', ' '),
+                     'Activity Name': f'Synthetic {i}',
+                     'Activity Type': ['Hike', 'Run', 'BackcountrySki'][i % 3],
+                     'Elapsed Time': elapsed, 'Distance': round(distance / 1000, 2),
+                     'Filename': filename, 'Moving Time': elapsed,
+                     'Elevation Gain': round(gain, 1), 'Elevation Loss': round(gain, 1),
+                     'Average Speed': round(distance / max(elapsed, 1), 3),
+                     'Average Grade': round(100 * gain / max(distance, 1), 3)})
+    activities = pd.DataFrame(rows)
+    activities.to_csv(os.path.join(root, person, 'activities.csv'), index=False)
+    return activities
+
+if __name__ == '__main__':
+    for n in [100, 5000, 50000]:
+        generate_archive(f'Synthetic_{n}', n)
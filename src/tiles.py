@@ -0,0 +1,192 @@
+from branca.element import Template, MacroElement
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+import folium
+import json
+import numpy as np
+import os
+import shutil
+import simplify
+
+MAX_LATITUDE = 85.0511287798
+
+loader_string = """
+{% macro script(this, kwargs) %}
+(function() {
+    var map = {{ this._parent.get_name() }};
+    var index = {{ this.index }};
+    var minZoom = {{ this.min_zoom }}, maxZoom = {{ this.max_zoom }};
+    var groups = {}, loaded = {}, drawn = {};
+    function tileX(lon, z) { return Math.floor((lon + 180) / 360 * Math.pow(2, z)); }
+    function tileY(lat, z) {
+        var r = Math.max(Math.min(lat, 85.0511287798), -85.0511287798) * Math.PI / 180;
+        return Math.floor((1 - Math.log(Math.tan(r) + 1 / Math.cos(r)) / Math.PI) / 2 * Math.pow(2, z));
+    }
+    function style(feature) { return feature.properties.style; }
+    function unseen(feature) {
+        var piece = feature.properties.piece;
+        if (piece === undefined) { return true; }
+        if (drawn[piece]) { return false; }
+        drawn[piece] = true;
+        return true;
+    }
+    function point(feature, latlng) { return L.circleMarker(latlng, feature.properties.style); }
+    function popup(feature, layer) {
+        if (feature.properties.popup) { layer.bindPopup(feature.properties.popup); }
+    }
+    function load() {
+        var z = Math.min(Math.max(Math.round(map.getZoom()), minZoom), maxZoom);
+        var bounds = map.getBounds();
+        for (var zoom in groups) {
+            if (zoom != z && map.hasLayer(groups[zoom])) { map.removeLayer(groups[zoom]); }
+        }
+        if (!groups[z]) { groups[z] = L.layerGroup(); }
+        groups[z].addTo(map);
+        var x0 = tileX(bounds.getWest(), z), x1 = tileX(bounds.getEast(), z);
+        var y0 = tileY(bounds.getNorth(), z), y1 = tileY(bounds.getSouth(), z);
+        for (var layer in index) {
+            var tiles = index[layer][z] || {};
+            for (var x = x0; x <= x1; x++) {
+                for (var y = y0; y <= y1; y++) {
+                    var key = layer + '/' + z + '/' + x + '/' + y;
+                    if (!tiles[x + '/' + y] || loaded[key]) { continue; }
+                    loaded[key] = true;
+                    fetch(key + '.geojson').then(function(response) { return response.json(); })
+                        .then(function(group) { return function(data) {
+                            L.geoJSON(data, {style: style, pointToLayer: point, onEachFeature: popup,
+                                       filter: unseen}).addTo(group);
+                        }; }(groups[z]));
+                }
+            }
+        }
+    }
+    map.on('moveend', load);
+    load();
+})();
+{% endmacro %}
+"""
+
+def tile_xy(lat, lon, zoom):
+    """[Web mercator tile of each point, the tiling Leaflet uses]
+    Args:
+        lat ([numpy array]): [latitudes in degrees]
+        lon ([numpy array]): [longitudes in degrees]
+        zoom ([int]): [zoom level]
+    Returns:
+        [tuple of numpy arrays]: [tile x and y of each point]
+    """
+    n = 2**zoom
+    lat = np.radians(np.clip(np.asarray(lat, dtype=np.float64), -MAX_LATITUDE, MAX_LATITUDE))
+    lon = np.asarray(lon, dtype=np.float64)
+    x = np.floor((lon + 180) / 360 * n)
+    y = np.floor((1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2 * n)
+    return np.clip(x, 0, n - 1).astype(np.int64), np.clip(y, 0, n - 1).astype(np.int64)
+
+def add_line(tiles, track, zoom, properties):
+    """[Cuts a line into runs of points in the same tile and adds each run
+        as a GeoJSON LineString to every tile its bounding box touches. Each
+        run also takes the first point of the next so the pieces join up, so
+        a line crossing a tile edge, or a long segment at high zoom, shows
+        in whichever of its tiles is loaded. A piece keeps the same piece id
+        in every tile so the map draws it once.]
+    Args:
+        tiles ([dictionary]): [(x, y) to list of features, updated in place]
+        track ([numpy array]): [n x 2 array of latitude, longitude]
+        zoom ([int]): [zoom level]
+        properties ([dictionary]): [GeoJSON properties of every piece]
+    """
+    if len(track) < 2:
+        return
+    x, y = tile_xy(track[:, 0], track[:, 1], zoom)
+    starts = np.flatnonzero(np.r_[True, (x[1:] != x[:-1]) | (y[1:] != y[:-1])])
+    stops = np.r_[starts[1:] + 1, len(track)]
+    for start, stop in zip(starts, stops):
+        if stop - start < 2:
+            continue
+        coordinates = simplify.to_locations(track[start:stop, ::-1])
+        home = (int(x[start]), int(y[start]))
+        piece = f'{zoom}/{home[0]}/{home[1]}/{len(tiles.get(home, []))}'
+        feature = {'type': 'Feature', 'properties': dict(properties, piece=piece),
+                   'geometry': {'type': 'LineString', 'coordinates': coordinates}}
+        for tile_x in range(int(x[start:stop].min()), int(x[start:stop].max()) + 1):
+            for tile_y in range(int(y[start:stop].min()), int(y[start:stop].max()) + 1):
+                tiles.setdefault((tile_x, tile_y), []).append(feature)
+
+def add_point(tiles, lat, lon, zoom, properties):
+    """[Adds a point to its tile as a GeoJSON Point]
+    Args:
+        tiles ([dictionary]): [(x, y) to list of features, updated in place]
+        lat ([float]): [latitude in degrees]
+        lon ([float]): [longitude in degrees]
+        zoom ([int]): [zoom level]
+        properties ([dictionary]): [GeoJSON properties of the point]
+    """
+    x, y = tile_xy([lat], [lon], zoom)
+    tiles.setdefault((int(x[0]), int(y[0])), []).append(
+        {'type': 'Feature', 'properties': properties,
+         'geometry': {'type': 'Point', 'coordinates': [round(float(lon), 6), round(float(lat), 6)]}})
+
+def write_layer(directory, layer, zoom, tiles):
+    """[Writes one zoom level of a layer as {layer}/{zoom}/{x}/{y}.geojson]
+    Args:
+        directory ([string]): [directory of the tiled map]
+        layer ([string]): [name of the layer]
+        zoom ([int]): [zoom level]
+        tiles ([dictionary]): [(x, y) to list of features]
+    Returns:
+        [list]: [x/y of the tiles written]
+    """
+    shutil.rmtree(os.path.join(directory, layer, str(zoom)), ignore_errors=True)
+    for (x, y), features in tiles.items():
+        path = os.path.join(directory, layer, str(zoom), str(x))
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, f'{y}.geojson'), 'w') as f:
+            json.dump({'type': 'FeatureCollection', 'features': features}, f, separators=(',', ':'))
+    return [f'{x}/{y}' for x, y in tiles]
+
+def save_tiled_map(directory, location, zoom_start, layers, legend=None):
+    """[Writes the index.html of a tiled map: a folium map that fetches the
+        GeoJSON tiles in view at the current zoom instead of inlining every
+        coordinate]
+    Args:
+        directory ([string]): [directory of the tiled map]
+        location ([list]): [lat/long the map is centred on]
+        zoom_start ([float]): [initial zoom]
+        layers ([dictionary]): [layer name to dictionary of zoom to tiles
+                                written, see write_layer]
+        legend ([string], optional): [legend template, e.g.
+                                      legend_helper.legend_string]. Defaults to None.
+    Returns:
+        [folium map object]: [folium map object]
+    """
+    zooms = [int(zoom) for tiles in layers.values() for zoom in tiles]
+    index = {layer: {str(zoom): {key: True for key in keys} for zoom, keys in tiles.items()}
+             for layer, tiles in layers.items()}
+    m = folium.Map(location=location, tiles='Stamen Terrain', zoom_start=zoom_start)
+    loader = MacroElement()
+    loader._template = Template(loader_string)
+    loader.index = json.dumps(index)
+    loader.min_zoom, loader.max_zoom = (min(zooms), max(zooms)) if zooms else (0, 0)
+    m.add_child(loader)
+    if legend is not None:
+        macro = MacroElement()
+        macro._template = Template(legend)
+        m.add_child(macro)
+    os.makedirs(directory, exist_ok=True)
+    m.save(os.path.join(directory, 'index.html'))
+    return m
+
+def serve(directory, port=8000):
+    """[Serves a tiled map on http://localhost:port/index.html, since browsers
+        will not fetch the tiles of a map opened from file://]
+    Args:
+        directory ([string]): [directory of the tiled map]
+        port (int, optional): [port to listen on]. Defaults to 8000.
+    """
+    handler = partial(SimpleHTTPRequestHandler, directory=directory)
+    with ThreadingHTTPServer(('localhost', port), handler) as server:
+        print(f'Serving http://localhost:{port}/index.html')
+        server.serve_forever()
+
+if __name__ == '__main__':
+    serve('../html/Example')
@@ -0,0 +1,235 @@
+from contextlib import contextmanager
+import fcntl
+import glob
+import json
+import numpy as np
+import os
+import pandas as pd
+import shutil
+import dataset
+
+TRACK_COLUMNS = {'timestamp': 'datetime64[ns]', 'position_lat': np.float32,
+                 'position_long': np.float32, 'altitude': np.float32, 'segment': np.int16}
+MISSING = {'timestamp': np.datetime64('NaT'), 'position_lat': np.nan, 'position_long': np.nan,
+           'altitude': np.nan, 'segment': 0}
+
+def store_dir(person):
+    """[Directory of a person's track store]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where activity files are.]
+    Returns:
+        [string]: [directory holding one .npy file per column and the activity index]
+    """
+    return f'../data/{person}/track_store'
+
+def dataset_signature(person, root=dataset.DATASET_DIR):
+    """[Size and modification time of each dataset file of a person, to tell
+        whether the track store was built from the current dataset. Only the
+        person's partition directories are listed, so it takes a few stat
+        calls however many people the dataset holds.]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where activity files are.]
+        root (str, optional): [root of the dataset]. Defaults to dataset.DATASET_DIR.
+    Returns:
+        [dictionary]: [file path to [size, mtime_ns]]
+    """
+    signature = {}
+    for path in sorted(glob.glob(os.path.join(root, f'person={person}', '*', '*', '*.parquet'))):
+        stat = os.stat(path)
+        signature[path] = [stat.st_size, stat.st_mtime_ns]
+    return signature
+
+@contextmanager
+def store_lock(directory):
+    """[Holds an exclusive lock on a track store while it is rebuilt, so two
+        processes updating it at once do not both build and swap it in]
+    Args:
+        directory ([string]): [store directory]
+    """
+    os.makedirs(os.path.dirname(directory) or '.', exist_ok=True)
+    with open(f'{directory}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def build_track_store(person, root=dataset.DATASET_DIR, directory=None, previous=None):
+    """[Copies the timestamps, coordinates, altitude and segment (see
+        clean.clean_activity) of a person's records into one contiguous array
+        per column, with the activities one after another, plus an index of
+        where each activity starts. Partitions are read one at a time into
+        arrays preallocated on disk, so memory does not grow with the
+        archive. The rows of partitions that did not change
+        since the previous store was built are copied from it instead of
+        being read from the dataset again. The new store replaces the old
+        one in a rename, so readers never see a partial store. Callers
+        should hold store_lock, see update_track_store.]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where activity files are.]
+        root (str, optional): [root of the dataset]. Defaults to dataset.DATASET_DIR.
+        directory ([string], optional): [store directory]. Defaults to store_dir(person).
+        previous ([dictionary], optional): [store to copy unchanged partitions
+                                            from, see load_track_store]. Defaults to None.
+    Returns:
+        [dictionary]: [see load_track_store]
+    """
+    directory = directory or store_dir(person)
+    signature = dataset_signature(person, root)
+    fragments = []
+    if signature:
+        fragments = list(dataset.open_dataset(root).get_fragments(filter=dataset.build_filter(person)))
+        fragments.sort(key=lambda fragment: fragment.path)
+    reusable = {}
+    if previous is not None and list(previous['columns']) == list(TRACK_COLUMNS):
+        reusable = {path: rows for path, rows in previous['ranges'].items()
+                    if path in signature and previous['sources'].get(path) == signature[path]}
+    n_rows = sum(fragment.metadata.num_rows for fragment in fragments)
+    building = f'{directory}.tmp-{os.getpid()}'
+    shutil.rmtree(building, ignore_errors=True)
+    os.makedirs(building)
+    arrays = {column: np.lib.format.open_memmap(os.path.join(building, f'{column}.npy'), mode='w+',
+                                                dtype=dtype, shape=(n_rows,))
+              for column, dtype in TRACK_COLUMNS.items()}
+    ids, starts, ranges = [], [], {}
+    start = 0
+    for fragment in fragments:
+        if fragment.path in reusable:
+            first, last = reusable[fragment.path]
+            stop = start + last - first
+            for column, array in arrays.items():
+                array[start:stop] = previous['columns'][column][first:last]
+            i, j = np.searchsorted(previous['offsets'][:-1], [first, last])
+            ids.append(previous['activity_ids'][i:j])
+            starts.append(previous['offsets'][i:j] - first + start)
+            ranges[fragment.path] = [start, stop]
+            start = stop
+            continue
+        names = fragment.physical_schema.names
+        table = fragment.to_table(columns=['activity_id'] + [c for c in TRACK_COLUMNS if c in names])
+        stop = start + table.num_rows
+        for column, array in arrays.items():
+            if column in names:
+                array[start:stop] = table.column(column).to_numpy()
+            else:
+                array[start:stop] = MISSING[column]
+        activity_ids = table.column('activity_id').to_numpy()
+        runs = np.flatnonzero(np.r_[True, activity_ids[1:] != activity_ids[:-1]]) if len(activity_ids) else []
+        ids.append(activity_ids[runs])
+        starts.append(start + np.asarray(runs, dtype=np.int64))
+        ranges[fragment.path] = [start, stop]
+        start = stop
+    for array in arrays.values():
+        array.flush()
+    del arrays
+    np.save(os.path.join(building, 'activity_ids.npy'), np.concatenate(ids + [np.empty(0, dtype=np.int64)]))
+    np.save(os.path.join(building, 'offsets.npy'), np.r_[np.concatenate(starts + [np.empty(0, dtype=np.int64)]),
+                                                         n_rows].astype(np.int64))
+    with open(os.path.join(building, 'meta.json'), 'w') as f:
+        json.dump({'rows': n_rows, 'columns': list(TRACK_COLUMNS), 'sources': signature, 'ranges': ranges}, f)
+    old = f'{directory}.old-{os.getpid()}'
+    if os.path.exists(directory):
+        os.rename(directory, old)
+    os.rename(building, directory)
+    shutil.rmtree(old, ignore_errors=True)
+    return load_track_store(person, directory=directory)
+
+def load_track_store(person, mmap=True, directory=None):
+    """[Opens a person's track store. The column arrays are memory mapped, so
+        opening it reads only the activity index.]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where activity files are.]
+        mmap (bool, optional): [memory map the arrays]. Defaults to True.
+        directory ([string], optional): [store directory]. Defaults to store_dir(person).
+    Returns:
+        [dictionary]: [columns, a dictionary of column name to array,
+                       activity_ids and offsets, activity_ids[i]'s rows being
+                       offsets[i] to offsets[i + 1], slices, activity_id to
+                       (start, stop), sources, the dataset signature it
+                       was built from, and ranges, dataset file to the
+                       (start, stop) of its rows. None if there is no store,
+                       or it is being swapped for a new one.]
+    """
+    directory = directory or store_dir(person)
+    if not os.path.exists(os.path.join(directory, 'meta.json')):
+        return None
+    try:
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+        columns = {column: np.load(os.path.join(directory, f'{column}.npy'), mmap_mode='r' if mmap else None)
+                   for column in meta['columns']}
+        activity_ids = np.load(os.path.join(directory, 'activity_ids.npy'))
+        offsets = np.load(os.path.join(directory, 'offsets.npy'))
+    except FileNotFoundError:
+        return None
+    slices = {int(a): (int(start), int(stop)) for a, start, stop in zip(activity_ids, offsets[:-1], offsets[1:])}
+    return {'columns': columns, 'activity_ids': activity_ids, 'offsets': offsets,
+            'slices': slices, 'sources': meta['sources'], 'ranges': meta.get('ranges', {})}
+
+def update_track_store(person, root=dataset.DATASET_DIR, directory=None):
+    """[Opens a person's track store, first rebuilding it if the dataset was
+        written since it was built or it holds other columns. Only the
+        partitions written since are read, see build_track_store, and a
+        process that finds another rebuilding it waits and uses its store.]
+    Args:
+        person ([string]): [The name of the folder in ../data
+        where activity files are.]
+        root (str, optional): [root of the dataset]. Defaults to dataset.DATASET_DIR.
+        directory ([string], optional): [store directory]. Defaults to store_dir(person).
+    Returns:
+        [dictionary]: [see load_track_store]
+    """
+    def current(store):
+        return store is not None and store['sources'] == dataset_signature(person, root) and \
+            list(store['columns']) == list(TRACK_COLUMNS)
+
+    directory = directory or store_dir(person)
+    store = load_track_store(person, directory=directory)
+    if not current(store):
+        with store_lock(directory):
+            store = load_track_store(person, directory=directory)
+            if not current(store):
+                store = build_track_store(person, root, directory, previous=store)
+    return store
+
+def activity_track(store, activity_id, columns=None):
+    """[Rows of one activity, as slices of the store's arrays without copying]
+    Args:
+        store ([dictionary]): [see load_track_store]
+        activity_id ([int]): [id of the activity]
+        columns ([list], optional): [columns to return]. Defaults to None, all.
+    Returns:
+        [dictionary]: [column name to array, empty if the activity is not in the store]
+    """
+    start, stop = store['slices'].get(int(activity_id), (0, 0))
+    return {column: store['columns'][column][start:stop] for column in columns or store['columns']}
+
+def tracks_frame(store, activity_ids=None, columns=None):
+    """[Copies the rows of some activities into a dataframe, for the code
+        that works on dataframes]
+    Args:
+        store ([dictionary]): [see load_track_store]
+        activity_ids ([list], optional): [activities to return]. Defaults to None, all.
+        columns ([list], optional): [columns to return]. Defaults to None, all.
+    Returns:
+        [pandas dataframe]: [records with an activity_id column, each activity in time order]
+    """
+    columns = [c for c in columns or store['columns'] if c != 'activity_id']
+    if activity_ids is None:
+        activity_ids = store['activity_ids']
+    activity_ids = [int(a) for a in activity_ids if int(a) in store['slices']]
+    slices = [store['slices'][a] for a in activity_ids]
+    sizes = np.array([stop - start for start, stop in slices], dtype=np.int64)
+    df = pd.DataFrame({column: np.concatenate([store['columns'][column][start:stop] for start, stop in slices]
+                                              + [store['columns'][column][:0]])
+                       for column in columns})
+    df['activity_id'] = np.repeat(np.array(activity_ids, dtype=np.int64), sizes)
+    return df
+
+if __name__ == '__main__':
+    store = update_track_store('Example_Strava')
+    print(f"{len(store['activity_ids'])} activities, {len(store['columns']['timestamp'])} records")